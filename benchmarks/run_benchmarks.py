@@ -0,0 +1,280 @@
+'''
+Reproducible offline benchmarks for extraction, search, quantization and persistence.
+Synthetic face libraries are generated from a fixed seed and results are
+written as JSON so runs can be compared over time.
+
+usage (from the root directory of this repo):
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 1000000 --output bench.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import queue as queue_module
+import multiprocessing
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+def synthetic_face_data(n_images:int, seed:int=0, n_identities:int=None) -> dict:
+    '''
+    Returns a face data dictionary of n_images synthetic images with 0-3 faces each.
+    Encodings are clustered around n_identities centres like real dlib descriptors
+    :param n_images: number of images
+    :param seed: random seed
+    :param n_identities: number of distinct identities. Defaults to n_images/20
+    '''
+    import model
+    rng = np.random.default_rng(seed)
+    n_identities = n_identities or max(1, n_images//20)
+    centres = rng.normal(0, 0.1, (n_identities, 128))
+    n_faces = rng.choice(4, n_images, p=[0.1, 0.6, 0.2, 0.1])
+    identities = rng.integers(0, n_identities, n_faces.sum())
+    encodings = centres[identities] + rng.normal(0, 0.03, (len(identities), 128))
+    data, row = dict(), 0
+    for i, count in enumerate(n_faces):
+        faces = np.tile(np.array([10, 10, 110, 110], dtype=np.int32), (count, 1))
+        data[f'/synthetic/{i:08d}.jpg'] = model.FaceData(encodings[row:row+count], faces)
+        row += count
+    return data
+
+def percentiles(seconds:list) -> dict:
+    '''
+    :param seconds: latencies in seconds
+    '''
+    ms = np.array(seconds)*1000
+    return {'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)), 'mean_ms': float(ms.mean())}
+
+def peak_rss_mb() -> float:
+    '''
+    Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024
+
+def bench_search(size:int, n_queries:int, top_k:int, seed:int) -> dict:
+    '''
+    Query latency of exact, batched and approximate search
+    '''
+    import search
+    import ann
+    data = synthetic_face_data(size, seed)
+    keys = [k for k, v in data.items() if len(v.face_encodings) == 1]
+    rng = np.random.default_rng(seed+1)
+    queries = [keys[i] for i in rng.choice(len(keys), min(n_queries, len(keys)), replace=False)]
+    start = time.perf_counter()
+    index = search.EmbeddingIndex.from_face_data(data)
+    result = {'n_faces': len(index), 'index_build_s': time.perf_counter()-start}
+
+    latencies = list()
+    for query in queries:
+        start = time.perf_counter()
+        index.search(data[query].face_encodings[0], top_k, exclude=query)
+        latencies.append(time.perf_counter()-start)
+    result['exact'] = percentiles(latencies)
+
+    encodings = [data[query].face_encodings[0] for query in queries]
+    start = time.perf_counter()
+    index.search_batch(encodings, top_k, exclude=queries)
+    result['batch_per_query_ms'] = (time.perf_counter()-start)*1000/len(queries)
+
+    start = time.perf_counter()
+    ivf = ann.IVFIndex.build(index, n_iter=10)
+    result['ivf_build_s'] = time.perf_counter()-start
+    latencies = list()
+    for query in queries:
+        start = time.perf_counter()
+        ivf.search(data[query].face_encodings[0], top_k, exclude=query)
+        latencies.append(time.perf_counter()-start)
+    result['ivf'] = percentiles(latencies)
+    result['ivf']['nprobe'] = ivf.nprobe
+    result['ivf']['recall_at_10'] = ivf.recall(min(100, len(queries)), 10)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def bench_quantization(size:int, n_queries:int, top_k:int, mode:str, seed:int) -> dict:
+    '''
+    Memory use, recall and query latency of a quantized index with exact re-ranking,
+    against exact search over the same (memory-mapped) face store
+    '''
+    import face_store
+    import search
+    import quantization
+    tmp_dir = tempfile.mkdtemp(prefix='face-search-bench-')
+    try:
+        path = os.path.join(tmp_dir, 'faces.fstore')
+        face_store.FaceStore.write(path, synthetic_face_data(size, seed))
+        store = face_store.FaceStore(path)
+        flat = search.EmbeddingIndex.from_arrays(store.keys, np.diff(store.offsets), store.encodings, store.norms)
+        start = time.perf_counter()
+        index = quantization.QuantizedIndex.build(flat, mode)
+        result = {'build_s': time.perf_counter()-start}
+        result.update(index.report(min(n_queries, 100), top_k))
+        rng = np.random.default_rng(seed+1)
+        rows = rng.choice(len(flat), min(n_queries, len(flat)), replace=False)
+        latencies, same = list(), 0
+        for row in rows:
+            query, key = np.array(flat.matrix[row]), flat.row_info(row)[0]
+            start = time.perf_counter()
+            matches = index.search(query, top_k, exclude=key)
+            latencies.append(time.perf_counter()-start)
+            same += [m[:2] for m in matches] == [m[:2] for m in flat.search(query, top_k, exclude=key)]
+        result['latency'] = percentiles(latencies)
+        result['threshold_results_identical'] = same/len(rows)
+        result['peak_rss_mb'] = peak_rss_mb()
+        return result
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def bench_store(size:int, fmt:str, seed:int) -> dict:
+    '''
+    Save/load time and peak RSS of a face data file. Loading runs in a fresh
+    process so its peak RSS is not inflated by generating the library
+    '''
+    import file_handler
+    tmp_dir = tempfile.mkdtemp(prefix='face-search-bench-')
+    try:
+        path = os.path.join(tmp_dir, f'faces.{fmt}')
+        handler = file_handler.FileHandler(path)
+        handler.face_data_dict = synthetic_face_data(size, seed)
+        start = time.perf_counter()
+        handler.save_face_data(silent=True)
+        result = {'save_s': time.perf_counter()-start, 'save_peak_rss_mb': peak_rss_mb()}
+        result.update(run_isolated(bench_load, path))
+        if os.path.isdir(path):
+            result['size_mb'] = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))/2**20
+        else:
+            result['size_mb'] = os.path.getsize(path)/2**20
+        return result
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def bench_load(path:str) -> dict:
+    '''
+    Load time and peak RSS of a face data file
+    '''
+    import file_handler
+    start = time.perf_counter()
+    handler = file_handler.FileHandler(path)
+    return {'load_s': time.perf_counter()-start, 'load_peak_rss_mb': peak_rss_mb(),
+        'n_images': len(handler.face_data_dict)}
+
+def bench_extraction(n_images:int, detector_type:str) -> dict:
+    '''
+    Images/sec of Model.get_face_data on copies of the bundled example image
+    and synthetic noise images (no faces, measures the detector floor)
+    '''
+    import cv2
+    import model
+    tmp_dir = tempfile.mkdtemp(prefix='face-search-bench-')
+    try:
+        example = cv2.imread(os.path.join(SRC_DIR, '..', 'assets', 'example.png'))
+        rng = np.random.default_rng(0)
+        files = list()
+        for i in range(n_images):
+            image = example if (example is not None and i % 2 == 0) else \
+                rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+            files.append(os.path.join(tmp_dir, f'{i:05d}.png'))
+            cv2.imwrite(files[-1], image)
+        m = model.Model(detector_type)
+        start = time.perf_counter()
+        m.load_models()
+        result = {'model_load_s': time.perf_counter()-start}
+        start = time.perf_counter()
+        for file in files:
+            m.get_face_data(file)
+        elapsed = time.perf_counter()-start
+        result.update({'n_images': n_images, 'images_per_s': n_images/elapsed, 'peak_rss_mb': peak_rss_mb()})
+        start = time.perf_counter()
+        m.get_face_data_batch(files)
+        result['batched_images_per_s'] = n_images/(time.perf_counter()-start)
+        return result
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _isolated(queue, func, args) -> None:
+    try:
+        queue.put(func(*args))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+def run_isolated(func, *args, timeout:float=None, poll_seconds:float=1.0) -> dict:
+    '''
+    Runs a benchmark in a fresh process so peak RSS is measured per benchmark.
+    Returns {'error': ...} instead of waiting forever if the process dies without
+    a result (e.g. OOM-killed) or runs longer than timeout seconds
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_isolated, args=(queue, func, args))
+    process.start()
+    start = time.monotonic()
+    while True:
+        try:
+            result = queue.get(timeout=poll_seconds)
+            break
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            try: # the result may have been queued right before the process exited
+                result = queue.get(timeout=poll_seconds)
+            except queue_module.Empty:
+                result = {'error': f'{func.__name__} exited with code {process.exitcode} without a result'}
+            break
+        if timeout is not None and time.monotonic()-start > timeout:
+            process.terminate()
+            result = {'error': f'{func.__name__} timed out after {timeout} s'}
+            break
+    process.join()
+    if 'error' in result:
+        print(f'!!! {result["error"]}')
+    return result
+
+def environment() -> dict:
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(),
+        'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='synthetic library sizes (images)')
+    parser.add_argument('--queries', type=int, default=200, help='queries per search benchmark')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--formats', nargs='+', default=['fstore', 'pbz2'], help='face data formats to benchmark')
+    parser.add_argument('--quant-modes', nargs='+', default=['float16', 'int8', 'pq'],
+        help='quantized search modes to benchmark')
+    parser.add_argument('--extraction-images', type=int, default=20, help='0 skips the extraction benchmark')
+    parser.add_argument('--detector-type', default='svm')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=None,
+        help='seconds before a benchmark process is stopped and reported as failed')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'config': vars(args), 'search': dict(), 'store': dict(),
+        'quantization': dict()}
+    for size in args.sizes:
+        print(f'+++ search: {size} images')
+        results['search'][str(size)] = run_isolated(bench_search, size, args.queries, args.top_k, args.seed,
+            timeout=args.timeout)
+        for fmt in args.formats:
+            print(f'+++ store: {size} images, {fmt}')
+            results['store'][f'{fmt}_{size}'] = run_isolated(bench_store, size, fmt, args.seed, timeout=args.timeout)
+        for mode in args.quant_modes:
+            print(f'+++ quantization: {size} images, {mode}')
+            results['quantization'][f'{mode}_{size}'] = run_isolated(bench_quantization, size, args.queries,
+                args.top_k, mode, args.seed, timeout=args.timeout)
+    if args.extraction_images > 0:
+        print(f'+++ extraction: {args.extraction_images} images')
+        results['extraction'] = run_isolated(bench_extraction, args.extraction_images, args.detector_type,
+            timeout=args.timeout)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'+++ Saved: {args.output}')
@@ -0,0 +1,303 @@
+import os
+import json
+import numpy as np
+import search
+
+class IVFIndex:
+    '''
+    Approximate nearest neighbour index (inverted file with k-means coarse
+    quantization). Every face encoding is assigned to its nearest of nlist
+    centroids and a query only scores the faces in its nprobe nearest lists.
+    Raising nprobe trades speed for recall. Exposes the same search interface
+    as search.EmbeddingIndex. Added faces are assigned to their lists in one go
+    on the next search or save, and removed faces are skipped until enough of
+    them accumulate to compact the index
+    '''
+    def __init__(self, nlist:int=1024, nprobe:int=16, dim:int=128) -> None:
+        '''
+        :param nlist: number of k-means centroids (inverted lists)
+        :param nprobe: number of lists scored per query
+        :param dim: length of a face encoding
+        '''
+        if not self._type_check('nlist', nlist, int) or \
+            not self._type_check('nprobe', nprobe, int) or \
+            not self._type_check('dim', dim, int):
+            raise TypeError
+        if nlist < 1 or nprobe < 1:
+            print(f'nlist and nprobe must be >= 1')
+            raise ValueError
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.flat = search.EmbeddingIndex(dim)
+        self.centroids = None
+        self._row_lists = np.empty(0, dtype=np.int32) # list id of every row of self.flat assigned so far
+        self._order = None # rows sorted by list id, rebuilt lazily after inserts
+        self._list_offsets = None
+
+    @classmethod
+    def build(cls, flat:search.EmbeddingIndex, nlist:int=None, nprobe:int=16, n_iter:int=20,
+        seed:int=0) -> 'IVFIndex':
+        '''
+        Trains an index on the encodings of an exact index and adds them all
+        :param flat: exact index holding the encodings
+        :param nlist: number of centroids. Defaults to ~4*sqrt(n_faces)
+        :param nprobe: number of lists scored per query
+        :param n_iter: k-means iterations
+        :param seed: random seed
+        '''
+        if nlist is None:
+            nlist = max(1, int(4*np.sqrt(len(flat))))
+        index = cls(nlist, nprobe, flat.dim)
+        index.flat = flat
+        index.train(flat.matrix, n_iter, seed)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.flat)
+
+    def __contains__(self, key) -> bool:
+        return key in self.flat
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, vectors:np.ndarray, n_iter:int=20, seed:int=0, max_points_per_list:int=256) -> None:
+        '''
+        Runs k-means on (a sample of) the vectors and (re)assigns every indexed row
+        :param vectors: (n, dim) training vectors
+        :param n_iter: k-means iterations
+        :param seed: random seed
+        :param max_points_per_list: training sample size per centroid
+        '''
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        if n == 0:
+            print(f'!!! Cannot train an IVFIndex without vectors')
+            raise ValueError
+        self.nlist = min(self.nlist, n)
+        sample_size = min(n, self.nlist*max_points_per_list)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, self.nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = self._assign(sample, centroids)
+            counts = np.bincount(labels, minlength=self.nlist)
+            sums = np.stack([np.bincount(labels, weights=sample[:, j], minlength=self.nlist)
+                for j in range(sample.shape[1])], axis=1)
+            filled = counts > 0
+            centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+            empty = np.flatnonzero(~filled)
+            if len(empty) > 0: # restart empty lists on random points
+                centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        self.centroids = centroids
+        self._row_lists = np.empty(0, dtype=np.int32)
+        self._flush()
+
+    def _assign(self, vectors:np.ndarray, centroids:np.ndarray, block_size:int=65536) -> np.ndarray:
+        '''
+        Private method returning the nearest centroid of each vector, in memory-bounded blocks
+        :param vectors: (n, dim) vectors
+        :param centroids: (nlist, dim) centroids
+        :param block_size: vectors per block
+        '''
+        centroid_norms = (centroids*centroids).sum(axis=1)
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[start:start+block_size], dtype=np.float32)
+            labels[start:start+block_size] = np.argmin(centroid_norms - 2*(block @ centroids.T), axis=1)
+        return labels
+
+    def _build_lists(self) -> None:
+        '''
+        Private method to group rows by list id
+        '''
+        self._order = np.argsort(self._row_lists, kind='stable').astype(np.int64)
+        counts = np.bincount(self._row_lists, minlength=self.nlist)
+        self._list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def _flush(self) -> None:
+        '''
+        Private method assigning the rows added since the last flush to their lists
+        in one matrix product, and compacting once many rows were removed
+        '''
+        assigned = len(self._row_lists)
+        if assigned < len(self.flat):
+            added = self.flat.matrix[assigned:]
+            labels = self._assign(added, self.centroids) if self.is_trained else np.zeros(len(added), dtype=np.int32)
+            self._row_lists = np.concatenate((self._row_lists, labels))
+            self._order = None
+        if self.flat.should_compact():
+            self._row_lists = self._row_lists[self.flat.compact()]
+            self._order = None
+
+    def add(self, key:str, encodings) -> None:
+        '''
+        Adds (or replaces) the encodings of an image. They are assigned to
+        their lists on the next search or save
+        :param key: image key
+        :param encodings: list of encodings or a (n_faces, dim) array
+        '''
+        self.flat.add(key, encodings)
+
+    def remove(self, key:str) -> bool:
+        '''
+        Removes the encodings of an image. Returns False if the key was not indexed
+        :param key: image key
+        '''
+        return self.flat.remove(key)
+
+    def candidates(self, query_encoding, nprobe:int=None) -> np.ndarray:
+        '''
+        Returns the rows in the nprobe lists nearest to the query
+        :param query_encoding: a single face encoding
+        :param nprobe: overrides self.nprobe for this query
+        '''
+        if not self.is_trained:
+            return self.flat.live_rows()
+        self._flush()
+        if self._order is None:
+            self._build_lists()
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        query = np.asarray(query_encoding, dtype=np.float32).reshape(-1)
+        dists = (self.centroids*self.centroids).sum(axis=1) - 2*(self.centroids @ query)
+        probes = np.argpartition(dists, nprobe-1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        rows = np.concatenate([self._order[self._list_offsets[p]:self._list_offsets[p+1]] for p in probes])
+        return self.flat.live_rows(rows)
+
+    def candidate_keys(self, query_encoding, nprobe:int=None) -> list:
+        '''
+        Returns the image keys with at least one face in the nprobe lists nearest to the query
+        :param query_encoding: a single face encoding
+        :param nprobe: overrides self.nprobe for this query
+        '''
+        key_ids = np.unique(self.flat._row_key_ids[self.candidates(query_encoding, nprobe)])
+        return [self.flat.keys[i] for i in key_ids]
+
+    def search(self, query_encoding, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:str=None, nprobe:int=None) -> list:
+        '''
+        Returns the approximate top_k matches ranked by sim_score, see search.EmbeddingIndex.search
+        :param query_encoding: a single face encoding
+        :param top_k: number of matches to return. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out (usually the query itself)
+        :param nprobe: overrides self.nprobe for this query
+        '''
+        if len(self.flat) == 0:
+            return list()
+        rows = self.candidates(query_encoding, nprobe)
+        if exclude is not None and exclude in self.flat:
+            excluded = self.flat.rows_for(exclude)
+            rows = rows[(rows < excluded.start) | (rows >= excluded.stop)]
+        euclid, cos = self.flat.score(query_encoding, rows)
+        mask = (euclid <= euclidean_thres) | (cos >= cosine_thres)
+        return self.flat.rank_rows(rows[mask], euclid[mask], cos[mask], top_k)
+
+    def search_batch(self, query_encodings, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:list=None, nprobe:int=None) -> list:
+        '''
+        Returns a list with the approximate matches of each query, see search
+        :param query_encodings: list of encodings or a (n_queries, dim) array
+        :param top_k: number of matches to return per query. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out per query (None entries allowed)
+        :param nprobe: overrides self.nprobe for these queries
+        '''
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, self.flat.dim)
+        if exclude is None:
+            exclude = [None]*len(queries)
+        return [self.search(q, top_k, euclidean_thres, cosine_thres, key, nprobe) for q, key in zip(queries, exclude)]
+
+    def recall(self, sample_size:int=100, top_k:int=10, nprobe:int=None, seed:int=0) -> float:
+        '''
+        Returns the fraction of the exact top_k nearest faces that the index also
+        returns, averaged over a random sample of indexed faces used as queries
+        :param sample_size: number of query faces
+        :param top_k: neighbours compared per query
+        :param nprobe: overrides self.nprobe for this measurement
+        :param seed: random seed
+        '''
+        live = self.flat.live_rows()
+        if len(live) == 0:
+            return 1.0
+        rng = np.random.default_rng(seed)
+        found = expected = 0
+        for row in rng.choice(live, min(sample_size, len(live)), replace=False):
+            query = np.array(self.flat.matrix[row])
+            key, _ = self.flat.row_info(row)
+            exact = self.flat.search(query, top_k, np.inf, -np.inf, exclude=key)
+            approx = self.search(query, top_k, np.inf, -np.inf, exclude=key, nprobe=nprobe)
+            exact_ids = {(m.key, m.face_num) for m in exact}
+            found += len(exact_ids & {(m.key, m.face_num) for m in approx})
+            expected += len(exact_ids)
+        return found/expected if expected > 0 else 1.0
+
+    def save(self, path:str) -> None:
+        '''
+        Saves the centroids and the list of every face, e.g. next to the face store as
+        <face data path>.ivf.npz. The encodings are not saved: load attaches the lists
+        to an index over the face store
+        :param path: output .npz path
+        '''
+        self._flush()
+        if self.flat.n_removed > 0:
+            self._row_lists = self._row_lists[self.flat.compact()]
+            self._order = None
+        keys, counts = self.flat.key_counts() # rows of the flat index are stored in key order once compacted
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, counts=counts, row_lists=self._row_lists,
+            centroids=self.centroids if self.is_trained else np.empty((0, self.flat.dim), dtype=np.float32),
+            config=np.array(json.dumps({'nlist': self.nlist, 'nprobe': self.nprobe, 'keys': keys})))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path:str, flat:'search.EmbeddingIndex') -> 'IVFIndex':
+        '''
+        Loads the lists saved by save on top of an exact index over the face data.
+        Faces of flat that were not saved (or changed since) are assigned again
+        :param path: .npz path written by save
+        :param flat: exact index over the face data, e.g. mapping the face store
+        '''
+        with np.load(path) as file:
+            config = json.loads(str(file['config']))
+            index = cls(config['nlist'], config['nprobe'], flat.dim)
+            index.flat = flat
+            index.centroids = file['centroids'] if len(file['centroids']) > 0 else None
+            saved_lists, saved_counts = file['row_lists'], file['counts']
+        if index.centroids is None:
+            return index
+        keys, counts = flat.key_counts()
+        if flat.n_removed == 0 and keys == config['keys'] and np.array_equal(counts, saved_counts):
+            index._row_lists = saved_lists.astype(np.int32)
+            return index
+        saved_starts = np.cumsum(saved_counts) - saved_counts
+        saved = {key: (int(start), int(count)) for key, start, count in zip(config['keys'], saved_starts, saved_counts)}
+        row_lists = np.full(len(flat), -1, dtype=np.int32)
+        for key in keys:
+            rows = flat.rows_for(key)
+            saved_rows = saved.get(key)
+            if saved_rows is not None and saved_rows[1] == rows.stop-rows.start:
+                row_lists[rows] = saved_lists[saved_rows[0]:saved_rows[0]+saved_rows[1]]
+        missing = np.flatnonzero(row_lists < 0)
+        if len(missing) > 0:
+            row_lists[missing] = index._assign(flat.matrix[missing], index.centroids)
+        index._row_lists = row_lists
+        return index
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
@@ -0,0 +1,318 @@
+import os
+import json
+import numpy as np
+import search
+
+class IdentityClusters:
+    '''
+    Groups every face of a library into identities. The thresholded similarity
+    graph is computed in block_size x block_size tiles and each tile's edges are
+    consumed right away: merged into a union-find for connected components, or
+    reduced to the max_neighbours strongest edges of every face for Chinese
+    Whispers, so memory stays bounded however large the clusters are. Faces added
+    later are assigned to existing clusters without reclustering. Labels of added
+    faces go into a buffer that grows by doubling, so assigning one image does not
+    copy every label
+    '''
+    def __init__(self, flat:search.EmbeddingIndex, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> None:
+        '''
+        :param flat: exact index holding the encodings to cluster
+        :param euclidean_thres: max euclidean distance of two faces of the same identity
+        :param cosine_thres: min cosine similarity of two faces of the same identity
+        '''
+        if not self._type_check('flat', flat, search.EmbeddingIndex) or \
+            not self._type_check('euclidean_thres', euclidean_thres, float) or \
+            not self._type_check('cosine_thres', cosine_thres, float):
+            raise TypeError
+        self.flat = flat
+        self.euclidean_thres = euclidean_thres
+        self.cosine_thres = cosine_thres
+        self._labels = np.full(len(flat), -1, dtype=np.int64) # cluster label of every row of flat, plus spare capacity
+        self._next_label = 0
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels[:len(self.flat)]
+
+    @labels.setter
+    def labels(self, labels:np.ndarray) -> None:
+        self._labels = np.asarray(labels, dtype=np.int64)
+
+    def tiles(self, block_size:int=4096):
+        '''
+        Yields the edges (src rows, dst rows, weights) between similar faces one tile
+        at a time, src < dst. Weights are cosine similarities
+        :param block_size: rows per tile. Peak memory is ~block_size^2 floats
+        '''
+        matrix, norms = self.flat.matrix, self.flat.norms
+        n = len(matrix)
+        for a in range(0, n, block_size):
+            block_a = np.asarray(matrix[a:a+block_size], dtype=np.float32)
+            norms_a = norms[a:a+block_size]
+            for b in range(a, n, block_size):
+                dots = block_a @ np.asarray(matrix[b:b+block_size], dtype=np.float32).T
+                norms_b = norms[b:b+block_size]
+                euclid = np.sqrt(np.maximum(norms_a[:, None]**2 + norms_b[None, :]**2 - 2*dots, 0))
+                cos = dots / np.maximum(norms_a[:, None]*norms_b[None, :], np.finfo(np.float32).tiny)
+                mask = (euclid <= self.euclidean_thres) | (cos >= self.cosine_thres)
+                if a == b:
+                    mask = np.triu(mask, k=1)
+                i, j = np.nonzero(mask)
+                yield (i + a).astype(np.int64), (j + b).astype(np.int64), cos[i, j]
+
+    def similarity_graph(self, block_size:int=4096) -> tuple:
+        '''
+        Returns every edge (src rows, dst rows, weights) between similar faces, src < dst.
+        Holds all edges at once, which grows with the square of the cluster sizes; fit
+        consumes tiles instead
+        :param block_size: rows per tile. Peak memory is ~block_size^2 floats
+        '''
+        srcs, dsts, weights = list(), list(), list()
+        for src, dst, weight in self.tiles(block_size):
+            srcs.append(src)
+            dsts.append(dst)
+            weights.append(weight)
+        if len(srcs) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(srcs), np.concatenate(dsts), np.concatenate(weights)
+
+    def fit(self, method:str='components', block_size:int=4096, iterations:int=20, seed:int=0,
+        max_neighbours:int=32) -> np.ndarray:
+        '''
+        Clusters every indexed face. Returns the label of every row
+        :param method: "components" (connected components) or "chinese_whispers"
+        :param block_size: rows per tile of the similarity graph
+        :param iterations: Chinese Whispers iterations
+        :param seed: Chinese Whispers random seed
+        :param max_neighbours: Chinese Whispers keeps only this many strongest edges per face
+        '''
+        if not self._type_check('method', method, str):
+            raise TypeError
+        if method not in ('components', 'chinese_whispers'):
+            print(f'method must be either "components" or "chinese_whispers". Got: {method}')
+            raise ValueError
+        if max_neighbours < 1:
+            print(f'max_neighbours must be >= 1. Got: {max_neighbours}')
+            raise ValueError
+        self.flat.compact()
+        n = len(self.flat)
+        if method == 'components':
+            labels = self._connected_components(n, block_size)
+        else:
+            labels = self._chinese_whispers(n, block_size, iterations, seed, max_neighbours)
+        _, self.labels = np.unique(labels, return_inverse=True) # relabel 0..n_clusters-1
+        self.labels = self.labels.astype(np.int64)
+        self._next_label = int(self.labels.max())+1 if n > 0 else 0
+        return self.labels
+
+    def _connected_components(self, n:int, block_size:int) -> np.ndarray:
+        '''
+        Private method. Merges the edges of every tile into a union-find (roots link to
+        the smaller root) and drops them, then flattens it with pointer jumping
+        '''
+        parent = np.arange(n, dtype=np.int64)
+        for src, dst, _ in self.tiles(block_size):
+            while len(src) > 0:
+                root_src, root_dst = self._roots(parent, src), self._roots(parent, dst)
+                differ = root_src != root_dst
+                src, dst, root_src, root_dst = src[differ], dst[differ], root_src[differ], root_dst[differ]
+                np.minimum.at(parent, np.maximum(root_src, root_dst), np.minimum(root_src, root_dst))
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent
+            parent = grand_parent
+
+    def _roots(self, parent:np.ndarray, nodes:np.ndarray) -> np.ndarray:
+        '''
+        Private method returning the union-find root of every node, pointing the nodes at them
+        '''
+        roots = parent[nodes]
+        while True:
+            next_roots = parent[roots]
+            if np.array_equal(next_roots, roots):
+                parent[nodes] = roots
+                return roots
+            roots = next_roots
+
+    def _neighbours(self, n:int, block_size:int, max_neighbours:int) -> tuple:
+        '''
+        Private method returning the (n, max_neighbours) rows and weights of the strongest
+        edges of every face (-1 and 0 where it has fewer), reduced tile by tile
+        '''
+        neighbours = np.full((n, max_neighbours), -1, dtype=np.int64)
+        weights = np.full((n, max_neighbours), -np.inf, dtype=np.float32)
+        for src, dst, weight in self.tiles(block_size):
+            # both directions of every edge, grouped by node
+            nodes, others, edge_weights = np.concatenate((src, dst)), np.concatenate((dst, src)), \
+                np.concatenate((weight, weight)).astype(np.float32)
+            order = np.lexsort((-edge_weights, nodes))
+            nodes, others, edge_weights = nodes[order], others[order], edge_weights[order]
+            starts = np.searchsorted(nodes, nodes, side='left')
+            rank = np.arange(len(nodes)) - starts # 0 for the strongest edge of each node
+            keep = rank < max_neighbours
+            nodes, others, edge_weights, rank = nodes[keep], others[keep], edge_weights[keep], rank[keep]
+            touched = np.unique(nodes)
+            tile_neighbours = np.full((len(touched), max_neighbours), -1, dtype=np.int64)
+            tile_weights = np.full((len(touched), max_neighbours), -np.inf, dtype=np.float32)
+            slot = np.searchsorted(touched, nodes)
+            tile_neighbours[slot, rank], tile_weights[slot, rank] = others, edge_weights
+            merged_neighbours = np.concatenate((neighbours[touched], tile_neighbours), axis=1)
+            merged_weights = np.concatenate((weights[touched], tile_weights), axis=1)
+            best = np.argpartition(-merged_weights, max_neighbours-1, axis=1)[:, :max_neighbours]
+            neighbours[touched] = np.take_along_axis(merged_neighbours, best, axis=1)
+            weights[touched] = np.take_along_axis(merged_weights, best, axis=1)
+        weights[neighbours < 0] = 0
+        return neighbours, weights
+
+    def _chinese_whispers(self, n:int, block_size:int, iterations:int, seed:int, max_neighbours:int,
+        n_batches:int=8) -> np.ndarray:
+        '''
+        Private method. Every node repeatedly adopts the label with the highest total
+        edge weight among its strongest neighbours. Nodes are updated in n_batches
+        random batches per iteration, each voting at once with bincount
+        '''
+        neighbours, weights = self._neighbours(n, block_size, max_neighbours)
+        labels = np.arange(n, dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        for _ in range(iterations):
+            changed = False
+            for batch in np.array_split(rng.permutation(n), n_batches):
+                batch_neighbours = neighbours[batch]
+                valid = batch_neighbours >= 0
+                voters = np.nonzero(valid)[0] # index of the voting node within batch
+                if len(voters) == 0:
+                    continue
+                votes = labels[batch_neighbours[valid]]
+                pairs, inverse = np.unique(np.stack((voters, votes), axis=1), axis=0, return_inverse=True)
+                totals = np.bincount(inverse.reshape(-1), weights=weights[batch][valid], minlength=len(pairs))
+                order = np.lexsort((-totals, pairs[:, 0])) # strongest label first for every node
+                first = order[np.concatenate(([True], pairs[order[1:], 0] != pairs[order[:-1], 0]))]
+                nodes, best = batch[pairs[first, 0]], pairs[first, 1]
+                moved = labels[nodes] != best
+                if moved.any():
+                    labels[nodes[moved]] = best[moved]
+                    changed = True
+            if not changed:
+                break
+        return labels
+
+    def assign(self, key:str, encodings, k:int=10) -> list:
+        '''
+        Adds the faces of a new image and assigns each to the cluster most common
+        among its k nearest similar faces, or to a new cluster if it has none.
+        Returns the labels of the added faces
+        :param key: image key
+        :param encodings: list of encodings or a (n_faces, dim) array
+        :param k: neighbours voting per face
+        '''
+        self.remove(key)
+        assigned = [self._vote(encoding, k) for encoding in (encodings if encodings is not None else list())]
+        self.flat.add(key, encodings)
+        if len(assigned) > 0:
+            stop = len(self.flat)
+            if stop > len(self._labels):
+                labels = np.full(max(stop, 2*len(self._labels), 1024), -1, dtype=np.int64)
+                labels[:stop-len(assigned)] = self._labels[:stop-len(assigned)]
+                self._labels = labels
+            self._labels[stop-len(assigned):stop] = assigned
+        return assigned
+
+    def _vote(self, encoding, k:int) -> int:
+        '''
+        Private method returning the label most common among the k nearest similar
+        labelled faces of an encoding, or a new label if it has none
+        '''
+        votes = dict()
+        for match in self.flat.search(encoding, k, self.euclidean_thres, self.cosine_thres):
+            label = self._labels[self.flat.rows_for(match.key).start + match.face_num]
+            if label >= 0:
+                votes[label] = votes.get(label, 0.0) + match.cos_sim
+        if len(votes) > 0:
+            return int(max(votes, key=votes.get))
+        self._next_label += 1
+        return self._next_label-1
+
+    def remove(self, key:str) -> bool:
+        '''
+        Removes the faces of an image. Returns False if the key was not clustered
+        :param key: image key
+        '''
+        if not self.flat.remove(key):
+            return False
+        if self.flat.should_compact():
+            self.labels = self.labels[self.flat.compact()]
+        return True
+
+    def clusters(self, min_size:int=1) -> list:
+        '''
+        Returns the clusters, largest first, as lists of (image key, face index)
+        :param min_size: leave out clusters with fewer faces
+        '''
+        groups = dict()
+        for row in self.flat.live_rows():
+            groups.setdefault(int(self.labels[row]), list()).append(self.flat.row_info(row))
+        return sorted((g for g in groups.values() if len(g) >= min_size), key=len, reverse=True)
+
+    def save(self, path:str) -> None:
+        '''
+        Saves the label of every face, e.g. next to the face store as
+        <face data path>.clusters.npz. The encodings are not saved: load attaches
+        the labels to an index over the face store
+        :param path: output .npz path
+        '''
+        if self.flat.n_removed > 0:
+            self.labels = self.labels[self.flat.compact()]
+        keys, counts = self.flat.key_counts()
+        config = {'euclidean_thres': self.euclidean_thres, 'cosine_thres': self.cosine_thres, 'keys': keys}
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, counts=counts, labels=self.labels, config=np.array(json.dumps(config)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path:str, flat:search.EmbeddingIndex, k:int=10) -> 'IdentityClusters':
+        '''
+        Loads the labels saved by save on top of an exact index over the face data.
+        Faces of flat that were not saved (or changed since) are assigned again
+        :param path: .npz path written by save
+        :param flat: exact index over the face data, e.g. mapping the face store
+        :param k: neighbours voting per reassigned face, see assign
+        '''
+        with np.load(path) as file:
+            config = json.loads(str(file['config']))
+            saved_labels, saved_counts = file['labels'], file['counts']
+        clusters = cls(flat, config['euclidean_thres'], config['cosine_thres'])
+        clusters._next_label = int(saved_labels.max())+1 if len(saved_labels) > 0 else 0
+        keys, counts = flat.key_counts()
+        if flat.n_removed == 0 and keys == config['keys'] and np.array_equal(counts, saved_counts):
+            clusters.labels = saved_labels
+            return clusters
+        saved_starts = np.cumsum(saved_counts) - saved_counts
+        saved = {key: (int(start), int(count)) for key, start, count in zip(config['keys'], saved_starts, saved_counts)}
+        labels = np.full(len(flat), -1, dtype=np.int64)
+        for key in keys:
+            rows = flat.rows_for(key)
+            saved_rows = saved.get(key)
+            if saved_rows is not None and saved_rows[1] == rows.stop-rows.start:
+                labels[rows] = saved_labels[saved_rows[0]:saved_rows[0]+saved_rows[1]]
+        clusters.labels = labels
+        for row in np.flatnonzero(labels < 0):
+            if flat.row_info(row)[0] is not None:
+                clusters._labels[row] = clusters._vote(flat.matrix[row], k)
+        return clusters
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
@@ -0,0 +1,259 @@
+import os
+import collections.abc
+import json
+import concurrent.futures
+import numpy as np
+import cv2
+from model import FaceData
+
+def dhash(gray:np.ndarray) -> int:
+    '''
+    Returns the 64 bit difference hash of a grayscale image: whether each pixel of
+    an 8x9 thumbnail is brighter than its right neighbour
+    :param gray: grayscale image
+    '''
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int(np.packbits(small[:, 1:] > small[:, :-1]).view('>u8')[0])
+
+def image_hash(path:str) -> tuple:
+    '''
+    Returns (dhash, (height, width)) of an image, or None if it cannot be read.
+    Jpegs are decoded at a quarter of their size, which is enough for the hash
+    and much cheaper than a full decode. The shape is that of the reduced image
+    :param path: image path
+    '''
+    gray = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        return None
+    return dhash(gray), gray.shape[:2]
+
+class HashIndex:
+    '''
+    Perceptual hashes of the library indexed for Hamming distance lookup. Hashes
+    are split into max_distance+1 bands, so by the pigeonhole principle any hash
+    within max_distance bits shares at least one band exactly with the query
+    '''
+    def __init__(self, max_distance:int=4) -> None:
+        '''
+        :param max_distance: max Hamming distance (in bits, of 64) of near-duplicates
+        '''
+        if not self._type_check('max_distance', max_distance, int):
+            raise TypeError
+        if max_distance < 0 or max_distance > 15:
+            print(f'max_distance must be in [0, 15]. Got: {max_distance}')
+            raise ValueError
+        self.max_distance = max_distance
+        n_bands = max_distance+1
+        bounds = [64*i//n_bands for i in range(n_bands+1)]
+        self._bands = [(lo, (1 << (hi-lo))-1) for lo, hi in zip(bounds[:-1], bounds[1:])] # (shift, mask)
+        self._buckets = [dict() for _ in self._bands]
+        self.hashes = dict() # image key -> (hash, (height, width))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, key:str) -> bool:
+        return key in self.hashes
+
+    def add(self, key:str, hash:int, shape:tuple) -> None:
+        '''
+        :param key: image key
+        :param hash: 64 bit perceptual hash
+        :param shape: (height, width) the hash was computed at
+        '''
+        self.remove(key)
+        self.hashes[key] = (hash, tuple(shape))
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            buckets.setdefault((hash >> shift) & mask, set()).add(key)
+
+    def remove(self, key:str) -> bool:
+        '''
+        Returns False if the key was not indexed
+        :param key: image key
+        '''
+        if key not in self.hashes:
+            return False
+        hash = self.hashes.pop(key)[0]
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            bucket = buckets[(hash >> shift) & mask]
+            bucket.discard(key)
+            if len(bucket) == 0:
+                del buckets[(hash >> shift) & mask]
+        return True
+
+    def query(self, hash:int, max_distance:int=None) -> list:
+        '''
+        Returns (image key, Hamming distance) of every indexed hash within max_distance, nearest first
+        :param hash: 64 bit perceptual hash
+        :param max_distance: defaults to (and cannot exceed) the max_distance of the index
+        '''
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            candidates.update(buckets.get((hash >> shift) & mask, ()))
+        matches = list()
+        for key in candidates:
+            distance = bin(self.hashes[key][0] ^ hash).count('1')
+            if distance <= max_distance:
+                matches.append((key, distance))
+        return sorted(matches, key=lambda m: (m[1], m[0]))
+
+    def save(self, path:str) -> None:
+        '''
+        Saves the hashes, e.g. next to the face store as <face data path>.phash.npz
+        :param path: output .npz path
+        '''
+        keys = list(self.hashes.keys())
+        hashes = np.array([self.hashes[k][0] for k in keys], dtype=np.uint64)
+        shapes = np.array([self.hashes[k][1] for k in keys], dtype=np.int32).reshape(-1, 2)
+        config = {'max_distance': self.max_distance, 'keys': keys}
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, hashes=hashes, shapes=shapes, config=np.array(json.dumps(config)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path:str, max_distance:int=None) -> 'HashIndex':
+        '''
+        :param path: .npz path written by save
+        :param max_distance: overrides the saved max_distance
+        '''
+        with np.load(path) as file:
+            config = json.loads(str(file['config']))
+            index = cls(config['max_distance'] if max_distance is None else max_distance)
+            for key, hash, shape in zip(config['keys'], file['hashes'].tolist(), file['shapes'].tolist()):
+                index.add(key, hash, shape)
+        return index
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
+
+def rescale_face_data(face_data:FaceData, from_shape:tuple, to_shape:tuple) -> FaceData:
+    '''
+    Returns a copy of face data extracted from one image for a resized copy of it.
+    Encodings are reused as they are, face rectangles are rescaled
+    :param face_data: face data of the original image
+    :param from_shape: (height, width) of the original image
+    :param to_shape: (height, width) of the copy
+    '''
+    rects = face_data.boxes
+    if tuple(from_shape) != tuple(to_shape):
+        scale_y, scale_x = to_shape[0]/from_shape[0], to_shape[1]/from_shape[1]
+        rects = np.rint(rects*np.array([scale_x, scale_y, scale_x, scale_y])).astype(np.int32)
+    return FaceData(face_data.encodings.copy(), rects)
+
+class Deduplicator:
+    '''
+    Dedup stage of batch extraction. Every file is hashed first (in parallel);
+    files that are near-duplicates of an image already in the library, or of
+    another file of the batch, reuse its face data instead of being encoded
+    '''
+    def __init__(self, index:HashIndex, face_data_dict:dict, threads:int=4, max_aspect_diff:float=0.02) -> None:
+        '''
+        :param index: hashes of the library. Updated in place
+        :param face_data_dict: dictionary of extracted face data of the library
+        :param threads: number of hashing threads
+        :param max_aspect_diff: max relative difference of the aspect ratios of duplicates,
+            so crops with a similar hash are still encoded
+        '''
+        if not self._type_check('index', index, HashIndex) or \
+            not self._type_check('face_data_dict', face_data_dict, collections.abc.Mapping):
+            raise TypeError
+        self.index = index
+        self.face_data_dict = face_data_dict
+        self.threads = threads
+        self.max_aspect_diff = max_aspect_diff
+        self.groups = dict() # original image key -> keys of its duplicates
+
+    def run(self, files:list, extract):
+        '''
+        Yields (file, FaceData) for every file, like the extraction iterators
+        :param files: list of image file paths
+        :param extract: callable taking a list of files and yielding (file, FaceData) for each
+        '''
+        for file in files: # their previous hashes (if any) are stale
+            self.index.remove(file)
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+            hashes = list(executor.map(image_hash, files))
+        to_extract, duplicates = list(), dict() # batch original -> [(duplicate, shape)]
+        for file, hashed in zip(files, hashes):
+            if hashed is None:
+                to_extract.append(file) # let extraction report the error
+                continue
+            original = self._find(*hashed, duplicates)
+            if original is None:
+                to_extract.append(file)
+                duplicates[file] = list()
+            elif original in duplicates: # original is extracted in this batch
+                duplicates[original].append((file, hashed[1]))
+            else:
+                yield file, self._reuse(original, file, hashed[1])
+            self.index.add(file, *hashed)
+        failed = list()
+        for file, face_data in extract(to_extract): # the caller stores face_data after the yield
+            yield file, face_data
+            for duplicate, shape in duplicates.pop(file, list()):
+                if face_data is None:
+                    failed.append(duplicate)
+                else:
+                    yield duplicate, self._reuse(file, duplicate, shape, face_data)
+        if len(failed) > 0:
+            yield from extract(failed)
+
+    def report(self) -> list:
+        '''
+        Returns the duplicate groups found so far as lists of image keys, original first
+        '''
+        return [[original] + dups for original, dups in self.groups.items()]
+
+    def _find(self, hash:int, shape:tuple, pending:dict) -> str:
+        '''
+        Private method returning the key of the nearest indexed near-duplicate with the same
+        aspect ratio that is pending extraction or has face data, or None
+        '''
+        aspect = shape[1]/shape[0]
+        for key, _ in self.index.query(hash):
+            other = self.index.hashes[key][1]
+            if abs(other[1]/other[0]-aspect) > self.max_aspect_diff*aspect:
+                continue
+            if key in pending or self.face_data_dict.get(key) is not None:
+                return key
+        return None
+
+    def _reuse(self, original:str, file:str, shape:tuple, face_data:FaceData=None) -> FaceData:
+        '''
+        Private method. Face data of original (from the library unless passed) rescaled
+        to a duplicate of shape
+        '''
+        self.groups.setdefault(original, list()).append(file)
+        if face_data is None:
+            face_data = self.face_data_dict[original]
+        return rescale_face_data(face_data, self.index.hashes[original][1], shape)
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
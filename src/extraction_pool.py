@@ -0,0 +1,180 @@
+import os
+import itertools
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import model
+import profiling
+
+_worker_model = None
+
+def _init_worker(detector_type:str, model_kwargs:dict) -> None:
+    '''
+    Loads one Model (detector, shape predictor and recognition model) per worker process
+    :param detector_type: "svm" or "cnn"
+    :param model_kwargs: other Model settings
+    '''
+    global _worker_model
+    model_kwargs = dict(model_kwargs)
+    profile = model_kwargs.pop('profile', False)
+    _worker_model = model.Model(detector_type, profiler=profiling.Profiler(enabled=profile), **model_kwargs)
+
+def _extract_chunk(args:tuple) -> tuple:
+    '''
+    Returns (results, profiler snapshot) of a chunk of files extracted in a worker
+    :param args: (list of files, upsample_times, dlib batch size or None)
+    '''
+    results = _extract_files(*args)
+    snapshot = _worker_model.profiler.snapshot() if _worker_model.profiler.enabled else None
+    _worker_model.profiler.reset()
+    return results, snapshot
+
+def _extract_files(files:list, upsample_times:int, batch_size:int) -> list:
+    '''
+    Extracts face data of a chunk of files in a worker. A file that fails
+    is returned with None (like Model.get_face_data) instead of killing the worker
+    :param files: image file paths
+    :param upsample_times: optionally upsample images prior to encoding
+    :param batch_size: dlib batch size or None
+    '''
+    if batch_size is not None:
+        try:
+            return list(zip(files, _worker_model.get_face_data_batch(files, upsample_times, batch_size)))
+        except Exception as e:
+            print(f'!!! Batched extraction failed, retrying files one by one\n', e)
+    results = list()
+    for file in files:
+        try:
+            face_data = _worker_model.get_face_data(file, upsample_times)
+        except Exception as e:
+            print(f'!!! Failed to extract {file}\n', e)
+            _worker_model.profiler.record_failure(file, e)
+            face_data = None
+        results.append((file, face_data))
+    return results
+
+class ExtractionPool:
+    '''
+    Process pool that extracts face data in parallel. Files are sent to the
+    workers in chunks and results are streamed back as each chunk finishes.
+    If a worker dies (e.g. a native crash on a corrupt image or an OOM kill) the
+    pool is restarted and the files of the lost chunks are retried one at a time,
+    so the file that kills its worker again is returned with None
+    '''
+    def __init__(self, detector_type:str="svm", workers:int=None, chunk_size:int=16, model_kwargs:dict=None,
+        profiler:profiling.Profiler=None) -> None:
+        '''
+        :param detector_type: "svm" or "cnn"
+        :param workers: number of worker processes. Defaults to the number of cores
+        :param chunk_size: number of files sent to a worker at a time
+        :param model_kwargs: other Model settings, e.g. max_detection_dim
+        :param profiler: optional profiling.Profiler the workers' stage timings and counters are merged into
+        '''
+        if not self._type_check('detector_type', detector_type, str) or \
+            not self._type_check('chunk_size', chunk_size, int) or \
+            (workers is not None and not self._type_check('workers', workers, int)):
+            raise TypeError
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1 or chunk_size < 1:
+            print(f'workers and chunk_size must be >= 1')
+            raise ValueError
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.profiler = profiler
+        self._initargs = (detector_type, dict(model_kwargs or dict(), profile=profiler is not None and profiler.enabled))
+        self._pool = self._start()
+
+    def _start(self) -> concurrent.futures.ProcessPoolExecutor:
+        '''
+        Private method starting the worker processes
+        '''
+        return concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=self._initargs)
+
+    def _restart(self) -> None:
+        '''
+        Private method replacing a pool broken by a dead worker
+        '''
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._pool = self._start()
+
+    def imap(self, files:list, upsample_times:int=0, batch_size:int=None):
+        '''
+        Yields (file, FaceData) in completion order
+        :param files: iterable of image file paths
+        :param upsample_times: optionally upsample images prior to encoding
+        :param batch_size: encode each chunk with Model.get_face_data_batch using this dlib batch size
+        '''
+        files = iter(files)
+        running = dict() # future -> files of its chunk
+        while True:
+            while len(running) < 2*self.workers: # bounded read-ahead keeps files streaming lazily
+                chunk = list(itertools.islice(files, self.chunk_size))
+                if len(chunk) == 0:
+                    break
+                running[self._pool.submit(_extract_chunk, (chunk, upsample_times, batch_size))] = chunk
+            if len(running) == 0:
+                return
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                done, _ = concurrent.futures.wait(running) # every chunk in flight is lost with the pool
+            lost = list()
+            for future in done:
+                chunk = running.pop(future)
+                if isinstance(future.exception(), BrokenProcessPool):
+                    lost.extend(chunk)
+                    continue
+                yield from self._results(*future.result())
+            if len(lost) > 0:
+                print(f'!!! A worker died, retrying {len(lost)} files one at a time')
+                self._restart()
+                for file in lost:
+                    yield from self._retry(file, upsample_times)
+
+    def _results(self, results:list, snapshot:dict) -> list:
+        '''
+        Private method merging a chunk's profiler snapshot and returning its results
+        '''
+        if snapshot is not None:
+            self.profiler.merge(snapshot)
+        return results
+
+    def _retry(self, file:str, upsample_times:int) -> list:
+        '''
+        Private method extracting a single file of a lost chunk. Returns [(file, None)]
+        if it kills its worker again
+        '''
+        try:
+            return self._results(*self._pool.submit(_extract_chunk, ([file], upsample_times, None)).result())
+        except BrokenProcessPool as e:
+            print(f'!!! Failed to extract {file}: the worker died')
+            if self.profiler is not None:
+                self.profiler.record_failure(file, e)
+            self._restart()
+            return [(file, None)]
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> 'ExtractionPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if exc[0] is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        self.close()
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
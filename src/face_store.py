@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import shutil
+import pickle
+import collections.abc
+import bz2file as bz2
+import numpy as np
+from model import FaceData
+
+STORE_SUFFIX = 'fstore'
+STORE_VERSION = 1
+
+class FaceStore:
+    '''
+    Columnar on-disk face data store. A store is a folder holding
+        encodings.npy  float32 (n_faces, 128) face encodings
+        norms.npy      float32 (n_faces,) norm of every encoding, so indexes over the
+                       store do not read the encodings to compute them
+        rects.npy      int32 (n_faces, 4) face rectangles as left, top, right, bottom
+        offsets.npy    int64 (n_images+1,) first row of each image in the arrays above
+        index.json     image keys (paths) and whether their extraction succeeded
+    The arrays are memory-mapped on load so opening a store is near-instant
+    and encodings are never copied until they are modified
+    '''
+    def __init__(self, store_path:str, mmap:bool=True) -> None:
+        '''
+        :param store_path: path to an existing store folder
+        :param mmap: memory-map the arrays instead of reading them into memory
+        '''
+        if not self._type_check('store_path', store_path, str) or \
+            not self._type_check('mmap', mmap, bool):
+            raise TypeError
+        store_path = store_path.rstrip('/')
+        recover(store_path)
+        if not os.path.isdir(store_path):
+            print(f'!!! {store_path} is not a face store')
+            raise FileNotFoundError
+        self.store_path = store_path
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(store_path, 'index.json'), 'r') as file:
+            index = json.load(file)
+        if index.get('version') != STORE_VERSION:
+            print(f'!!! Unsupported face store version: {index.get("version")}')
+            raise ValueError
+        self.keys = index['keys']
+        self.valid = index['valid']
+        self.encodings = np.load(os.path.join(store_path, 'encodings.npy'), mmap_mode=mmap_mode)
+        self.rects = np.load(os.path.join(store_path, 'rects.npy'), mmap_mode=mmap_mode)
+        norms_path = os.path.join(store_path, 'norms.npy') # not in stores written before it was added
+        self.norms = np.load(norms_path, mmap_mode=mmap_mode) if os.path.isfile(norms_path) else None
+        self.offsets = np.load(os.path.join(store_path, 'offsets.npy'))
+        self._key_ids = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self._key_ids
+
+    def get(self, key:str) -> FaceData:
+        '''
+        Returns the FaceData of an image, or None if its extraction failed
+        :param key: image key
+        '''
+        i = self._key_ids[key]
+        if not self.valid[i]:
+            return None
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return FaceData(self.encodings[start:stop], self.rects[start:stop])
+
+    def to_face_data_dict(self) -> dict:
+        '''
+        Returns a dictionary of image key -> FaceData whose encodings
+        are views into the memory-mapped encoding block. Creates every FaceData
+        at once; FaceDataView creates them on access instead
+        '''
+        return {key: self.get(key) for key in self.keys}
+
+    @staticmethod
+    def write(store_path:str, data:dict, dim:int=128) -> None:
+        '''
+        Writes a dictionary of FaceData as a store. The new store is written
+        next to the target and swapped in so a failed write never corrupts it
+        :param store_path: path to the store folder
+        :param data: dictionary of image key -> FaceData
+        :param dim: length of a face encoding
+        '''
+        keys, valid, counts = list(), list(), list()
+        encoding_blocks, rect_blocks = list(), list()
+        for key, face_data in data.items():
+            keys.append(key)
+            valid.append(face_data is not None)
+            if face_data is None or len(face_data.face_encodings) == 0:
+                counts.append(0)
+                continue
+            counts.append(len(face_data.face_encodings))
+            encoding_blocks.append(face_data.encodings)
+            rect_blocks.append(face_data.boxes)
+        encodings = np.concatenate(encoding_blocks) if encoding_blocks else np.empty((0, dim), dtype=np.float32)
+        norms = np.sqrt(np.einsum('ij,ij->i', encodings, encodings)).astype(np.float32)
+        rects = np.concatenate(rect_blocks) if rect_blocks else np.empty((0, 4), dtype=np.int32)
+        offsets = np.zeros(len(keys)+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        store_path = store_path.rstrip('/')
+        recover(store_path)
+        tmp_path, old_path = f'{store_path}.tmp', f'{store_path}.old'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, array in (('encodings', encodings), ('norms', norms), ('rects', rects), ('offsets', offsets)):
+            with open(os.path.join(tmp_path, f'{name}.npy'), 'wb') as file:
+                np.save(file, array)
+                file.flush()
+                os.fsync(file.fileno())
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as file:
+            json.dump({'version': STORE_VERSION, 'dim': dim, 'keys': keys, 'valid': valid}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        fsync_path(tmp_path) # the files are on disk before the store is swapped in
+        if os.path.isdir(store_path):
+            os.rename(store_path, old_path) # a crash from here on is undone by recover
+        os.rename(tmp_path, store_path)
+        fsync_path(os.path.dirname(os.path.abspath(store_path))) # the swap is on disk before callers drop the journal
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
+
+class FaceDataView(collections.abc.MutableMapping):
+    '''
+    Dictionary of image key -> FaceData backed by a FaceStore. Opening it is free:
+    the FaceData of a key (views into the memory-mapped arrays) is only created when
+    the key is read. Changes are kept in memory on top of the store until it is rewritten
+    '''
+    def __init__(self, store:FaceStore) -> None:
+        '''
+        :param store: the opened face store
+        '''
+        self.store = store
+        self._changed = dict() # keys set since the store was written
+        self._deleted = set() # keys of the store deleted since
+        self._added = 0 # number of changed keys that are not in the store
+
+    @property
+    def modified(self) -> bool:
+        '''
+        True if keys were set or deleted since the store was written
+        '''
+        return len(self._changed) > 0 or len(self._deleted) > 0
+
+    def rebase(self, store:FaceStore) -> None:
+        '''
+        Switches to a store holding every change, e.g. after writing this view to it
+        :param store: the newly written face store
+        '''
+        self.store = store
+        self._changed, self._deleted, self._added = dict(), set(), 0
+
+    def __getitem__(self, key:str) -> FaceData:
+        if key in self._changed:
+            return self._changed[key]
+        if key in self._deleted or key not in self.store:
+            raise KeyError(key)
+        return self.store.get(key)
+
+    def __setitem__(self, key:str, face_data:FaceData) -> None:
+        if key not in self._changed and key not in self.store:
+            self._added += 1
+        self._changed[key] = face_data
+        self._deleted.discard(key)
+
+    def __delitem__(self, key:str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        if key in self.store:
+            self._deleted.add(key)
+        elif key in self._changed:
+            self._added -= 1
+        self._changed.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._changed or (key not in self._deleted and key in self.store)
+
+    def __iter__(self):
+        for key in self.store.keys:
+            if key not in self._deleted:
+                yield key
+        for key in list(self._changed.keys()):
+            if key not in self.store:
+                yield key
+
+    def __len__(self) -> int:
+        return len(self.store) - len(self._deleted) + self._added
+
+def recover(store_path:str) -> bool:
+    '''
+    Restores the previous store if a write crashed after moving it aside (only
+    <store>.old is left, or the store folder is incomplete) and removes leftovers
+    of a write that crashed before or after the swap. Returns True if it restored
+    :param store_path: path to the store folder
+    '''
+    store_path = store_path.rstrip('/')
+    old_path = f'{store_path}.old'
+    if not os.path.isdir(old_path):
+        return False
+    if os.path.isfile(os.path.join(store_path, 'index.json')): # the swap completed
+        shutil.rmtree(old_path)
+        return False
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.rename(old_path, store_path)
+    print(f'+++ Recovered {store_path} from an interrupted write')
+    return True
+
+def fsync_path(path:str) -> None:
+    '''
+    Flushes a file, or the entries of a folder (e.g. after a rename), to disk
+    :param path: file or folder path
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError: # e.g. folders cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def is_store_path(path:str) -> bool:
+    '''
+    Returns True if the path names a face store rather than a legacy .pbz2 pickle
+    :param path: face data path
+    '''
+    return path.rstrip('/').split('.')[-1] == STORE_SUFFIX
+
+def convert_legacy(pkl_path:str, store_path:str, silent:bool=False) -> None:
+    '''
+    One-shot conversion of a legacy bz2-pickled face data dictionary to a store
+    :param pkl_path: path to the .pbz2 file
+    :param store_path: path to the store folder to create
+    :param silent: print success message if False
+    '''
+    with bz2.BZ2File(pkl_path, 'rb') as file:
+        data = pickle.load(file)
+    FaceStore.write(store_path, data)
+    if not silent:
+        print(f'+++ Converted: {pkl_path} -> {store_path}')
+        print(f'    Number of keys: {len(data)}')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python face_store.py path/to/dict.pbz2 path/to/store.fstore')
+        sys.exit(1)
+    convert_legacy(sys.argv[1], sys.argv[2])
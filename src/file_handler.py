@@ -2,6 +2,12 @@ import os
 import pickle
 import bz2file as bz2
 from pathlib import Path
+import face_store
+import manifest
+import journal
+import video_frames
+
+IMAGE_SUFFIXES = {'.jpeg', '.jpg', '.png', '.webp'}
 
 class FileHandler:
     '''
@@ -10,10 +16,22 @@ class FileHandler:
     def __init__(self, face_data_pkl:str) -> None:
         '''
         :param face_data_pkl: path to the compressed pickled dictionary 
-            that stores/should store extracted face data.
+            that stores/should store extracted face data. Paths ending in
+            .fstore use the memory-mapped columnar face store instead
         '''
+        self.face_store = None
+        self._manifest = None
         self._init_face_data_pkl(face_data_pkl)
 
+    @property
+    def manifest(self) -> manifest.Manifest:
+        '''
+        Manifest of encoded files stored next to the face data. Loaded on first use
+        '''
+        if self._manifest is None:
+            self._manifest = manifest.Manifest(f'{self.face_data_pkl}.manifest.json')
+        return self._manifest
+
     def _type_check(self, obj_name:str, obj, type)->bool:
         '''
         Private method to type check an object
@@ -41,7 +59,11 @@ class FileHandler:
         '''
         if not self._type_check('face_data_pkl', face_data_pkl, str):
             raise TypeError 
-        if os.path.isfile(face_data_pkl):
+        self.is_store = face_store.is_store_path(face_data_pkl)
+        if self.is_store:
+            face_data_pkl = face_data_pkl.rstrip('/')
+            face_store.recover(face_data_pkl)
+        if os.path.isfile(face_data_pkl) or (self.is_store and os.path.isdir(face_data_pkl)):
             self.face_data_pkl = face_data_pkl
             self.face_data_dict = self._load_face_data()
         else:
@@ -50,9 +72,9 @@ class FileHandler:
                 head = os.path.abspath('data')
             if os.path.isdir(head):
                 tail_split = tail.split('.')
-                if tail_split[-1] != 'pbz2':
+                if tail_split[-1] not in ('pbz2', face_store.STORE_SUFFIX):
                     tail = f'{tail}.pbz2'
-                if os.path.isfile(f'{head}/{tail}'):
+                if os.path.exists(f'{head}/{tail}'):
                     self.face_data_pkl = f'{head}/{tail}'
                     self.face_data_dict = self._load_face_data()
                 else:
@@ -61,6 +83,10 @@ class FileHandler:
             else:
                 print(f'!!! "{face_data_pkl}" does not exist and cannot be created')
                 raise ValueError
+        self.journal = journal.Journal(f'{self.face_data_pkl}.journal')
+        if self.face_data_dict is not None and len(self.journal.segments()) > 0:
+            replayed = self.journal.replay(self.face_data_dict, self.manifest)
+            print(f'+++ Replayed {replayed} journal segment(s): {self.journal.journal_dir}')
 
 
     def save_face_data(self, silent:bool=False) -> bool:
@@ -71,8 +97,24 @@ class FileHandler:
         if not self._type_check('silent', silent, bool):
             raise TypeError 
         try:
-            with bz2.BZ2File(self.face_data_pkl, 'w') as file:
-                pickle.dump(self.face_data_dict, file)
+            if self.is_store:
+                face_store.FaceStore.write(self.face_data_pkl, self.face_data_dict)
+                self.face_store = face_store.FaceStore(self.face_data_pkl) # map the new arrays
+                if isinstance(self.face_data_dict, face_store.FaceDataView):
+                    self.face_data_dict.rebase(self.face_store)
+            else: # written next to the live file and swapped in, like the store
+                tmp_path = f'{self.face_data_pkl}.tmp'
+                with open(tmp_path, 'wb') as raw_file:
+                    with bz2.BZ2File(raw_file, 'w') as file:
+                        pickle.dump(self.face_data_dict, file)
+                    raw_file.flush()
+                    os.fsync(raw_file.fileno())
+                os.replace(tmp_path, self.face_data_pkl)
+            if self._manifest is not None and not self._manifest.save(silent=True):
+                print(f'!!! Kept the journal: {self.journal.journal_dir}')
+                return False
+            face_store.fsync_path(os.path.dirname(os.path.abspath(self.face_data_pkl))) # the renames above
+            self.journal.clear() # every journaled segment is now durably in the main store
             if not silent:
                 print(f'+++ Saved: {self.face_data_pkl}')
             return True
@@ -81,6 +123,29 @@ class FileHandler:
         return False
 
 
+    def checkpoint(self, face_data:dict, removed:list=None, manifest_entries:dict=None) -> bool:
+        '''
+        Appends newly extracted face data to the journal without rewriting the main store
+        :param face_data: image key -> FaceData extracted since the last checkpoint
+        :param removed: image keys deleted since the last checkpoint
+        :param manifest_entries: manifest entries of the keys in face_data
+        '''
+        try:
+            self.journal.append(face_data, removed, manifest_entries)
+            return True
+        except Exception as e:
+            print(f'!!! Failed to checkpoint to: {self.journal.journal_dir}\n', e)
+        return False
+
+
+    def compact(self, silent:bool=False) -> bool:
+        '''
+        Merges the journal into the main store (a full save) and deletes its segments
+        :param silent: print success/failure message if False.
+        '''
+        return self.save_face_data(silent)
+
+
     def _load_face_data(self, silent:bool=False) -> dict:
         '''
         Pickle load dictionary of extracted face data
@@ -89,8 +154,12 @@ class FileHandler:
         if not self._type_check('silent', silent, bool):
             raise TypeError 
         try:
-            data = bz2.BZ2File(self.face_data_pkl, 'rb')
-            result = pickle.load(data)
+            if self.is_store:
+                self.face_store = face_store.FaceStore(self.face_data_pkl)
+                result = face_store.FaceDataView(self.face_store) # FaceData are created on access
+            else:
+                data = bz2.BZ2File(self.face_data_pkl, 'rb')
+                result = pickle.load(data)
             if not silent:
                 print(f'+++ Loaded: {self.face_data_pkl}')
                 print(f'    Number of keys: {len(result.keys())}')
@@ -99,6 +168,22 @@ class FileHandler:
             print(f'!!! Failed to load: {self.face_data_pkl}\n', e)
 
 
+    def convert_to_store(self, store_path:str, silent:bool=False) -> bool:
+        '''
+        Writes the loaded face data to a memory-mapped face store and
+        switches this handler over to it
+        :param store_path: path to the .fstore folder to create
+        :param silent: print success/failure message if False.
+        '''
+        if not self._type_check('store_path', store_path, str) or \
+            not self._type_check('silent', silent, bool):
+            raise TypeError
+        if not face_store.is_store_path(store_path):
+            store_path = f'{store_path.rstrip("/")}.{face_store.STORE_SUFFIX}'
+        self.face_data_pkl, self.is_store = store_path.rstrip('/'), True
+        return self.save_face_data(silent)
+
+
     def get_image_files(self, dir_path:str, include_sub_dirs=False) -> list:
         '''
         Return list of images in the passed directory
@@ -108,14 +193,55 @@ class FileHandler:
         if not self._type_check('dir_path', dir_path, str):
             raise TypeError 
         if os.path.exists(dir_path):
-            if include_sub_dirs:
-                if not dir_path.endswith('/'): dir_path = f'{dir_path}/'
-                files_gen = (p.resolve() for p in Path(dir_path).glob("**/*") if p.suffix in {".jpeg", ".jpg", ".png", ".webp"} and not p.name.startswith('.'))
-                files = [str(f) for f in list(files_gen)]
-            else:
-                files = [f'{dir_path}/{f}' for f in os.listdir(dir_path) if (f.endswith(".jpg") or f.endswith(".jpeg") or f.endswith(".png") \
-                    or f.endswith(".webp") and not f.startswith('.'))]
-            return files
+            return list(self.iter_image_files(dir_path, include_sub_dirs))
+        else:
+            print(f'!!! {dir_path} does not exist')
+            return
+
+
+    def iter_image_files(self, dir_path:str, include_sub_dirs=False):
+        '''
+        Lazily yield images in the passed directory while it is being listed
+        :param dir_path: path to folder of images to be encoded
+        :param include_sub_dirs: optionally recurse into nested folders
+        '''
+        if not self._type_check('dir_path', dir_path, str):
+            raise TypeError 
+        yield from self._iter_files(dir_path, include_sub_dirs, IMAGE_SUFFIXES)
+
+
+    def get_video_files(self, dir_path:str, include_sub_dirs=False) -> list:
+        '''
+        Return list of videos in the passed directory
+        :param dir_path: path to folder of videos to be encoded
+        :param include_sub_dirs: optionally recurse into nested folders
+        '''
+        if not self._type_check('dir_path', dir_path, str):
+            raise TypeError 
+        if os.path.exists(dir_path):
+            return list(self._iter_files(dir_path, include_sub_dirs, video_frames.VIDEO_SUFFIXES))
         else:
             print(f'!!! {dir_path} does not exist')
-            return
\ No newline at end of file
+            return
+
+
+    def _iter_files(self, dir_path:str, include_sub_dirs:bool, suffixes:set):
+        '''
+        Private method yielding the files with one of the suffixes in the passed directory
+        '''
+        if not os.path.exists(dir_path):
+            print(f'!!! {dir_path} does not exist')
+            return
+        dirs = [dir_path]
+        while len(dirs) > 0:
+            current = dirs.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if include_sub_dirs and entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif not entry.name.startswith('.') and \
+                            os.path.splitext(entry.name)[1] in suffixes and entry.is_file():
+                            yield str(Path(entry.path).resolve()) if include_sub_dirs else f'{dir_path}/{entry.name}'
+            except OSError as e:
+                print(f'!!! Could not list {current}\n', e)
@@ -0,0 +1,131 @@
+import os
+import json
+import numpy as np
+from model import FaceData
+
+class Journal:
+    '''
+    Append-only journal of face data segments kept next to the face data.
+    Each checkpoint writes only the newly extracted images as one segment
+    (segment-<n>.npz), committed with an atomic rename so a crash never
+    leaves a half-written segment. On load the segments are replayed on top
+    of the main store, and compaction merges them into it
+    '''
+    def __init__(self, journal_dir:str) -> None:
+        '''
+        :param journal_dir: folder holding the segments. Created on first append
+        '''
+        if not self._type_check('journal_dir', journal_dir, str):
+            raise TypeError
+        self.journal_dir = journal_dir
+
+    def segments(self) -> list:
+        '''
+        Returns the committed segment paths in write order
+        '''
+        if not os.path.isdir(self.journal_dir):
+            return list()
+        names = sorted(f for f in os.listdir(self.journal_dir) if f.startswith('segment-') and f.endswith('.npz'))
+        return [os.path.join(self.journal_dir, f) for f in names]
+
+    def append(self, face_data:dict, removed:list=None, manifest_entries:dict=None) -> str:
+        '''
+        Writes a segment and returns its path. Cost is proportional to the new data only
+        :param face_data: image key -> FaceData (or None) extracted since the last checkpoint
+        :param removed: image keys deleted since the last checkpoint
+        :param manifest_entries: manifest entries of the keys in face_data
+        '''
+        os.makedirs(self.journal_dir, exist_ok=True)
+        segments = self.segments()
+        seq = int(os.path.basename(segments[-1])[8:-4])+1 if len(segments) > 0 else 0
+        keys, valid, counts, encodings, rects = list(), list(), list(), list(), list()
+        for key, data in face_data.items():
+            keys.append(key)
+            valid.append(data is not None)
+            n_faces = len(data.face_encodings) if data is not None else 0
+            counts.append(n_faces)
+            if n_faces > 0:
+                encodings.append(data.encodings)
+                rects.append(data.boxes)
+        meta = {'keys': keys, 'valid': valid, 'removed': removed or list(), 'manifest': manifest_entries or dict()}
+        path = os.path.join(self.journal_dir, f'segment-{seq:08d}.npz')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, meta=np.array(json.dumps(meta)), counts=np.array(counts, dtype=np.int64),
+                encodings=np.concatenate(encodings) if encodings else np.empty((0, 128), dtype=np.float32),
+                rects=np.concatenate(rects) if rects else np.empty((0, 4), dtype=np.int32))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_dir()
+        return path
+
+    def replay(self, face_data_dict:dict, manifest=None) -> int:
+        '''
+        Applies every segment, in order, to face_data_dict (and the manifest).
+        Returns the number of segments replayed
+        :param face_data_dict: dictionary of extracted face data to update in place
+        :param manifest: optional manifest.Manifest to update in place
+        '''
+        segments = self.segments()
+        for path in segments:
+            with np.load(path) as file:
+                meta = json.loads(str(file['meta']))
+                offsets = np.concatenate(([0], np.cumsum(file['counts'])))
+                encodings, rects = file['encodings'], file['rects']
+            for key in meta['removed']:
+                face_data_dict.pop(key, None)
+                if manifest is not None:
+                    manifest.remove(key)
+            for i, key in enumerate(meta['keys']):
+                if not meta['valid'][i]:
+                    face_data_dict[key] = None
+                    continue
+                start, stop = offsets[i], offsets[i+1]
+                face_data_dict[key] = FaceData(encodings[start:stop], rects[start:stop])
+            if manifest is not None:
+                manifest.update(meta['manifest'])
+        return len(segments)
+
+    def clear(self) -> None:
+        '''
+        Deletes every segment. Call only once their data is in the main store
+        '''
+        for path in self.segments():
+            os.remove(path)
+        if os.path.isdir(self.journal_dir):
+            for name in os.listdir(self.journal_dir):
+                if name.endswith('.tmp'): # left over by a crash mid-append
+                    os.remove(os.path.join(self.journal_dir, name))
+            self._fsync_dir()
+
+    def _fsync_dir(self) -> None:
+        '''
+        Private method to make renames in the journal folder durable
+        '''
+        try:
+            fd = os.open(self.journal_dir, os.O_RDONLY)
+        except OSError: # e.g. folders cannot be opened on Windows
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
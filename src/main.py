@@ -1,20 +1,170 @@
+import os
+import time
+import numpy as np
+import itertools
 from tqdm import tqdm
 import model
 import file_handler
+import face_store
+import extraction_pool
+import pipeline
+import search
+import ann
+import clustering
+import profiling
+import duplicates
+import quantization
+import video
+import video_frames
 
 class Driver:
   '''
   Drives program and is handled by user. Provides methods to batch encode multiple images 
   in a given folder at once, and to encode single image files directly
   '''
-  def __init__(self, face_data_dict:str, detector_type:str='svm') -> None:
+  def __init__(self, face_data_dict:str, detector_type:str='svm', use_ann:bool=False,
+    use_clusters:bool=False, max_detection_dim:int=None, profiler:profiling.Profiler=None,
+    use_quantized:bool=False) -> None:
     '''
     :param face_data_dict: path to the compressed pickled dictionary 
       that stores/should store extracted face data.
     :param detector_type: "svm" or "cnn"
+    :param use_ann: load the approximate nearest neighbour index saved next to the
+      face data, if any. Build one with build_ann_index
+    :param use_clusters: load the identity clusters saved next to the face data, if any.
+      Build them with cluster_identities
+    :param max_detection_dim: optionally detect faces on images downscaled so their
+      longest side is at most this many pixels (e.g. 1600 for phone photos)
+    :param profiler: optional profiling.Profiler recording per-stage timings, counters and
+      failures of extraction. Flushed to its sinks after every batch_extract_faces
+    :param use_quantized: load the quantized index saved next to the face data, if any.
+      Build one with build_quantized_index
     '''
-    self.model = model.Model(detector_type)
+    start = time.perf_counter()
+    self.detector_type = detector_type
+    self.model_kwargs = {'max_detection_dim': max_detection_dim}
+    self.profiler = profiler if profiler is not None else profiling.Profiler(enabled=False)
+    self.model = model.Model(detector_type, profiler=self.profiler, **self.model_kwargs)
     self.file_handler = file_handler.FileHandler(face_data_dict)
+    self.ann_index = None
+    self.ann_index_path = f'{self.file_handler.face_data_pkl}.ivf.npz'
+    if use_ann and os.path.isfile(self.ann_index_path):
+      self.ann_index = ann.IVFIndex.load(self.ann_index_path, self._flat_index())
+    self.clusters = None
+    self.clusters_path = f'{self.file_handler.face_data_pkl}.clusters.npz'
+    if use_clusters and os.path.isfile(self.clusters_path):
+      self.clusters = clustering.IdentityClusters.load(self.clusters_path, self._flat_index())
+    self.quantized_index = None
+    self.quantized_index_path = f'{self.file_handler.face_data_pkl}.quant.npz'
+    if use_quantized and os.path.isfile(self.quantized_index_path):
+      self.quantized_index = quantization.QuantizedIndex.load(self.quantized_index_path, self._flat_index())
+    self._exact_index = None # built by search_index on first search
+    self.hash_index = None # loaded by batch_extract_faces(..., dedup=True)
+    self.hash_index_path = f'{self.file_handler.face_data_pkl}.phash.npz'
+    self.startup_seconds = time.perf_counter()-start
+    print(f'+++ Startup: {self.startup_seconds*1000:.1f} ms (dlib models load on first extraction)')
+
+  def build_ann_index(self, nlist:int=None, nprobe:int=16, report_recall:bool=True) -> ann.IVFIndex:
+    '''
+    Trains an approximate nearest neighbour index over all extracted faces and saves it
+    next to the face data. batch_extract_faces keeps it up to date afterwards
+    :param nlist: number of k-means lists. Defaults to ~4*sqrt(number of faces)
+    :param nprobe: number of lists scored per query. Higher is slower but more accurate
+    :param report_recall: print the recall@10 against exact search on a sample of faces
+    '''
+    self.ann_index = ann.IVFIndex.build(self._flat_index(), nlist, nprobe)
+    self.ann_index.save(self.ann_index_path)
+    print(f'+++ Saved: {self.ann_index_path}')
+    if report_recall:
+      print(f'    Recall@10 (nprobe={nprobe}): {self.ann_index.recall():.3f}')
+    return self.ann_index
+
+  def build_quantized_index(self, mode:str='int8', n_subspaces:int=16, report:bool=True) -> quantization.QuantizedIndex:
+    '''
+    Compresses every extracted face encoding for search with exact re-ranking and saves
+    the codes next to the face data. With a face store (.fstore) the full precision
+    encodings stay memory-mapped on disk. batch_extract_faces encodes new data
+    with the same codec afterwards
+    :param mode: "float16" (2x smaller), "int8" (4x) or "pq" (product quantization, 512/n_subspaces x)
+    :param n_subspaces: pq bytes per face
+    :param report: print memory use and recall@10 of the codes on a sample of faces
+    '''
+    self.quantized_index = quantization.QuantizedIndex.build(self._flat_index(), mode, n_subspaces)
+    self.quantized_index.save(self.quantized_index_path)
+    print(f'+++ Saved: {self.quantized_index_path}')
+    if report:
+      stats = self.quantized_index.report()
+      print(f'    {mode}: {stats["memory_mb"]:.1f} MB in memory ({stats["bytes_per_face"]:.0f} bytes/face '
+        f'vs {stats["float32_bytes_per_face"]} float32), recall@10 before re-ranking: {stats["recall_at_10"]:.3f}, '
+        f'{stats["mean_candidates"]:.1f} faces re-ranked per query')
+    return self.quantized_index
+
+  def _flat_index(self) -> search.EmbeddingIndex:
+    '''
+    Private method returning an exact index over every extracted face. Maps the encoding
+    block of the face store without copying it when the store holds all the face data
+    '''
+    store = self.file_handler.face_store
+    face_data_dict = self.file_handler.face_data_dict
+    if isinstance(face_data_dict, face_store.FaceDataView) and face_data_dict.store is store and \
+      not face_data_dict.modified:
+      return search.EmbeddingIndex.from_arrays(store.keys, np.diff(store.offsets), store.encodings, store.norms)
+    return search.EmbeddingIndex.from_face_data(self.file_handler.face_data_dict)
+
+  def search_batch(self, queries:list, top_k:int, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> list:
+    '''
+    Searches for every face of many query images at once. Returns, per query, a list
+    with the top_k search.Match of each of its faces
+    :param queries: list of keys in face_data_dict and/or FaceData (e.g. from extract_faces)
+    :param top_k: max number of matches to return per query face
+    :param euclidean_thres: max euclidean distance of a match
+    :param cosine_thres: min cosine similarity of a match
+    '''
+    return self.model.search_similar_batch(queries, self.file_handler.face_data_dict, top_k,
+      euclidean_thres, cosine_thres, index=self.search_index())
+
+  def cluster_identities(self, method:str='components', euclidean_thres:float=0.6, cosine_thres:float=0.92,
+    block_size:int=4096) -> list:
+    '''
+    Groups every extracted face into identities and saves the clusters next to the
+    face data. batch_extract_faces assigns new faces to them afterwards.
+    Returns the clusters, largest first, as lists of (image key, face index)
+    :param method: "components" or "chinese_whispers"
+    :param euclidean_thres: max euclidean distance of two faces of the same identity
+    :param cosine_thres: min cosine similarity of two faces of the same identity
+    :param block_size: faces per tile when computing the similarity graph
+    '''
+    self.clusters = clustering.IdentityClusters(self._flat_index(), euclidean_thres, cosine_thres)
+    self.clusters.fit(method, block_size)
+    self.clusters.save(self.clusters_path)
+    print(f'+++ Saved: {self.clusters_path}')
+    return self.clusters.clusters()
+
+  def search(self, query:str, top_k:int, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> list:
+    '''
+    Returns the top_k images similar to a stored query image as a list of search.Match,
+    using the approximate or quantized index when one is loaded
+    :param query: key of the query image in face_data_dict
+    :param top_k: max number of matches to return
+    :param euclidean_thres: max euclidean distance of a match
+    :param cosine_thres: min cosine similarity of a match
+    '''
+    return self.model.search_similar(query, self.file_handler.face_data_dict, top_k,
+      euclidean_thres, cosine_thres, index=self.search_index())
+
+  def search_index(self):
+    '''
+    Returns the index searches run on: the loaded approximate or quantized index, or
+    else an exact index over every extracted face, built once and reused until the
+    next batch_extract_faces
+    '''
+    if self.ann_index is not None:
+      return self.ann_index
+    if self.quantized_index is not None:
+      return self.quantized_index
+    if self._exact_index is None:
+      self._exact_index = self._flat_index()
+    return self._exact_index
   
   def extract_faces(self, img_path:str, upsample_times:int=0) -> model.FaceData:
     '''
@@ -23,22 +173,272 @@ class Driver:
     '''
     return self.model.get_face_data(img_path, upsample_times)
 
-  def batch_extract_faces(self, dir_path:str, upsample_times:int=0, include_sub_dirs:bool=False) -> None:
+  def batch_extract_faces(self, dir_path:str, upsample_times:int=0, include_sub_dirs:bool=False,
+    incremental:bool=False, hash_files:bool=False, workers:int=1, chunk_size:int=16,
+    pipelined:bool=False, decode_threads:int=4, queue_size:int=16, batch_size:int=None,
+    checkpoint_every:int=None, checkpoint_seconds:float=None, compact:bool=True,
+    dedup:bool=False, dedup_distance:int=4) -> dict:
     '''
+    Returns a report with the number of added, updated, removed and skipped files
     :param dir_path: path to folder of images to extract facial data from
     :param upsample_times: optionally upsample images prior to encoding 
     :param include_sub_dirs: optionally recurse into nested folders
+    :param incremental: only encode files that are new or changed since the last run
+      (per the file manifest) and drop data of files deleted from dir_path
+    :param hash_files: in incremental mode, also compare content hashes so files that
+      were only touched are not re-encoded
+    :param workers: number of extraction processes. 1 extracts in this process,
+      None uses every core
+    :param chunk_size: number of files sent to a worker process at a time
+    :param pipelined: with workers=1, stream files through a staged pipeline that
+      prefetches and decodes images on background threads. Unless incremental, files
+      are discovered lazily so extraction starts before the folder is fully listed
+    :param decode_threads: number of image decode threads in pipelined mode
+    :param queue_size: max number of images buffered between pipeline stages
+    :param batch_size: when not pipelined, extract chunk_size files at a time with batched dlib
+      calls of up to batch_size face chips (and same-sized images for the cnn detector)
+    :param checkpoint_every: append newly extracted images to the crash-safe journal every
+      this many files. Rerun with incremental=True to resume an interrupted run
+    :param checkpoint_seconds: also checkpoint when this many seconds passed since the last one
+    :param compact: at the end, merge everything into the main face data file (a full save).
+      If False only the new data is appended to the journal; compact later with
+      file_handler.compact()
+    :param dedup: hash every file first and reuse the face data (with rescaled face rectangles)
+      of exact and near-duplicates (resized copies, re-exports) instead of encoding them again.
+      Hashes are kept next to the face data so later runs also dedup against the library.
+      The report then also lists the duplicate groups
+    :param dedup_distance: max Hamming distance (in bits, of 64) of the hashes of near-duplicates
     '''
-    files = self.file_handler.get_image_files(dir_path, include_sub_dirs)
-    for file in tqdm(files):
-      face_data = self.model.get_face_data(file, upsample_times)
-      self.file_handler.face_data_dict[file] = face_data
-    self.file_handler.save_face_data()
+    face_data_dict = self.file_handler.face_data_dict
+    manifest = self.file_handler.manifest
+    report = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+    entries = None
+    removed = list()
+    if incremental:
+      files = self.file_handler.get_image_files(dir_path, include_sub_dirs)
+      changes = manifest.diff(files, dir_path, include_sub_dirs, hash_files, known=face_data_dict)
+      # videos in the manifest are listed by batch_extract_videos only
+      removed = [path for path in changes['removed'] if os.path.splitext(path)[1] in file_handler.IMAGE_SUFFIXES]
+      for path in self._drop_keys(removed):
+        manifest.remove(path)
+      entries = changes['entries']
+      manifest.update({file: entries[file] for file in changes['skipped']})
+      report = {k: len(changes[k]) for k in report.keys()}
+      report['removed'] = len(removed)
+      files = changes['added'] + changes['updated']
+    elif pipelined and workers == 1 and not dedup:
+      files = self.file_handler.iter_image_files(dir_path, include_sub_dirs)
+    else:
+      files = self.file_handler.get_image_files(dir_path, include_sub_dirs)
+    total = len(files) if isinstance(files, list) else None
+    extract = lambda files: self._extract_iter(files, upsample_times, workers, chunk_size, pipelined,
+      decode_threads, queue_size, batch_size)
+    if dedup:
+      if self.hash_index is None:
+        self.hash_index = duplicates.HashIndex.load(self.hash_index_path, dedup_distance) \
+          if os.path.isfile(self.hash_index_path) else duplicates.HashIndex(dedup_distance)
+      if incremental:
+        for path in removed:
+          self.hash_index.remove(path)
+      deduplicator = duplicates.Deduplicator(self.hash_index, face_data_dict, decode_threads)
+      extracted = deduplicator.run(files, extract)
+    else:
+      extracted = extract(files)
+    pending, pending_entries = dict(), dict()
+    last_checkpoint = time.monotonic()
+    batch_start = time.perf_counter()
+    for file, face_data in tqdm(extracted, total=total):
+      if entries is None:
+        report['updated' if file in face_data_dict else 'added'] += 1
+        try:
+          entry = manifest.stat(file, hash_files)
+        except OSError:
+          entry = None
+      else:
+        entry = entries[file]
+      if entry is not None and face_data is not None: # failed files stay out so the next run retries them
+        manifest.update({file: entry})
+        pending_entries[file] = entry
+      face_data_dict[file] = face_data
+      pending[file] = face_data
+      if (checkpoint_every is not None and len(pending) >= checkpoint_every) or \
+        (checkpoint_seconds is not None and time.monotonic()-last_checkpoint >= checkpoint_seconds):
+        self.file_handler.checkpoint(pending, removed, pending_entries)
+        pending, pending_entries, removed = dict(), dict(), list()
+        last_checkpoint = time.monotonic()
+      self._index_keys({file: face_data})
+    self.profiler.observe('batch_extract_faces', time.perf_counter()-batch_start)
+    print(f'+++ Added: {report["added"]}, updated: {report["updated"]}, '
+      f'removed: {report["removed"]}, skipped: {report["skipped"]}')
+    if dedup:
+      report['duplicate_groups'] = deduplicator.report()
+      report['duplicates'] = sum(len(group)-1 for group in report['duplicate_groups'])
+      print(f'+++ Duplicates reused: {report["duplicates"]} in {len(report["duplicate_groups"])} groups')
+    changed = not incremental or report['added'] + report['updated'] + report['removed'] > 0
+    if not compact and (len(pending) > 0 or len(removed) > 0):
+      self.file_handler.checkpoint(pending, removed, pending_entries)
+    self._finish_batch(changed, compact)
+    if dedup and (changed or not os.path.isfile(self.hash_index_path)):
+      self.hash_index.save(self.hash_index_path)
+    self.profiler.flush()
+    return report
+
+  def batch_extract_videos(self, dir_path:str, upsample_times:int=0, include_sub_dirs:bool=False,
+    incremental:bool=False, min_interval:float=0.5, max_interval:float=5.0, scene_change:float=0.04,
+    iou_threshold:float=0.3, chips_per_track:int=1, compact:bool=True) -> dict:
+    '''
+    Extracts face data from the videos in a folder without encoding every frame (see
+    video.VideoIngester). Faces are stored under frame keys ("video.mp4#t=12.480") that
+    search, find_similarities and the renderer handle like image keys. Every video is
+    checkpointed to the journal once done, so an interrupted run resumes with incremental=True.
+    Returns a report with the number of added, updated, removed and skipped videos and
+    of the read and sampled frames, face tracks and encoded faces
+    :param dir_path: path to folder of videos to extract facial data from
+    :param upsample_times: optionally upsample frames prior to detection
+    :param include_sub_dirs: optionally recurse into nested folders
+    :param incremental: only ingest videos that are new or changed since the last run
+      (per the file manifest) and drop data of videos deleted from dir_path
+    :param min_interval: min seconds between sampled frames
+    :param max_interval: sample a frame at least every this many seconds, even if the scene is static
+    :param scene_change: min mean absolute difference (as a fraction of 255) to the last sampled
+      frame for a frame to be sampled
+    :param iou_threshold: min overlap of a detection with a track's last box to continue the track
+    :param chips_per_track: number of chips encoded per face track
+    :param compact: at the end, merge everything into the main face data file (a full save).
+      If False the data stays in the journal; compact later with file_handler.compact()
+    '''
+    face_data_dict = self.file_handler.face_data_dict
+    manifest = self.file_handler.manifest
+    ingester = video.VideoIngester(self.model, min_interval, max_interval, scene_change, iou_threshold,
+      chips_per_track=chips_per_track)
+    videos = self.file_handler.get_video_files(dir_path, include_sub_dirs) or list()
+    frame_keys = dict() # video path -> keys of its frames in the face data
+    for key in face_data_dict.keys():
+      parsed = video_frames.parse_frame_key(key)
+      if parsed is not None:
+        frame_keys.setdefault(parsed[0], list()).append(key)
+    report = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+    entries = None
+    if incremental:
+      changes = manifest.diff(videos, dir_path, include_sub_dirs, known=frame_keys)
+      removed = [path for path in changes['removed'] if os.path.splitext(path)[1] in video_frames.VIDEO_SUFFIXES]
+      removed_keys = list()
+      for path in removed:
+        removed_keys.extend(self._drop_keys(frame_keys.pop(path, list())))
+        manifest.remove(path)
+      if len(removed_keys) > 0:
+        self.file_handler.checkpoint(dict(), removed_keys)
+      entries = changes['entries']
+      manifest.update({path: entries[path] for path in changes['skipped']})
+      report.update({'removed': len(removed), 'skipped': len(changes['skipped'])})
+      videos = changes['added'] + changes['updated']
+    batch_start = time.perf_counter()
+    for path in tqdm(videos):
+      try:
+        data = ingester.ingest(path, upsample_times)
+        entry = entries[path] if entries is not None else manifest.stat(path)
+      except Exception as e:
+        print(f'!!! Could not ingest {path}\n', e)
+        self.profiler.record_failure(path, e)
+        continue
+      report['updated' if path in manifest or path in frame_keys else 'added'] += 1
+      stale = self._drop_keys([key for key in frame_keys.pop(path, list()) if key not in data])
+      face_data_dict.update(data)
+      manifest.update({path: entry})
+      self._index_keys(data)
+      self.file_handler.checkpoint(data, stale, {path: entry})
+    self.profiler.observe('batch_extract_videos', time.perf_counter()-batch_start)
+    report.update({'frames': ingester.stats['frames'], 'sampled': ingester.stats['sampled'],
+      'tracks': ingester.stats['tracks'], 'faces': ingester.stats['encoded']})
+    print(f'+++ Added: {report["added"]}, updated: {report["updated"]}, '
+      f'removed: {report["removed"]}, skipped: {report["skipped"]} videos')
+    print(f'+++ Sampled {report["sampled"]} of {report["frames"]} frames, '
+      f'encoded {report["faces"]} faces of {report["tracks"]} tracks')
+    self._finish_batch(report['added'] + report['updated'] + report['removed'] > 0, compact)
+    self.profiler.flush()
+    return report
+
+  def _index_keys(self, data:dict) -> None:
+    '''
+    Private method adding new face data (key -> FaceData or None) to the indexes kept up to date
+    '''
+    for key, face_data in data.items():
+      encodings = face_data.face_encodings if face_data is not None else None
+      if self.ann_index is not None:
+        self.ann_index.add(key, encodings)
+      if self.clusters is not None:
+        self.clusters.assign(key, encodings)
+      if self.quantized_index is not None:
+        self.quantized_index.add(key, encodings)
+
+  def _drop_keys(self, keys:list) -> list:
+    '''
+    Private method removing keys from the face data and the indexes kept up to date. Returns the keys
+    '''
+    for key in keys:
+      self.file_handler.face_data_dict.pop(key, None)
+      if self.ann_index is not None:
+        self.ann_index.remove(key)
+      if self.clusters is not None:
+        self.clusters.remove(key)
+      if self.quantized_index is not None:
+        self.quantized_index.remove(key)
+    return keys
+
+  def _finish_batch(self, changed:bool, compact:bool) -> None:
+    '''
+    Private method run after a batch extraction: saves the face data and the indexes kept
+    up to date (if compact) and drops the exact index built over the old face data.
+    The quantized index is moved onto the rewritten store
+    '''
+    if compact and changed and self.file_handler.save_face_data():
+      if self.ann_index is not None:
+        self.ann_index.save(self.ann_index_path)
+      if self.clusters is not None:
+        self.clusters.save(self.clusters_path)
+      if self.quantized_index is not None: # onto the rewritten store, encoding only the added faces
+        self.quantized_index.attach(self._flat_index())
+        self.quantized_index.save(self.quantized_index_path)
+    elif compact and not changed:
+      self.file_handler.manifest.save(silent=True)
+    if changed:
+      self._exact_index = None
+
+  def _extract_iter(self, files, upsample_times:int, workers:int, chunk_size:int,
+    pipelined:bool=False, decode_threads:int=4, queue_size:int=16, batch_size:int=None):
+    '''
+    Yields (file, FaceData) for every file, in this process, on a staged pipeline
+    or on a process pool
+    :param files: iterable of image file paths
+    :param upsample_times: optionally upsample images prior to encoding 
+    :param workers: number of extraction processes
+    :param chunk_size: number of files sent to a worker process at a time
+    :param pipelined: use the staged prefetching pipeline when workers is 1
+    :param decode_threads: number of image decode threads in pipelined mode
+    :param queue_size: max number of images buffered between pipeline stages
+    :param batch_size: use batched dlib calls of up to batch_size chips per chunk of files
+    '''
+    if workers == 1:
+      if pipelined:
+        yield from pipeline.ExtractionPipeline(self.model, decode_threads, queue_size).run(files, upsample_times)
+      elif batch_size is not None:
+        files = iter(files)
+        for chunk in iter(lambda: list(itertools.islice(files, chunk_size)), []):
+          yield from zip(chunk, self.model.get_face_data_batch(chunk, upsample_times, batch_size))
+      else:
+        for file in files:
+          yield file, self.model.get_face_data(file, upsample_times)
+      return
+    with extraction_pool.ExtractionPool(self.detector_type, workers, chunk_size, self.model_kwargs,
+      self.profiler) as pool:
+      yield from pool.imap(files, upsample_times, batch_size)
 
 # Example user code
 if __name__ == '__main__':
   '''init driver with path to pickled dictionary. Creates one if it does not exist'''
   driver = Driver('path/to/dict/to/use.pbz2')
+  # to see where ingest time goes, pass e.g.
+  # profiler=profiling.Profiler(sinks=[profiling.JsonFileSink('data/profile.json')])
 
   '''comparing two images'''
   face_data_1 = driver.extract_faces('/path/to/image/1')
@@ -49,7 +449,35 @@ if __name__ == '__main__':
   
   '''extracting facial data in batches'''
   driver.batch_extract_faces('/path/to/image/folder') # extracted data stored in driver.file_handler.face_data_dict
+  driver.batch_extract_faces('/path/to/image/folder', incremental=True) # later runs only encode new/changed files
+  driver.batch_extract_faces('/path/to/image/folder', workers=None) # extract on every core
+  driver.batch_extract_faces('/path/to/image/folder', pipelined=True) # overlap listing/decoding with encoding
+  driver.batch_extract_faces('/path/to/image/folder', chunk_size=64, batch_size=32) # batched dlib calls
+  driver.batch_extract_faces('/path/to/image/folder', checkpoint_every=500) # crash-safe; resume with incremental=True
+  driver.batch_extract_faces('/path/to/image/folder', dedup=True) # reuse face data of duplicate/resized copies
+  driver.batch_extract_videos('/path/to/video/folder', incremental=True) # sampled frames, one chip per face track
   target_img_key = 'target-img-key' # key to image in driver.file_handler.face_data_dict. Find images with similar faces to this key
   top_k = 10 # attempt to render top_k similar images
   metrics_dict = driver.model.find_similarities(target_img_key, driver.file_handler.face_data_dict) # compare target image to all images in face_data_dict
-  driver.model.render_similar_images(target_img_key, driver.file_handler.face_data_dict, metrics_dict, top_k)
\ No newline at end of file
+  driver.model.render_similar_images(target_img_key, driver.file_handler.face_data_dict, metrics_dict, top_k)
+
+  '''faster: vectorized top_k search over all faces without per-face Metrics'''
+  matches = driver.model.search_similar(target_img_key, driver.file_handler.face_data_dict, top_k)
+  driver.model.render_matches(target_img_key, matches)
+  driver.model.render_matches(target_img_key, matches, driver.file_handler.face_data_dict, page_size=50) # box matched faces
+
+  '''million-face libraries: approximate nearest neighbour search (kept up to date by batch_extract_faces)'''
+  driver.build_ann_index(nprobe=16) # once; later runs can use Driver(..., use_ann=True)
+  matches = driver.search(target_img_key, top_k)
+  driver.model.render_matches(target_img_key, matches)
+
+  '''libraries larger than RAM: compressed codes in memory, exact re-ranking from the face store on disk'''
+  driver.build_quantized_index('int8') # or 'float16' / 'pq'; later runs can use Driver(..., use_quantized=True)
+  matches = driver.search(target_img_key, top_k)
+
+  '''searching for every face of a group photo and many stored images at once'''
+  group_photo = driver.extract_faces('/path/to/group/photo')
+  results = driver.search_batch([group_photo, target_img_key], top_k) # results[query][face] -> matches
+
+  '''grouping every face into identities ("people" view)'''
+  people = driver.cluster_identities() # lists of (image key, face index), largest first
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+
+class Manifest:
+    '''
+    Records the size, mtime and optional content hash of every encoded file
+    so batch extraction only has to re-encode files that changed
+    '''
+    def __init__(self, manifest_path:str) -> None:
+        '''
+        :param manifest_path: path to the manifest json. Created on save if it does not exist
+        '''
+        if not self._type_check('manifest_path', manifest_path, str):
+            raise TypeError
+        self.manifest_path = manifest_path
+        self.entries = dict()
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, 'r') as file:
+                    self.entries = json.load(file)
+            except Exception as e:
+                print(f'!!! Failed to load: {manifest_path}. Starting with an empty manifest\n', e)
+
+    def __contains__(self, path) -> bool:
+        return path in self.entries
+
+    def stat(self, path:str, hash_file:bool=False) -> dict:
+        '''
+        Returns the manifest entry describing a file as it currently is on disk
+        :param path: file path
+        :param hash_file: also compute a content hash
+        '''
+        st = os.stat(path)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+        if hash_file:
+            entry['hash'] = self._hash(path)
+        return entry
+
+    def _hash(self, path:str) -> str:
+        '''
+        Private method to compute the content hash of a file
+        :param path: file path
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def diff(self, files:list, dir_path:str, include_sub_dirs:bool=False, hash_files:bool=False,
+        known:dict=None) -> dict:
+        '''
+        Compares the files found in dir_path to the manifest. Returns a dict with
+            added: files not seen before
+            updated: files whose size/mtime (and hash if hash_files) changed
+            removed: manifest entries under dir_path whose file no longer exists
+            skipped: unchanged files
+            entries: up-to-date manifest entries of added, updated and skipped files
+        :param files: image files currently in dir_path
+        :param dir_path: folder the files were listed from
+        :param include_sub_dirs: whether files were listed recursively
+        :param hash_files: compare content hashes when size/mtime changed
+        :param known: optional dict of already encoded files (e.g. face_data_dict). Files
+            in it with face data but missing from the manifest are adopted as unchanged
+        '''
+        changes = {'added': list(), 'updated': list(), 'removed': list(), 'skipped': list(), 'entries': dict()}
+        current = set(files)
+        for file in files:
+            try:
+                entry = self.stat(file)
+            except OSError as e:
+                print(f'!!! Could not stat {file}\n', e)
+                continue
+            old = self.entries.get(file)
+            if old is None:
+                status = 'skipped' if known is not None and known.get(file) is not None else 'added'
+            elif old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                entry, status = old, 'skipped'
+            elif hash_files and 'hash' in old and self._hash(file) == old['hash']:
+                entry['hash'], status = old['hash'], 'skipped' # touched but not modified
+            else:
+                status = 'updated'
+            if hash_files and 'hash' not in entry:
+                entry['hash'] = self._hash(file)
+            changes[status].append(file)
+            changes['entries'][file] = entry
+
+        root = os.path.abspath(dir_path)
+        for path in self.entries.keys():
+            if path in current:
+                continue
+            parent = os.path.dirname(os.path.abspath(path))
+            in_scope = parent == root or (include_sub_dirs and parent.startswith(root + os.sep))
+            if in_scope and not os.path.exists(path):
+                changes['removed'].append(path)
+        return changes
+
+    def update(self, entries:dict) -> None:
+        '''
+        :param entries: path -> entry returned by stat/diff
+        '''
+        self.entries.update(entries)
+
+    def remove(self, path:str) -> None:
+        '''
+        :param path: file path to drop from the manifest
+        '''
+        self.entries.pop(path, None)
+
+    def save(self, silent:bool=False) -> bool:
+        '''
+        Writes the manifest json
+        :param silent: print success/failure message if False.
+        '''
+        try:
+            tmp_path = f'{self.manifest_path}.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(self.entries, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.manifest_path)
+            if not silent:
+                print(f'+++ Saved: {self.manifest_path}')
+            return True
+        except Exception as e:
+            print(f'!!! Failed to save: {self.manifest_path}\n', e)
+        return False
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
@@ -1,10 +1,51 @@
+import os
+import collections.abc
+import time
+import shutil
 import typing
+import threading
+import bz2file as bz2
 import numpy as np
 from numpy.linalg import norm
 from numpy import dot
 import dlib
 import cv2
 import render_html
+import thumbnails
+import profiling
+import search
+import ann
+import quantization
+import video_frames
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'face-search')
+
+def resolve_model_file(name:str, data_dir:str='data', cache_dir:str=None) -> str:
+    '''
+    Returns the path of an unpacked dlib model file. Uses data_dir/name if it exists,
+    else decompresses data_dir/name.bz2 into the cache folder once
+    :param name: model file name, e.g. "shape_predictor_68_face_landmarks.dat"
+    :param data_dir: folder holding the bundled model files
+    :param cache_dir: folder for decompressed models. Defaults to $FACE_SEARCH_CACHE
+        or ~/.cache/face-search
+    '''
+    path = os.path.join(data_dir, name)
+    if os.path.isfile(path):
+        return path
+    cache_dir = cache_dir or os.environ.get('FACE_SEARCH_CACHE', DEFAULT_CACHE_DIR)
+    cached_path = os.path.join(cache_dir, name)
+    if os.path.isfile(cached_path):
+        return cached_path
+    if not os.path.isfile(f'{path}.bz2'):
+        print(f'!!! Neither {path} nor {path}.bz2 exist')
+        raise FileNotFoundError
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{cached_path}.{os.getpid()}.tmp'
+    with bz2.BZ2File(f'{path}.bz2', 'rb') as src, open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp_path, cached_path)
+    print(f'+++ Decompressed: {path}.bz2 -> {cached_path}')
+    return cached_path
 
 class Metrics:
     def __init__(self, euclid_dist:np.float64=0.0, cos_sim:np.float64=0.0) -> None:
@@ -25,32 +66,145 @@ class Metrics:
         self.sim_score = self.euclid_dist + abs(self.cos_sim-1)
 
 class FaceData:
-    def __init__(self, face_encodings:list=list(), faces:list=list()) -> None:
+    '''
+    Faces found in one image, stored compactly as one float32 (n_faces, 128) array of
+    encodings and one int32 (n_faces, 4) array of face boxes (left, top, right, bottom).
+    dlib rectangles are only created when faces is first read, and cached until boxes change
+    '''
+    __slots__ = ('encodings', 'boxes', '_rects')
+
+    def __init__(self, face_encodings=None, faces=None) -> None:
+        '''
+        :param face_encodings: list of encodings or a (n_faces, 128) array
+        :param faces: list of dlib rectangles or a (n_faces, 4) array of boxes
+        '''
         self.face_encodings = face_encodings
         self.faces = faces
 
+    @property
+    def face_encodings(self) -> np.ndarray:
+        return self.encodings
+
+    @face_encodings.setter
+    def face_encodings(self, face_encodings) -> None:
+        if face_encodings is None or len(face_encodings) == 0:
+            self.encodings = np.empty((0, 128), dtype=np.float32)
+        else:
+            self.encodings = np.asarray(face_encodings, dtype=np.float32).reshape(len(face_encodings), -1)
+
+    @property
+    def faces(self) -> list:
+        cached = getattr(self, '_rects', None)
+        if cached is None or cached[0] is not self.boxes:
+            cached = (self.boxes, [dlib.rectangle(int(l), int(t), int(r), int(b)) for l, t, r, b in self.boxes])
+            self._rects = cached
+        return list(cached[1])
+
+    @faces.setter
+    def faces(self, faces) -> None:
+        if faces is None or isinstance(faces, np.ndarray):
+            self.boxes = np.asarray(faces if faces is not None else (), dtype=np.int32).reshape(-1, 4)
+        else:
+            self.boxes = np.array([(f.left(), f.top(), f.right(), f.bottom()) for f in faces], dtype=np.int32).reshape(-1, 4)
+
+    def __getstate__(self) -> dict:
+        return {'encodings': self.encodings, 'boxes': self.boxes}
+
+    def __setstate__(self, state) -> None:
+        '''
+        Also loads FaceData pickled before it used slots, which hold a list
+        of float64 encodings and a list of dlib rectangles
+        '''
+        if isinstance(state, tuple): # (__dict__, slots) of the default slots pickle
+            state = {k: v for part in state if part for k, v in part.items()}
+        if 'face_encodings' in state:
+            self.face_encodings = state['face_encodings']
+            self.faces = state['faces']
+        else:
+            self.encodings = state['encodings']
+            self.boxes = state['boxes']
+
 class Model:
     '''
     Handles the extraction and encoding of faces in images
     '''
-    def __init__(self, detector_type:str="svm") -> None:
+    def __init__(self, detector_type:str="svm", max_detection_dim:int=None, retry_full_resolution:bool=True,
+        data_dir:str='data', cache_dir:str=None, profiler:profiling.Profiler=None) -> None:
         '''
-        Inits config/settings
+        Inits config/settings. The dlib models are loaded on first use
         :param detector_type: "svm" or "cnn"
+        :param max_detection_dim: optionally run the detector on a copy of the image
+            downscaled so its longest side is at most this many pixels. Face rectangles
+            are mapped back to full resolution for landmarks and encoding
+        :param retry_full_resolution: when detecting on a downscaled copy finds no
+            face, run the detector again on the full resolution image
+        :param data_dir: folder holding the (optionally .bz2 compressed) dlib model files
+        :param cache_dir: folder compressed model files are decompressed to
+        :param profiler: optional profiling.Profiler recording per-stage timings, face
+            counts and failures. Disabled if None
         '''
-        if not self._type_check('detector_type', detector_type, str):
+        if not self._type_check('detector_type', detector_type, str) or \
+            not self._type_check('retry_full_resolution', retry_full_resolution, bool) or \
+            (max_detection_dim is not None and not self._type_check('max_detection_dim', max_detection_dim, int)):
             raise TypeError
+        if max_detection_dim is not None and max_detection_dim <= 0:
+            print(f'max_detection_dim must be > 0. Got: {max_detection_dim}')
+            raise ValueError
+        self.max_detection_dim = max_detection_dim
+        self.retry_full_resolution = retry_full_resolution
         self.detector_type = detector_type.lower()
-        if self.detector_type == 'svm':
-            self.face_detector = dlib.get_frontal_face_detector()
-        elif self.detector_type == 'cnn':
-            self.face_detector = dlib.cnn_face_detection_model_v1('data/mmod_human_face_detector.dat')
-        else:
+        if self.detector_type not in ('svm', 'cnn'):
             print(f'detector_type must be either "svm" or "cnn". Got: {detector_type}')
             raise ValueError
-        self.shape_predictor = dlib.shape_predictor('data/shape_predictor_68_face_landmarks.dat')
-        self.face_recognition_model = dlib.face_recognition_model_v1('data/dlib_face_recognition_resnet_model_v1.dat')
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.load_times = dict() # model name -> seconds spent loading it
+        self._models = dict()
+        self._models_lock = threading.Lock()
+        self.profiler = profiler if profiler is not None else profiling.Profiler(enabled=False)
         self.renderer = render_html.Renderer()
+        self.thumbnail_cache = None # created by render_matches
+
+    def _load(self, name:str, loader):
+        '''
+        Private method to load a model once, on first use
+        :param name: model name
+        :param loader: callable returning the loaded model
+        '''
+        model = self._models.get(name)
+        if model is None:
+            with self._models_lock:
+                model = self._models.get(name)
+                if model is None:
+                    start = time.perf_counter()
+                    model = loader()
+                    self.load_times[name] = time.perf_counter()-start
+                    self._models[name] = model
+        return model
+
+    @property
+    def face_detector(self):
+        if self.detector_type == 'svm':
+            return self._load('face_detector', dlib.get_frontal_face_detector)
+        return self._load('face_detector', lambda: dlib.cnn_face_detection_model_v1(
+            resolve_model_file('mmod_human_face_detector.dat', self.data_dir, self.cache_dir)))
+
+    @property
+    def shape_predictor(self):
+        return self._load('shape_predictor', lambda: dlib.shape_predictor(
+            resolve_model_file('shape_predictor_68_face_landmarks.dat', self.data_dir, self.cache_dir)))
+
+    @property
+    def face_recognition_model(self):
+        return self._load('face_recognition_model', lambda: dlib.face_recognition_model_v1(
+            resolve_model_file('dlib_face_recognition_resnet_model_v1.dat', self.data_dir, self.cache_dir)))
+
+    def load_models(self) -> None:
+        '''
+        Loads every model now instead of on first use
+        '''
+        for name in ('face_detector', 'shape_predictor', 'face_recognition_model'):
+            getattr(self, name)
     
     def _type_check(self, obj_name:str, obj, type)->bool:
         '''
@@ -80,12 +234,47 @@ class Model:
         if upsample_times < 0:
             print(f'upsample_times must be >= 0')
             raise ValueError
-        faces = self.face_detector(image, upsample_times)
+        detection_image, scale = self._detection_image(image)
+        if scale == 1.0:
+            return self._detect(image, upsample_times)
+        faces = self._detect(detection_image, upsample_times)
+        if len(faces) == 0 and self.retry_full_resolution:
+            return self._detect(image, upsample_times)
+        return [self._scale_rect(face, 1/scale) for face in faces]
+
+    def _detection_image(self, image:np.ndarray) -> tuple:
+        '''
+        Private method returning (image to run the detector on, its scale) as set by max_detection_dim
+        :param image: image arr 
+        '''
+        longest_side = max(image.shape[:2])
+        if self.max_detection_dim is None or longest_side <= self.max_detection_dim:
+            return image, 1.0
+        scale = self.max_detection_dim/longest_side
+        return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+    def _detect(self, image:np.ndarray, upsample_times:int)->list:
+        '''
+        Private method to run the face detector
+        :param image: image arr 
+        :param upsample_times: optionally upsample image prior to encoding  
+        '''
+        with self.profiler.stage('detect'):
+            faces = self.face_detector(image, upsample_times)
         if self.detector_type == 'cnn':
             rect_faces = [f.rect for f in faces] # convert mmod_rectangles to rectangles
             return rect_faces 
         return faces 
 
+    def _scale_rect(self, rect, scale:float):
+        '''
+        Private method to scale a dlib rectangle
+        :param rect: dlib rectangle
+        :param scale: scale factor
+        '''
+        return dlib.rectangle(int(round(rect.left()*scale)), int(round(rect.top()*scale)),
+            int(round(rect.right()*scale)), int(round(rect.bottom()*scale)))
+
     def get_face_data(self, file:str, upsample_times:int=0) -> FaceData:
         '''
         Returns a list of computed encodings for face(s) in an image
@@ -99,29 +288,178 @@ class Model:
             print(f'upsample_times must be >= 0')
             raise ValueError
         try:
-            image = cv2.imread(file)
+            image = self.read_image(file)
             faces = self.extract_faces(image, upsample_times)
-            face_encodings = list()
-            if len(faces) > 0:
-                for face in faces:
-                    pose_locations = self.shape_predictor(image, face)
-                    face_np_arr = dlib.get_face_chip(image, pose_locations)
-                    face_encodings.append(np.array(self.face_recognition_model.compute_face_descriptor(face_np_arr)))
+            pose_locations = self.extract_landmarks(image, faces)
+            face_encodings = self.compute_encodings(image, pose_locations)
+            self.profiler.record_image(len(face_encodings))
             return FaceData(face_encodings, faces)
-        except FileNotFoundError:
+        except FileNotFoundError as e:
             print(f"Img file '{file}' not found")
+            self.profiler.record_failure(file, e)
         except Exception as e:
             print(e)
+            self.profiler.record_failure(file, e)
+
+    def get_face_data_batch(self, files:list, upsample_times:int=0, batch_size:int=32) -> list:
+        '''
+        Returns the FaceData of each file (None for files that failed, like get_face_data).
+        Face chips of all files are encoded by the recognition network batch_size at a
+        time and, with the cnn detector, images of the same size are detected together
+        :param files: image file paths
+        :param upsample_times: optionally upsample images prior to encoding  
+        :param batch_size: max number of chips (or cnn detector images) per dlib call
+        '''
+        if not self._type_check('files', files, list) or \
+            not self._type_check('upsample_times', upsample_times, int) or \
+            not self._type_check('batch_size', batch_size, int):
+            raise TypeError
+        if upsample_times < 0 or batch_size < 1:
+            print(f'upsample_times must be >= 0 and batch_size >= 1')
+            raise ValueError
+        images = list()
+        for file in files:
+            try:
+                images.append(self.read_image(file))
+            except Exception as e:
+                print(e)
+                images.append(None)
+        if self.profiler.enabled:
+            for file, image in zip(files, images):
+                if image is None:
+                    self.profiler.record_failure(file, ValueError('image could not be read'))
+        faces = self.extract_faces_batch(images, upsample_times, batch_size, files)
+        chips, owners = list(), list()
+        for i, image in enumerate(images):
+            if faces[i] is None:
+                continue
+            try:
+                pose_locations = self.extract_landmarks(image, faces[i])
+                with self.profiler.stage('face_chip'):
+                    for pose_location in pose_locations:
+                        chips.append(dlib.get_face_chip(image, pose_location))
+                        owners.append(i)
+            except Exception as e:
+                print(e)
+                self.profiler.record_failure(files[i], e)
+                faces[i] = None
+        face_encodings = [list() for _ in files]
+        for start in range(0, len(chips), batch_size):
+            batch_chips, batch_owners = chips[start:start+batch_size], owners[start:start+batch_size]
+            try:
+                with self.profiler.stage('descriptor'):
+                    descriptors = self.face_recognition_model.compute_face_descriptor(batch_chips)
+            except Exception as e:
+                print(e)
+                descriptors = [None]*len(batch_chips)
+                for owner in set(batch_owners):
+                    self.profiler.record_failure(files[owner], e)
+                    faces[owner] = None
+            for owner, descriptor in zip(batch_owners, descriptors):
+                if faces[owner] is not None:
+                    face_encodings[owner].append(np.array(descriptor))
+        results = list()
+        for i in range(len(files)):
+            if faces[i] is None:
+                results.append(None)
+                continue
+            self.profiler.record_image(len(face_encodings[i]))
+            results.append(FaceData(face_encodings[i], faces[i]))
+        return results
+
+    def extract_faces_batch(self, images:list, upsample_times:int=0, batch_size:int=32, files:list=None) -> list:
+        '''
+        Returns the faces (rectangles) of each image, None for images that could not be processed.
+        The cnn detector is run on batches of same-sized images
+        :param images: list of image arrs (None entries allowed)
+        :param upsample_times: optionally upsample images prior to encoding  
+        :param batch_size: max number of images per cnn detector call
+        :param files: optional file path of each image, used to record failures
+        '''
+        if files is not None and len(files) != len(images):
+            print(f'files must have one entry per image')
+            raise ValueError
+        if files is None:
+            files = [f'images[{i}]' for i in range(len(images))]
+        faces = [None]*len(images)
+        if self.detector_type != 'cnn':
+            for i, image in enumerate(images):
+                if image is None:
+                    continue
+                try:
+                    faces[i] = self.extract_faces(image, upsample_times)
+                except Exception as e:
+                    print(e)
+                    self.profiler.record_failure(files[i], e)
+            return faces
+        groups, scales = dict(), dict()
+        for i, image in enumerate(images):
+            if image is None:
+                continue
+            detection_image, scales[i] = self._detection_image(image)
+            groups.setdefault(detection_image.shape, list()).append((i, detection_image))
+        for group in groups.values():
+            for start in range(0, len(group), batch_size):
+                batch = group[start:start+batch_size]
+                try:
+                    with self.profiler.stage('detect'):
+                        detections = self.face_detector([image for _, image in batch], upsample_times, batch_size=batch_size)
+                except Exception as e:
+                    print(e)
+                    for i, _ in batch:
+                        self.profiler.record_failure(files[i], e)
+                    continue
+                for (i, _), mmod_faces in zip(batch, detections):
+                    rects = [f.rect for f in mmod_faces] # convert mmod_rectangles to rectangles
+                    if scales[i] == 1.0:
+                        faces[i] = rects
+                    elif len(rects) == 0 and self.retry_full_resolution:
+                        faces[i] = self._detect(images[i], upsample_times)
+                    else:
+                        faces[i] = [self._scale_rect(rect, 1/scales[i]) for rect in rects]
+        return faces
+
+    def read_image(self, file:str) -> np.ndarray:
+        '''
+        Reads and decodes an image file, or the frame named by a video frame key
+        :param file: image file path or video frame key
+        '''
+        with self.profiler.stage('imread'):
+            return video_frames.read_key(file)
+
+    def extract_landmarks(self, image:np.ndarray, faces) -> list:
+        '''
+        Returns the 68 point pose locations of each face
+        :param image: image arr 
+        :param faces: face rectangles returned by extract_faces
+        '''
+        with self.profiler.stage('shape_predictor'):
+            return [self.shape_predictor(image, face) for face in faces]
+
+    def compute_encodings(self, image:np.ndarray, pose_locations:list) -> list:
+        '''
+        Returns the face encoding of each face
+        :param image: image arr 
+        :param pose_locations: pose locations returned by extract_landmarks
+        '''
+        face_encodings = list()
+        for pose_location in pose_locations:
+            with self.profiler.stage('face_chip'):
+                face_np_arr = dlib.get_face_chip(image, pose_location)
+            with self.profiler.stage('descriptor'):
+                face_encodings.append(np.array(self.face_recognition_model.compute_face_descriptor(face_np_arr)))
+        return face_encodings
 
     def compute_similarity(self, encodings_1:list, encodings_2:list)->list[Metrics]:
-        if not self._type_check('encodings_1', encodings_1, list) or \
-            not self._type_check('encodings_2', encodings_2, list):
+        if not self._type_check('encodings_1', encodings_1, (list, np.ndarray)) or \
+            not self._type_check('encodings_2', encodings_2, (list, np.ndarray)):
             raise TypeError
         if len(encodings_1) == 0 or len(encodings_2) == 0:
             return list()
         if len(encodings_1) > 1:
             print(f'query image must contain only one face')
             raise ValueError
+        encodings_1, encodings_2 = self._as_float64(encodings_1), self._as_float64(encodings_2)
         if not self._type_check('encodings_1[0]', encodings_1[0], np.ndarray) or \
             not self._type_check('encodings_2[0]', encodings_2[0], np.ndarray):
             raise TypeError
@@ -130,15 +468,22 @@ class Model:
             for encoding_2 in encodings_2:
                 euclidean_dist = norm(encodings_1[0]-encoding_2) # 0 is an exact match
                 cosine_sim = dot(encodings_1[0], encoding_2)/(norm(encodings_1[0])*norm(encoding_2)) # 1 is an exact match
-                metrics_list.append(Metrics(euclidean_dist, cosine_sim))
+                metrics_list.append(Metrics(euclidean_dist, np.clip(cosine_sim, 0.0, 1.0))) # clip rounding error
         except Exception as e:
             print(e)
         return metrics_list
 
+    def _as_float64(self, encodings) -> np.ndarray:
+        '''
+        Private method returning a list or array of encodings (e.g. FaceData.face_encodings,
+        which is float32) as a float64 (n_faces, dim) array, the precision Metrics expects
+        '''
+        return np.asarray(encodings, dtype=np.float64).reshape(len(encodings), -1)
+
     def test_similarity(self, encodings_1:list, encodings_2:list, euclidean_thres:float = 0.61, \
         cosine_thres:float = 0.92, silent:bool=False)->bool:
-        if not self._type_check('encodings_1', encodings_1, list) or \
-            not self._type_check('encodings_2', encodings_2, list) or \
+        if not self._type_check('encodings_1', encodings_1, (list, np.ndarray)) or \
+            not self._type_check('encodings_2', encodings_2, (list, np.ndarray)) or \
             not self._type_check('euclidean_thres', euclidean_thres, float) or \
             not self._type_check('cosine_thres', cosine_thres, float):
             raise TypeError
@@ -147,6 +492,7 @@ class Model:
         if len(encodings_1) > 1:
             print(f'query image: must contain only one face')
             raise ValueError
+        encodings_1, encodings_2 = self._as_float64(encodings_1), self._as_float64(encodings_2)
         if not self._type_check('encodings_1[0]', encodings_1[0], np.ndarray) or \
             not self._type_check('encodings_2[0]', encodings_2[0], np.ndarray):
             raise TypeError
@@ -170,35 +516,164 @@ class Model:
             print(e)
         return False
     
-    def find_similarities(self, query:str, data:typing.Dict[str, FaceData]):
+    def find_similarities(self, query:str, data:typing.Dict[str, FaceData], index=None):
+        '''
+        Compares the query image's face to every face in data with one batched
+        matrix product. Returns {(query, key): [Metrics per face in key]}
+        :param query: key of the query image in data
+        :param data: dictionary of extracted face data
+        :param index: optional prebuilt search.EmbeddingIndex over data (built on the
+            fly if None), an ann.IVFIndex to only compare images in the lists
+            nearest to the query, or a quantization.QuantizedIndex to only compare
+            faces that may pass the default thresholds (0.6 euclidean / 0.92 cosine)
+        '''
         if not self._type_check('query', query, str) or \
-            not self._type_check('data', data, dict):
+            not self._type_check('data', data, collections.abc.Mapping):
             raise TypeError
         if not query in data:
             print(f"query: {query} not in data")
             raise KeyError
-        metrics_dict = dict()
         query_encoding = data[query].face_encodings
         if len(query_encoding) != 1:
             print(f'query image {query}: must contain exactly 1 face')
             raise ValueError
-        for key in data.keys():
-            if key == query:
+        if index is None:
+            index = search.EmbeddingIndex.from_face_data(data)
+        elif not self._type_check('index', index, (search.EmbeddingIndex, ann.IVFIndex, quantization.QuantizedIndex)):
+            raise TypeError
+        if isinstance(index, ann.IVFIndex):
+            flat, keys = index.flat, index.candidate_keys(query_encoding[0])
+            rows = np.concatenate([np.arange(flat.rows_for(k).start, flat.rows_for(k).stop) for k in keys]) \
+                if len(keys) > 0 else np.empty(0, dtype=np.int64)
+            euclid, cos = np.full(len(flat), np.inf, dtype=np.float32), np.zeros(len(flat), dtype=np.float32)
+            euclid[rows], cos[rows] = flat.score(query_encoding[0], rows)
+        elif isinstance(index, quantization.QuantizedIndex):
+            flat, rows = index.flat, index.candidates(query_encoding[0])
+            keys = dict.fromkeys(flat.row_info(row)[0] for row in rows)
+            euclid, cos = np.full(len(flat), np.inf, dtype=np.float32), np.zeros(len(flat), dtype=np.float32)
+            euclid[rows], cos[rows] = flat.score(query_encoding[0], rows)
+        else:
+            flat, keys = index, data.keys()
+            euclid, cos = flat.score(query_encoding[0])
+        euclid = euclid.astype(np.float64)
+        cos = np.clip(cos, 0.0, 1.0).astype(np.float64)
+        metrics_dict = dict()
+        for key in keys:
+            if key == query or data.get(key) is None:
                 continue
-            try:
-                encoding = data[key].face_encodings
-                metrics_list = self.compute_similarity(query_encoding, encoding)
-                metrics_dict[(query,key)] = metrics_list
-            except Exception as e:
-                print(e)
+            rows = flat.rows_for(key)
+            metrics_dict[(query,key)] = [Metrics(e, c) for e, c in zip(euclid[rows], cos[rows])]
         return metrics_dict
 
+    def search_similar(self, query:str, data:typing.Dict[str, FaceData], top_k:int, euclidean_thres:float = 0.6,
+        cosine_thres:float = 0.92, index=None) -> list:
+        '''
+        Returns the top_k faces most similar to the query image's face as a list of
+        search.Match ranked by sim_score, without building per-face Metrics
+        :param query: key of the query image in data
+        :param data: dictionary of extracted face data
+        :param top_k: max number of matches to return
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param index: optional prebuilt search.EmbeddingIndex, ann.IVFIndex or
+            quantization.QuantizedIndex over data. An exact index is built on the fly if None
+        '''
+        if not self._type_check('query', query, str) or \
+            not self._type_check('data', data, collections.abc.Mapping) or \
+            not self._type_check('top_k', top_k, int) or \
+            not self._type_check('euclidean_thres', euclidean_thres, float) or \
+            not self._type_check('cosine_thres', cosine_thres, float):
+            raise TypeError
+        if not query in data:
+            print(f"query: {query} not in data")
+            raise KeyError
+        query_encoding = data[query].face_encodings
+        if len(query_encoding) != 1:
+            print(f'query image {query}: must contain exactly 1 face')
+            raise ValueError
+        if index is None:
+            index = search.EmbeddingIndex.from_face_data(data)
+        return index.search(query_encoding[0], top_k, euclidean_thres, cosine_thres, exclude=query)
+
+    def search_similar_batch(self, queries:list, data:typing.Dict[str, FaceData], top_k:int,
+        euclidean_thres:float = 0.6, cosine_thres:float = 0.92, index=None) -> list:
+        '''
+        Searches for every face of many query images at once, e.g. all faces of a
+        group photo, scoring them against data in one matrix operation.
+        Returns, per query, a list with the top_k search.Match of each of its faces
+        :param queries: list of keys in data and/or FaceData of images not in data
+        :param data: dictionary of extracted face data
+        :param top_k: max number of matches to return per query face
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param index: optional prebuilt search.EmbeddingIndex, ann.IVFIndex or
+            quantization.QuantizedIndex over data. An exact index is built on the fly if None
+        '''
+        if not self._type_check('queries', queries, list) or \
+            not self._type_check('data', data, collections.abc.Mapping) or \
+            not self._type_check('top_k', top_k, int) or \
+            not self._type_check('euclidean_thres', euclidean_thres, float) or \
+            not self._type_check('cosine_thres', cosine_thres, float):
+            raise TypeError
+        encodings, exclude, counts = list(), list(), list()
+        for query in queries:
+            if isinstance(query, str):
+                if not query in data:
+                    print(f"query: {query} not in data")
+                    raise KeyError
+                face_data, key = data[query], query
+            elif isinstance(query, FaceData):
+                face_data, key = query, None
+            else:
+                print(f'!!! queries should hold str keys or FaceData not {type(query)}')
+                raise TypeError
+            query_encodings = face_data.face_encodings if face_data is not None else list()
+            encodings.extend(query_encodings)
+            exclude.extend([key]*len(query_encodings))
+            counts.append(len(query_encodings))
+        if index is None:
+            index = search.EmbeddingIndex.from_face_data(data)
+        matches = index.search_batch(encodings, top_k, euclidean_thres, cosine_thres, exclude) \
+            if len(encodings) > 0 else list()
+        results, start = list(), 0
+        for count in counts:
+            results.append(matches[start:start+count])
+            start += count
+        return results
+
+    def render_matches(self, query:str, matches:list, data:typing.Dict[str, FaceData]=None,
+        html_path:str='data/results.html', page_size:int=100, thumbnail_size:int=256) -> list:
+        '''
+        Renders the matches returned by search_similar as paginated HTML with cached thumbnails.
+        Returns the page paths
+        :param query: query image path
+        :param matches: list of search.Match
+        :param data: dictionary of extracted face data. If passed, the matched face is boxed in each thumbnail
+        :param html_path: path of the first page
+        :param page_size: images per page
+        :param thumbnail_size: longest side of the thumbnails. 0 embeds the full-size images
+        '''
+        self.renderer.set_query_image(query)
+        cache = None
+        if thumbnail_size > 0:
+            cache_dir = os.path.join(os.path.dirname(html_path), 'thumbnails')
+            if self.thumbnail_cache is None or self.thumbnail_cache.size != thumbnail_size or \
+                self.thumbnail_cache.cache_dir != cache_dir:
+                self.thumbnail_cache = thumbnails.ThumbnailCache(cache_dir, thumbnail_size)
+            cache = self.thumbnail_cache
+        def results():
+            for match in matches:
+                box = None
+                if data is not None and data.get(match.key) is not None:
+                    box = tuple(data[match.key].boxes[match.face_num].tolist())
+                yield match.key, match.sim_score, box
+        return self.renderer.render_pages(results(), html_path, page_size, cache)
 
     def render_similar_images(self, query:str, data:typing.Dict[str, FaceData], metrics_dict,
         top_k:int, euclidean_thres:float = 0.6, cosine_thres:float = 0.92):
 
         if not self._type_check('query', query, str) or \
-            not self._type_check('data', data, dict) or \
+            not self._type_check('data', data, collections.abc.Mapping) or \
             not self._type_check('distances', metrics_dict, dict) or \
             not self._type_check('top_k', top_k, int) or \
             not self._type_check('euclidean_thres', euclidean_thres, float) or \
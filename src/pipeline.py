@@ -0,0 +1,153 @@
+import queue
+import threading
+import model
+
+_DONE = object() # end of stream marker passed down the stages
+
+class ExtractionPipeline:
+    '''
+    Streams files through bounded stages so disk i/o and decoding overlap
+    with detection and encoding:
+        decode threads -> detect + landmarks thread -> descriptor thread
+    Files are pulled lazily from any iterable (e.g. FileHandler.iter_image_files)
+    so extraction starts before directory listing finishes, and the bounded
+    queues keep memory flat regardless of the folder size
+    '''
+    def __init__(self, model:model.Model, decode_threads:int=4, queue_size:int=16) -> None:
+        '''
+        :param model: model used for detection and encoding
+        :param decode_threads: number of threads reading and decoding images
+        :param queue_size: max number of images waiting between two stages
+        '''
+        if not self._type_check('decode_threads', decode_threads, int) or \
+            not self._type_check('queue_size', queue_size, int):
+            raise TypeError
+        if decode_threads < 1 or queue_size < 1:
+            print(f'decode_threads and queue_size must be >= 1')
+            raise ValueError
+        self.model = model
+        self.decode_threads = decode_threads
+        self.queue_size = queue_size
+
+    def run(self, files, upsample_times:int=0):
+        '''
+        Yields (file, FaceData) in completion order. FaceData is None for
+        files that could not be read or processed, like Model.get_face_data
+        :param files: iterable of image file paths
+        :param upsample_times: optionally upsample images prior to encoding
+        '''
+        if not self._type_check('upsample_times', upsample_times, int):
+            raise TypeError
+        if upsample_times < 0:
+            print(f'upsample_times must be >= 0')
+            raise ValueError
+        files = iter(files)
+        files_lock = threading.Lock()
+        stop = threading.Event()
+        decoded = queue.Queue(self.queue_size)
+        detected = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+
+        def put(q, item):
+            # gives up if the consumer stopped early so no thread blocks forever
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def decode():
+            while not stop.is_set():
+                with files_lock:
+                    file = next(files, _DONE)
+                if file is _DONE:
+                    break
+                try:
+                    image = self.model.read_image(file)
+                except Exception as e:
+                    print(f'!!! Failed to read {file}\n', e)
+                    image = None
+                if image is None:
+                    self.model.profiler.record_failure(file, ValueError('image could not be read'))
+                if not put(decoded, (file, image)):
+                    return
+            put(decoded, _DONE)
+
+        def detect():
+            remaining = self.decode_threads
+            while remaining > 0 and not stop.is_set():
+                item = get(decoded)
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                file, image = item
+                faces = pose_locations = None
+                if image is not None:
+                    try:
+                        faces = self.model.extract_faces(image, upsample_times)
+                        pose_locations = self.model.extract_landmarks(image, faces)
+                    except Exception as e:
+                        print(f'!!! Failed to detect faces in {file}\n', e)
+                        self.model.profiler.record_failure(file, e)
+                if not put(detected, (file, image, faces, pose_locations)):
+                    return
+            put(detected, _DONE)
+
+        def encode():
+            while True:
+                item = get(detected)
+                if item is _DONE:
+                    break
+                file, image, faces, pose_locations = item
+                face_data = None
+                if pose_locations is not None:
+                    try:
+                        face_data = model.FaceData(self.model.compute_encodings(image, pose_locations), faces)
+                        self.model.profiler.record_image(len(face_data.face_encodings))
+                    except Exception as e:
+                        print(f'!!! Failed to encode faces in {file}\n', e)
+                        self.model.profiler.record_failure(file, e)
+                if not put(results, (file, face_data)):
+                    return
+            put(results, _DONE)
+
+        threads = [threading.Thread(target=decode, daemon=True) for _ in range(self.decode_threads)]
+        threads += [threading.Thread(target=detect, daemon=True), threading.Thread(target=encode, daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
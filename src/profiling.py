@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import threading
+import collections
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+class _NullStage:
+    '''
+    Shared no-op context manager returned by a disabled Profiler
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    '''
+    Context manager timing one run of a stage
+    '''
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler:'Profiler', name:str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profiler.observe(self.name, time.perf_counter()-self.start)
+
+class Profiler:
+    '''
+    Per-stage timers (histograms), counters and recent errors of the extraction path,
+    pushed to pluggable sinks on flush. A disabled profiler (the default for Model
+    and Driver) only costs an attribute check per call
+    '''
+    def __init__(self, enabled:bool=True, sinks:list=None, max_errors:int=100) -> None:
+        '''
+        :param enabled: record anything at all
+        :param sinks: list of sinks (JsonFileSink, CallbackSink, PrometheusTextSink) written on flush
+        :param max_errors: number of most recent errors kept
+        '''
+        if not self._type_check('enabled', enabled, bool) or \
+            (sinks is not None and not self._type_check('sinks', sinks, list)):
+            raise TypeError
+        self.enabled = enabled
+        self.sinks = sinks or list()
+        self._lock = threading.Lock()
+        self._max_errors = max_errors
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = collections.Counter()
+            self.timers = dict() # stage -> [count, sum of seconds, per-bucket counts]
+            self.errors = collections.deque(maxlen=self._max_errors)
+
+    def stage(self, name:str):
+        '''
+        Returns a context manager timing a stage, e.g. `with profiler.stage("detect"):`
+        :param name: stage name
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def observe(self, name:str, seconds:float) -> None:
+        '''
+        Records one run of a stage
+        :param name: stage name
+        :param seconds: duration
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, [0]*len(BUCKETS)]
+            timer[0] += 1
+            timer[1] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer[2][i] += 1
+                    break
+
+    def count(self, name:str, n:int=1) -> None:
+        '''
+        :param name: counter name
+        :param n: increment
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+
+    def record_image(self, n_faces:int) -> None:
+        '''
+        Counts an image that was processed successfully
+        :param n_faces: number of faces found in it
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters['images'] += 1
+            self.counters['faces_found'] += n_faces
+            if n_faces == 0:
+                self.counters['zero_face_images'] += 1
+
+    def record_failure(self, file:str, error:Exception) -> None:
+        '''
+        Counts an image that could not be processed and keeps the error
+        :param file: image file path
+        :param error: raised exception
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters['failures'] += 1
+            self.errors.append({'file': file, 'error': repr(error), 'time': time.time()})
+
+    def snapshot(self) -> dict:
+        '''
+        Returns the counters, per-stage timer histograms and recent errors as a json-able dict
+        '''
+        with self._lock:
+            timers = dict()
+            for name, (count, total, buckets) in self.timers.items():
+                cumulative, running = list(), 0
+                for bound, n in zip(BUCKETS, buckets):
+                    running += n
+                    cumulative.append(['+Inf' if bound == float('inf') else bound, running])
+                timers[name] = {'count': count, 'sum_s': total, 'mean_s': total/count if count else 0.0,
+                    'buckets': cumulative}
+            return {'counters': dict(self.counters), 'timers': timers, 'errors': list(self.errors)}
+
+    def merge(self, snapshot:dict) -> None:
+        '''
+        Adds a snapshot taken elsewhere, e.g. in an extraction pool worker
+        :param snapshot: dict returned by snapshot
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters.update(snapshot['counters'])
+            for name, timer in snapshot['timers'].items():
+                mine = self.timers.get(name)
+                if mine is None:
+                    mine = self.timers[name] = [0, 0.0, [0]*len(BUCKETS)]
+                mine[0] += timer['count']
+                mine[1] += timer['sum_s']
+                previous = 0
+                for i, (_, cumulative) in enumerate(timer['buckets']):
+                    mine[2][i] += cumulative-previous
+                    previous = cumulative
+            self.errors.extend(snapshot['errors'])
+
+    def flush(self) -> dict:
+        '''
+        Writes a snapshot to every sink and returns it
+        '''
+        snapshot = self.snapshot()
+        if self.enabled:
+            for sink in self.sinks:
+                try:
+                    sink.write(snapshot)
+                except Exception as e:
+                    print(f'!!! Profiler sink {type(sink).__name__} failed\n', e)
+        return snapshot
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
+
+class JsonFileSink:
+    '''
+    Writes each snapshot as json
+    '''
+    def __init__(self, path:str) -> None:
+        '''
+        :param path: output json path
+        '''
+        self.path = path
+
+    def write(self, snapshot:dict) -> None:
+        with open(self.path, 'w') as file:
+            json.dump(snapshot, file, indent=2)
+
+class CallbackSink:
+    '''
+    Passes each snapshot to a callable
+    '''
+    def __init__(self, callback) -> None:
+        '''
+        :param callback: called with the snapshot dict
+        '''
+        self.callback = callback
+
+    def write(self, snapshot:dict) -> None:
+        self.callback(snapshot)
+
+class PrometheusTextSink:
+    '''
+    Writes each snapshot in the Prometheus text exposition format, e.g. for the
+    node_exporter textfile collector
+    '''
+    def __init__(self, path:str, prefix:str='face_search') -> None:
+        '''
+        :param path: output .prom path
+        :param prefix: metric name prefix
+        '''
+        self.path = path
+        self.prefix = prefix
+
+    def format(self, snapshot:dict) -> str:
+        '''
+        :param snapshot: dict returned by Profiler.snapshot
+        '''
+        lines = list()
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            lines.append(f'{self.prefix}_{name}_total {value}')
+        metric = f'{self.prefix}_stage_seconds'
+        if len(snapshot['timers']) > 0:
+            lines.append(f'# TYPE {metric} histogram')
+        for stage, timer in sorted(snapshot['timers'].items()):
+            for bound, cumulative in timer['buckets']:
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {timer["sum_s"]}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {timer["count"]}')
+        return '\n'.join(lines)+'\n'
+
+    def write(self, snapshot:dict) -> None:
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.format(snapshot))
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,469 @@
+import os
+import json
+import numpy as np
+import search
+
+MODES = ('float16', 'int8', 'pq')
+
+class Float16Codec:
+    '''
+    Stores every encoding as float16 (256 bytes per face)
+    '''
+    mode = 'float16'
+
+    def train(self, vectors:np.ndarray, **kwargs) -> None:
+        pass
+
+    def encode(self, vectors:np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32).astype(np.float16)
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32)
+
+    def dots(self, codes:np.ndarray, query:np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) @ query
+
+    def params(self) -> dict:
+        return dict()
+
+    def set_params(self, params:dict) -> None:
+        pass
+
+class Int8Codec:
+    '''
+    Scalar quantization of every dimension to 256 levels between its min and
+    max over the training vectors (128 bytes per face)
+    '''
+    mode = 'int8'
+
+    def __init__(self) -> None:
+        self.low = None
+        self.scale = None
+
+    def train(self, vectors:np.ndarray, **kwargs) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.low = vectors.min(axis=0)
+        self.scale = np.maximum((vectors.max(axis=0)-self.low)/255, np.finfo(np.float32).tiny)
+
+    def encode(self, vectors:np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32)-self.low)/self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return self.low + codes.astype(np.float32)*self.scale
+
+    def dots(self, codes:np.ndarray, query:np.ndarray) -> np.ndarray:
+        return np.float32(self.low @ query) + codes.astype(np.float32) @ (query*self.scale)
+
+    def params(self) -> dict:
+        return {'low': self.low, 'scale': self.scale}
+
+    def set_params(self, params:dict) -> None:
+        self.low, self.scale = params['low'], params['scale']
+
+class PQCodec:
+    '''
+    Product quantization: every encoding is split into n_subspaces sub-vectors,
+    each stored as the id of its nearest of 256 k-means centroids (n_subspaces
+    bytes per face). Queries are scored with per-subspace lookup tables
+    '''
+    mode = 'pq'
+
+    def __init__(self, n_subspaces:int=16) -> None:
+        self.n_subspaces = n_subspaces
+        self.codebooks = None # (n_subspaces, n_centroids, sub_dim)
+
+    def train(self, vectors:np.ndarray, n_iter:int=20, seed:int=0, max_points:int=65536, **kwargs) -> None:
+        rng = np.random.default_rng(seed)
+        n, dim = vectors.shape
+        if dim % self.n_subspaces != 0:
+            print(f'n_subspaces must divide the encoding length {dim}. Got: {self.n_subspaces}')
+            raise ValueError
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, max_points), replace=False))], dtype=np.float32)
+        n_centroids = min(256, len(sample))
+        sub_dim = dim//self.n_subspaces
+        self.codebooks = np.empty((self.n_subspaces, n_centroids, sub_dim), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            sub = sample[:, j*sub_dim:(j+1)*sub_dim]
+            centroids = sub[rng.choice(len(sub), n_centroids, replace=False)].copy()
+            for _ in range(n_iter):
+                labels = self._nearest(sub, centroids)
+                counts = np.bincount(labels, minlength=n_centroids)
+                sums = np.stack([np.bincount(labels, weights=sub[:, d], minlength=n_centroids)
+                    for d in range(sub_dim)], axis=1)
+                filled = counts > 0
+                centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+                empty = np.flatnonzero(~filled)
+                if len(empty) > 0: # restart empty centroids on random points
+                    centroids[empty] = sub[rng.choice(len(sub), len(empty), replace=False)]
+            self.codebooks[j] = centroids
+
+    def _nearest(self, vectors:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        return np.argmin((centroids*centroids).sum(axis=1) - 2*(vectors @ centroids.T), axis=1)
+
+    def encode(self, vectors:np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        sub_dim = self.codebooks.shape[2]
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            codes[:, j] = self._nearest(vectors[:, j*sub_dim:(j+1)*sub_dim], self.codebooks[j])
+        return codes
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.n_subspaces)], axis=1)
+
+    def dots(self, codes:np.ndarray, query:np.ndarray) -> np.ndarray:
+        sub_dim = self.codebooks.shape[2]
+        tables = np.einsum('jcd,jd->jc', self.codebooks, query.reshape(self.n_subspaces, sub_dim))
+        dots = np.zeros(len(codes), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            dots += tables[j][codes[:, j]]
+        return dots
+
+    def params(self) -> dict:
+        return {'codebooks': self.codebooks}
+
+    def set_params(self, params:dict) -> None:
+        self.codebooks = params['codebooks']
+        self.n_subspaces = len(self.codebooks)
+
+def make_codec(mode:str, n_subspaces:int=16):
+    '''
+    :param mode: "float16", "int8" or "pq"
+    :param n_subspaces: pq sub-vectors (bytes) per encoding
+    '''
+    if mode == 'float16':
+        return Float16Codec()
+    if mode == 'int8':
+        return Int8Codec()
+    if mode == 'pq':
+        return PQCodec(n_subspaces)
+    print(f'mode must be one of {MODES}. Got: {mode}')
+    raise ValueError
+
+class QuantizedIndex:
+    '''
+    Keeps compressed codes of every face encoding in memory and the full precision
+    encodings on disk (e.g. the memory-mapped encoding block of a face store).
+    A query is scored against the codes first. Every face that could pass the
+    thresholds given its stored quantization error is then re-scored exactly
+    from disk, so threshold matches are the same as with an exact index.
+    Faces added later are kept in a small in-memory exact index (added) that every
+    search also scores, and removed faces are only marked, so the memory-mapped
+    matrix is never written or copied. attach moves the index onto a rewritten store.
+    Exposes the same search interface as search.EmbeddingIndex
+    '''
+    def __init__(self, flat:search.EmbeddingIndex, codec) -> None:
+        '''
+        :param flat: exact index over the full precision encodings. Its matrix should be memory-mapped
+        :param codec: trained Float16Codec, Int8Codec or PQCodec
+        '''
+        if not self._type_check('flat', flat, search.EmbeddingIndex):
+            raise TypeError
+        self.flat = flat
+        self.codec = codec
+        self.added = search.EmbeddingIndex(flat.dim) # faces added since the codes were built
+        self.codes, self.errors = self._encode_rows(np.arange(len(flat))) # errors: norm of the quantization error of every row
+
+    @classmethod
+    def build(cls, flat:search.EmbeddingIndex, mode:str='int8', n_subspaces:int=16, codec=None,
+        n_iter:int=20, seed:int=0) -> 'QuantizedIndex':
+        '''
+        Trains a codec on the encodings of an exact index and encodes them all
+        :param flat: exact index holding the encodings
+        :param mode: "float16", "int8" or "pq"
+        :param n_subspaces: pq sub-vectors (bytes) per encoding
+        :param codec: already trained codec to reuse. mode and n_subspaces are ignored
+        :param n_iter: pq k-means iterations
+        :param seed: random seed
+        '''
+        if codec is None:
+            if len(flat) == 0:
+                print(f'!!! Cannot train a QuantizedIndex without encodings')
+                raise ValueError
+            codec = make_codec(mode, n_subspaces)
+            codec.train(flat.matrix, n_iter=n_iter, seed=seed)
+        return cls(flat, codec)
+
+    def __len__(self) -> int:
+        return len(self.flat) + len(self.added)
+
+    def __contains__(self, key) -> bool:
+        return key in self.flat or key in self.added
+
+    @property
+    def mode(self) -> str:
+        return self.codec.mode
+
+    def _encode_rows(self, rows:np.ndarray, block_size:int=65536) -> tuple:
+        '''
+        Private method returning (codes, errors) of rows of flat, read and encoded in memory-bounded blocks
+        '''
+        codes, errors = list(), list()
+        for block_start in range(0, len(rows), block_size):
+            block_rows = rows[block_start:block_start+block_size]
+            if len(block_rows) == block_rows[-1]-block_rows[0]+1: # contiguous rows are sliced, not gathered
+                block = np.asarray(self.flat.matrix[block_rows[0]:block_rows[-1]+1], dtype=np.float32)
+            else:
+                block = np.asarray(self.flat.matrix[block_rows], dtype=np.float32)
+            block_codes = self.codec.encode(block)
+            codes.append(block_codes)
+            # slightly inflated so float rounding never drops a borderline match
+            errors.append((np.linalg.norm(block-self.codec.decode(block_codes), axis=1)*1.001+1e-6).astype(np.float32))
+        if len(codes) == 0:
+            probe = self.codec.encode(np.zeros((1, self.flat.dim), dtype=np.float32))
+            codes, errors = [probe[:0]], [np.empty(0, dtype=np.float32)]
+        return np.concatenate(codes), np.concatenate(errors)
+
+    def add(self, key:str, encodings) -> None:
+        '''
+        Adds (or replaces) the encodings of an image. They are kept at full precision in
+        added until attach encodes them against the rewritten store
+        :param key: image key
+        :param encodings: list of encodings or a (n_faces, dim) array
+        '''
+        self.remove(key)
+        self.added.add(key, encodings)
+
+    def remove(self, key:str) -> bool:
+        '''
+        Removes the encodings of an image. Returns False if the key was not indexed
+        :param key: image key
+        '''
+        if self.added.remove(key):
+            if self.added.should_compact():
+                self.added.compact()
+            return True
+        return self.flat.remove(key)
+
+    def attach(self, flat:search.EmbeddingIndex) -> None:
+        '''
+        Moves the index onto a new exact index over the face data, e.g. over the face
+        store rewritten after a batch. Codes of faces that did not change are kept,
+        every other face of flat is read from it and encoded with the same codec
+        :param flat: exact index over the full precision encodings
+        '''
+        previous = {key: rows for key, rows in self.flat._key_rows.items() if key not in self.added}
+        self.codes, self.errors = self._remap(flat, previous, self.codes, self.errors)
+        self.flat = flat
+        self.added = search.EmbeddingIndex(flat.dim)
+
+    def _remap(self, flat:search.EmbeddingIndex, previous:dict, codes:np.ndarray, errors:np.ndarray) -> tuple:
+        '''
+        Private method returning (codes, errors) aligned with the rows of flat. Keys found in
+        previous (key -> [first row, number of rows] in codes) with as many faces reuse their codes
+        '''
+        old_flat, self.flat = self.flat, flat # _encode_rows reads from flat
+        try:
+            keys, _ = flat.key_counts()
+            reused, reused_from = list(), list()
+            for key in keys:
+                rows, old = flat.rows_for(key), previous.get(key)
+                if old is not None and old[1] == rows.stop-rows.start:
+                    reused.append(np.arange(rows.start, rows.stop))
+                    reused_from.append(np.arange(old[0], old[0]+old[1]))
+            reused = np.concatenate(reused) if len(reused) > 0 else np.empty(0, dtype=np.int64)
+            reused_from = np.concatenate(reused_from) if len(reused_from) > 0 else np.empty(0, dtype=np.int64)
+            missing = np.ones(len(flat), dtype=bool)
+            missing[reused] = False
+            missing = np.flatnonzero(missing)
+            new_codes, new_errors = np.empty((len(flat),) + codes.shape[1:], dtype=codes.dtype), \
+                np.zeros(len(flat), dtype=np.float32)
+            new_codes[reused], new_errors[reused] = codes[reused_from], errors[reused_from]
+            new_codes[missing], new_errors[missing] = self._encode_rows(missing)
+        finally:
+            self.flat = old_flat
+        return new_codes, new_errors
+
+    def approximate_dots(self, query_encoding, block_size:int=65536) -> np.ndarray:
+        '''
+        Returns the dot product of the query with every row of flat, computed from the codes
+        :param query_encoding: a single face encoding
+        :param block_size: rows decoded at once
+        '''
+        query = np.asarray(query_encoding, dtype=np.float32).reshape(-1)
+        dots = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), block_size):
+            dots[start:start+block_size] = self.codec.dots(self.codes[start:start+block_size], query)
+        return dots
+
+    def candidates(self, query_encoding, euclidean_thres:float=0.6, cosine_thres:float=0.92,
+        shortlist:int=None) -> np.ndarray:
+        '''
+        Returns the rows that may pass either threshold: those that pass when their dot
+        product with the query is raised by the largest error its quantization allows
+        :param query_encoding: a single face encoding
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param shortlist: optionally keep only this many rows with the best approximate
+            scores. Faster to re-rank but matches may be missed
+        '''
+        query = np.asarray(query_encoding, dtype=np.float32).reshape(-1)
+        query_norm = np.float32(np.sqrt(query @ query))
+        dots, norms = self.approximate_dots(query), self.flat.norms
+        bound = dots + query_norm*self.errors
+        euclid = np.sqrt(np.maximum(query_norm*query_norm + norms*norms - 2*bound, 0))
+        cos = bound / np.maximum(norms*query_norm, np.finfo(np.float32).tiny)
+        rows = self.flat.live_rows(np.flatnonzero((euclid <= euclidean_thres) | (cos >= cosine_thres)))
+        if shortlist is not None and shortlist < len(rows):
+            approx = np.sqrt(np.maximum(query_norm*query_norm + norms[rows]**2 - 2*dots[rows], 0)) + \
+                np.abs(dots[rows] / np.maximum(norms[rows]*query_norm, np.finfo(np.float32).tiny) - 1)
+            rows = np.sort(rows[np.argpartition(approx, shortlist-1)[:shortlist]]) if shortlist > 0 \
+                else rows[:0]
+        return rows
+
+    def search(self, query_encoding, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:str=None, shortlist:int=None) -> list:
+        '''
+        Returns the top_k matches ranked by exact sim_score, see search.EmbeddingIndex.search
+        :param query_encoding: a single face encoding
+        :param top_k: number of matches to return. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out (usually the query itself)
+        :param shortlist: optionally re-rank only this many candidates, see candidates
+        '''
+        matches = list()
+        if len(self.flat) > 0:
+            rows = self.candidates(query_encoding, euclidean_thres, cosine_thres, shortlist)
+            if exclude is not None and exclude in self.flat:
+                excluded = self.flat.rows_for(exclude)
+                rows = rows[(rows < excluded.start) | (rows >= excluded.stop)]
+            euclid, cos = self.flat.score(query_encoding, rows) # reads only the candidate rows from disk
+            mask = (euclid <= euclidean_thres) | (cos >= cosine_thres)
+            matches = self.flat.rank_rows(rows[mask], euclid[mask], cos[mask], top_k)
+        if len(self.added) > 0:
+            matches = sorted(matches + self.added.search(query_encoding, top_k, euclidean_thres,
+                cosine_thres, exclude), key=lambda match: match.sim_score)[:top_k]
+        return matches
+
+    def search_batch(self, query_encodings, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:list=None, shortlist:int=None) -> list:
+        '''
+        Returns a list with the matches of each query, see search
+        :param query_encodings: list of encodings or a (n_queries, dim) array
+        :param top_k: number of matches to return per query. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out per query (None entries allowed)
+        :param shortlist: optionally re-rank only this many candidates per query
+        '''
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, self.flat.dim)
+        if exclude is None:
+            exclude = [None]*len(queries)
+        return [self.search(q, top_k, euclidean_thres, cosine_thres, key, shortlist) for q, key in zip(queries, exclude)]
+
+    def memory_bytes(self) -> int:
+        '''
+        Returns the bytes held in memory per the codes, errors, norms, row maps and
+        added faces, leaving out the (memory-mapped) full precision matrix
+        '''
+        params = sum(np.asarray(v).nbytes for v in self.codec.params().values())
+        return self.codes.nbytes + self.errors.nbytes + params + \
+            self.flat.norms.nbytes + self.flat._row_key_ids[:len(self.flat)].nbytes + \
+            self.flat._row_faces[:len(self.flat)].nbytes + self.added.matrix.nbytes + self.added.norms.nbytes
+
+    def recall(self, sample_size:int=100, top_k:int=10, shortlist:int=None, seed:int=0) -> float:
+        '''
+        Returns the fraction of the exact top_k nearest faces that are also found when
+        only the shortlist best faces by approximate score are re-ranked, averaged over
+        a random sample of indexed faces used as queries. With shortlist=top_k this is
+        the recall of the codes alone
+        :param sample_size: number of query faces
+        :param top_k: neighbours compared per query
+        :param shortlist: candidates re-ranked per query. Defaults to top_k
+        :param seed: random seed
+        '''
+        live = self.flat.live_rows()
+        if len(live) == 0:
+            return 1.0
+        rng = np.random.default_rng(seed)
+        found = expected = 0
+        for row in rng.choice(live, min(sample_size, len(live)), replace=False):
+            query = np.array(self.flat.matrix[row])
+            key, _ = self.flat.row_info(row)
+            exact = self.flat.search(query, top_k, np.inf, -np.inf, exclude=key)
+            approx = self.search(query, top_k, np.inf, -np.inf, exclude=key, shortlist=shortlist or top_k)
+            exact_ids = {(m.key, m.face_num) for m in exact}
+            found += len(exact_ids & {(m.key, m.face_num) for m in approx})
+            expected += len(exact_ids)
+        return found/expected if expected > 0 else 1.0
+
+    def report(self, sample_size:int=100, top_k:int=10, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, seed:int=0) -> dict:
+        '''
+        Returns memory use and recall of this index as a json-able dict:
+        in-memory bytes per face against float32, recall@top_k of the codes alone,
+        and the number of candidates re-ranked per query at the given thresholds
+        :param sample_size: number of query faces
+        :param top_k: neighbours compared per query
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param seed: random seed
+        '''
+        live = self.flat.live_rows()
+        n = len(live)
+        rng = np.random.default_rng(seed)
+        candidates = [len(self.candidates(self.flat.matrix[row], euclidean_thres, cosine_thres))
+            for row in rng.choice(live, min(sample_size, n), replace=False)] if n > 0 else [0]
+        return {'mode': self.mode, 'n_faces': n, 'memory_mb': self.memory_bytes()/2**20,
+            'bytes_per_face': self.memory_bytes()/max(n, 1), 'float32_bytes_per_face': 4*self.flat.dim,
+            f'recall_at_{top_k}': self.recall(sample_size, top_k, seed=seed),
+            'mean_candidates': float(np.mean(candidates))}
+
+    def save(self, path:str) -> None:
+        '''
+        Saves the codec and the codes of flat (not the full precision encodings), e.g. next
+        to the face store as <face data path>.quant.npz. Faces still in added are not
+        saved: attach the index to the rewritten store first
+        :param path: output .npz path
+        '''
+        live = self.flat.live_rows() # in key order, like key_counts
+        keys, counts = self.flat.key_counts()
+        config = {'mode': self.mode, 'keys': keys}
+        params = {f'param_{k}': v for k, v in self.codec.params().items()}
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, codes=self.codes[live], errors=self.errors[live], counts=counts,
+            config=np.array(json.dumps(config)), **params)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path:str, flat:'search.EmbeddingIndex') -> 'QuantizedIndex':
+        '''
+        Loads the codes saved by save on top of the full precision encodings. Faces of
+        flat that were not saved (or changed since) are encoded again with the saved codec
+        :param path: .npz path written by save
+        :param flat: exact index over the full precision encodings
+        '''
+        with np.load(path) as file:
+            config = json.loads(str(file['config']))
+            codec = make_codec(config['mode'])
+            codec.set_params({k[6:]: file[k] for k in file.files if k.startswith('param_')})
+            codes, errors, saved_counts = file['codes'], file['errors'], file['counts']
+        index = cls.__new__(cls)
+        index.flat, index.codec = flat, codec
+        index.added = search.EmbeddingIndex(flat.dim)
+        keys, counts = flat.key_counts()
+        if flat.n_removed == 0 and keys == config['keys'] and np.array_equal(counts, saved_counts):
+            index.codes, index.errors = codes, errors
+            return index
+        saved_starts = np.cumsum(saved_counts) - saved_counts
+        previous = {key: (int(start), int(count)) for key, start, count in zip(config['keys'], saved_starts, saved_counts)}
+        index.codes, index.errors = index._remap(flat, previous, codes, errors)
+        return index
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
@@ -1,4 +1,8 @@
 import os
+import html
+import itertools
+import thumbnails
+import video_frames
 
 class Renderer:
     '''
@@ -57,10 +61,17 @@ class Renderer:
                     background-color: black;
                     color: white;
                 }}
-                .grid-item img {{
+                .grid-item img, .grid-item video {{
                     max-width: 100%;
                     max-height: 100%;
                 }}
+                .page-links {{
+                    margin-top: 20px;
+                }}
+                .page-links a {{
+                    color: white;
+                    margin: 0 10px;
+                }}
             </style>
         </head>
         <body>
@@ -73,19 +84,20 @@ class Renderer:
             <div class="grid-container">
                 {image_tags}
             </div>
+            {page_links}
         </body>
         </html>
         '''
         self.query_image = ''
-        self.image_tags = ''
+        self.image_tags = list()
     
     def set_query_image(self, path) -> None:
         '''
-        :param path: query image path
+        :param path: query image path or video frame key
         '''
         if not self._type_check('path', path, str):
             raise TypeError 
-        if not os.path.isfile(path):
+        if not os.path.isfile(video_frames.source_path(path)):
             raise FileNotFoundError
         self.query_image = path
 
@@ -97,18 +109,7 @@ class Renderer:
         '''
         if not self._type_check('path', path, str) or not self._type_check('score', score, float):
             raise TypeError 
-        if not os.path.isfile(path):
-            raise FileNotFoundError
-        self.image_tags =  f'''
-        {self.image_tags}
-            <div class="grid-item">
-                <img src="{path}" alt="Image">
-                <div class="caption" style="word-break: break-word;">
-                <a href= "{path}"> {path} </a>
-                <br>
-                <b> Score: {score} </b>
-                </div>
-            </div>'''
+        self.image_tags.append(self.image_tag(path, path, score))
 
     def render(self, html_path="data/results.html") -> None:
         '''
@@ -118,13 +119,124 @@ class Renderer:
         '''
         if not self._type_check('html_path', html_path, str):
             raise TypeError 
-        html_content = self.html_template.format(query_image=self.query_image, image_tags=self.image_tags)
+        html_content = self.html_template.format(query_image=self.query_image,
+            image_tags=''.join(self.image_tags), page_links='')
         try:
             with open(html_path, 'w+') as file:
                 file.write(html_content)
             print('HTML file written')
         except Exception as e:
             print(f'render fail:\n{e}')
+
+    def render_pages(self, results, html_path:str="data/results.html", page_size:int=100,
+        thumbnail_cache:thumbnails.ThumbnailCache=None, workers:int=8) -> list:
+        '''
+        Streams results into HTML pages of page_size images each, written tag by tag
+        (results.html, results-2.html, ...) and linked to each other. Returns the page paths
+        :param results: iterable of (image path, score) or (image path, score, face box)
+        :param html_path: path of the first page. Creates one if doesn't exist
+        :param page_size: images per page
+        :param thumbnail_cache: show cached thumbnails (with the face box drawn in) instead of
+            the full-size images. Images that no longer exist are left out
+        :param workers: threads creating thumbnails
+        '''
+        if not self._type_check('html_path', html_path, str) or \
+            not self._type_check('page_size', page_size, int):
+            raise TypeError
+        if page_size < 1:
+            print(f'page_size must be >= 1. Got: {page_size}')
+            raise ValueError
+        html_dir = os.path.dirname(html_path)
+        root, ext = os.path.splitext(html_path)
+        query_src = self.query_image
+        if thumbnail_cache is not None and query_src != '':
+            query_src = self._relative_src(thumbnail_cache.get(query_src) or query_src, html_dir)
+        results = iter(results)
+        pages, current = [html_path], 0
+        page = list(itertools.islice(results, page_size))
+        while True:
+            next_page = list(itertools.islice(results, page_size)) # read ahead to know if a next page exists
+            if len(next_page) > 0:
+                pages.append(f'{root}-{len(pages)+1}{ext}')
+            if thumbnail_cache is not None:
+                thumbs = thumbnail_cache.get_many([(r[0], r[2] if len(r) > 2 else None) for r in page], workers)
+            else:
+                thumbs = [r[0] for r in page]
+            head, tail = self.html_template.format(query_image=html.escape(query_src), image_tags='\0',
+                page_links=self._page_links(pages, current)).split('\0')
+            try:
+                with open(pages[current], 'w') as file:
+                    file.write(head)
+                    for result, thumb in zip(page, thumbs):
+                        if thumb is None:
+                            continue
+                        src = self._relative_src(thumb, html_dir) if thumbnail_cache is not None else thumb
+                        file.write(self.image_tag(src, result[0], float(result[1])))
+                    file.write(tail)
+            except Exception as e:
+                print(f'render fail:\n{e}')
+                return pages[:current]
+            if len(next_page) == 0:
+                break
+            page, current = next_page, current+1
+        print(f'HTML file written ({len(pages)} page{"s" if len(pages) > 1 else ""})')
+        return pages
+
+    def format_page(self, query_image:str, image_tags:list) -> str:
+        '''
+        Returns a single page as a string, e.g. to serve it instead of writing a file
+        :param query_image: src of the query image
+        :param image_tags: grid items returned by image_tag
+        '''
+        return self.html_template.format(query_image=html.escape(query_image), image_tags=''.join(image_tags),
+            page_links='')
+
+    def image_tag(self, src:str, path:str, score:float, href:str=None) -> str:
+        '''
+        Returns the grid item of one result
+        :param src: src of the displayed image (e.g. a thumbnail). A video frame key is
+            shown as a video paused at that frame
+        :param path: image path shown in the caption
+        :param score: similarity score for this image
+        :param href: link target of the caption. Defaults to path
+        '''
+        href = html.escape(href if href is not None else path)
+        is_frame = video_frames.parse_frame_key(src) is not None
+        src, path = html.escape(src), html.escape(path)
+        media = f'<video src="{src}" preload="metadata" muted></video>' if is_frame else \
+            f'<img src="{src}" alt="Image" loading="lazy">'
+        return f'''
+            <div class="grid-item">
+                {media}
+                <div class="caption" style="word-break: break-word;">
+                <a href= "{href}"> {path} </a>
+                <br>
+                <b> Score: {score} </b>
+                </div>
+            </div>'''
+
+    def _page_links(self, pages:list, current:int) -> str:
+        '''
+        Private method returning the previous/next links of a page
+        '''
+        if len(pages) == 1:
+            return ''
+        links = list()
+        if current > 0:
+            links.append(f'<a href="{html.escape(os.path.basename(pages[current-1]))}"> &laquo; Previous </a>')
+        links.append(f'Page {current+1}')
+        if current < len(pages)-1:
+            links.append(f'<a href="{html.escape(os.path.basename(pages[current+1]))}"> Next &raquo; </a>')
+        return f'<div class="page-links">{" ".join(links)}</div>'
+
+    def _relative_src(self, path:str, html_dir:str) -> str:
+        '''
+        Private method. Path of a thumbnail as seen from the HTML page
+        '''
+        try:
+            return os.path.relpath(path, html_dir or '.')
+        except ValueError: # e.g. another drive on Windows
+            return os.path.abspath(path)
     
     def _type_check(self, obj_name:str, obj, type)->bool:
         '''
@@ -0,0 +1,354 @@
+import typing
+import numpy as np
+
+class Match(typing.NamedTuple):
+    '''
+    A single face in the library that matched a query
+    '''
+    key: str
+    face_num: int
+    euclid_dist: float
+    cos_sim: float
+    sim_score: float
+
+class EmbeddingIndex:
+    '''
+    Keeps every face encoding of a face data dictionary in one contiguous
+    float32 matrix along with precomputed norms and a row -> (image key, face index)
+    map, so a query is answered with a single matrix product. Removed rows are
+    only marked as removed (their key id is -1) and skipped by searches until compact
+    drops them, so removing an image does not move every row after it
+    '''
+    def __init__(self, dim:int=128) -> None:
+        '''
+        :param dim: length of a face encoding
+        '''
+        if not self._type_check('dim', dim, int):
+            raise TypeError
+        if dim <= 0:
+            print(f'dim must be > 0. Got: {dim}')
+            raise ValueError
+        self.dim = dim
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+        self._row_key_ids = np.empty(0, dtype=np.int32)
+        self._row_faces = np.empty(0, dtype=np.int32)
+        self._size = 0
+        self._removed = 0 # number of removed rows not compacted yet
+        self.keys = list() # key id -> image key (None once removed)
+        self._key_ids = dict() # image key -> key id
+        self._key_rows = dict() # image key -> [first row, number of rows]
+
+    @classmethod
+    def from_face_data(cls, data:dict, dim:int=128) -> 'EmbeddingIndex':
+        '''
+        Builds an index from a dictionary of FaceData
+        :param data: dictionary of image key -> FaceData
+        :param dim: length of a face encoding
+        '''
+        keys, blocks = list(), list()
+        for key, face_data in data.items():
+            if face_data is None or len(face_data.face_encodings) == 0:
+                continue
+            keys.append(key)
+            blocks.append(np.asarray(face_data.face_encodings, dtype=np.float32).reshape(-1, dim))
+        if len(blocks) == 0:
+            return cls(dim)
+        return cls.from_arrays(keys, [len(b) for b in blocks], np.concatenate(blocks))
+
+    @classmethod
+    def from_arrays(cls, keys:list, counts, matrix:np.ndarray, norms:np.ndarray=None,
+        block_size:int=65536) -> 'EmbeddingIndex':
+        '''
+        Builds an index over an existing (n_faces, dim) matrix without copying it,
+        e.g. the memory-mapped encoding block of a face store
+        :param keys: image keys, in matrix row order
+        :param counts: number of faces (rows) of each key
+        :param matrix: float32 encodings of all keys stacked
+        :param norms: optional precomputed norm of every row (e.g. the store's norms.npy),
+            so the matrix is not read at all. Otherwise computed block_size rows at a time
+        :param block_size: rows read at once when computing the norms
+        '''
+        index = cls(matrix.shape[1])
+        counts = np.asarray(counts, dtype=np.int64)
+        keep = counts > 0
+        keys, counts = [k for k, c in zip(keys, keep) if c], counts[keep]
+        starts = (np.cumsum(counts) - counts).astype(np.int64)
+        index._matrix = matrix if matrix.dtype == np.float32 else matrix.astype(np.float32)
+        if norms is not None:
+            index._norms = norms if norms.dtype == np.float32 else norms.astype(np.float32)
+        else:
+            index._norms = np.empty(len(matrix), dtype=np.float32)
+            for start in range(0, len(matrix), block_size):
+                block = np.asarray(index._matrix[start:start+block_size])
+                index._norms[start:start+block_size] = np.sqrt(np.einsum('ij,ij->i', block, block))
+        index._row_key_ids = np.repeat(np.arange(len(keys), dtype=np.int32), counts)
+        index._row_faces = (np.arange(len(matrix)) - np.repeat(starts, counts)).astype(np.int32)
+        index._size = len(matrix)
+        index.keys = list(keys)
+        index._key_ids = {key: i for i, key in enumerate(keys)}
+        index._key_rows = {key: [int(starts[i]), int(counts[i])] for i, key in enumerate(keys)}
+        return index
+
+    def key_counts(self) -> tuple:
+        '''
+        Returns (image keys, number of rows of each key) in row order
+        '''
+        items = sorted(self._key_rows.items(), key=lambda item: item[1][0])
+        return [key for key, _ in items], np.array([rows[1] for _, rows in items], dtype=np.int64)
+
+    def __len__(self) -> int:
+        '''
+        Number of rows, including removed rows until compact
+        '''
+        return self._size
+
+    @property
+    def n_removed(self) -> int:
+        return self._removed
+
+    def live_mask(self) -> np.ndarray:
+        '''
+        Returns a boolean mask of the rows that were not removed
+        '''
+        return self._row_key_ids[:self._size] >= 0
+
+    def live_rows(self, rows:np.ndarray=None) -> np.ndarray:
+        '''
+        Returns the rows (of all rows, or of the passed rows) that were not removed
+        :param rows: optional candidate rows
+        '''
+        if rows is None:
+            return np.flatnonzero(self.live_mask()) if self._removed > 0 else np.arange(self._size)
+        return rows[self._row_key_ids[rows] >= 0] if self._removed > 0 else rows
+
+    def should_compact(self, min_rows:int=1024, ratio:float=0.25) -> bool:
+        '''
+        True once enough rows were removed that compacting is worth a full copy
+        :param min_rows: min number of removed rows
+        :param ratio: min fraction of removed rows
+        '''
+        return self._removed >= min_rows and self._removed >= ratio*self._size
+
+    def compact(self) -> np.ndarray:
+        '''
+        Drops the removed rows. Returns the old row numbers of the rows kept, in order,
+        so arrays aligned with the rows can be compacted the same way (arr[kept])
+        '''
+        kept = self.live_rows()
+        if self._removed == 0:
+            return kept
+        new_rows = np.cumsum(self.live_mask()) - 1
+        for name in ('_matrix', '_norms', '_row_key_ids', '_row_faces'):
+            setattr(self, name, np.asarray(getattr(self, name)[kept])) # a copy, also of a memory-mapped matrix
+        for rows in self._key_rows.values():
+            rows[0] = int(new_rows[rows[0]])
+        self._size, self._removed = len(kept), 0
+        return kept
+
+    def __contains__(self, key) -> bool:
+        return key in self._key_rows
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self._size]
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._norms[:self._size]
+
+    def _reserve(self, n_rows:int) -> None:
+        '''
+        Private method to grow the backing arrays (amortised doubling)
+        :param n_rows: number of rows that must fit
+        '''
+        capacity = len(self._matrix)
+        if n_rows <= capacity:
+            return
+        capacity = max(n_rows, 2*capacity, 1024)
+        for name in ('_matrix', '_norms', '_row_key_ids', '_row_faces'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def add(self, key:str, encodings) -> None:
+        '''
+        Adds (or replaces) the encodings of an image
+        :param key: image key
+        :param encodings: list of encodings or a (n_faces, dim) array
+        '''
+        if key in self._key_rows:
+            self.remove(key)
+        if encodings is None or len(encodings) == 0:
+            return
+        block = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        start, stop = self._size, self._size+len(block)
+        self._reserve(stop)
+        key_id = len(self.keys)
+        self.keys.append(key)
+        self._key_ids[key] = key_id
+        self._key_rows[key] = [start, len(block)]
+        self._matrix[start:stop] = block
+        self._norms[start:stop] = np.linalg.norm(block, axis=1)
+        self._row_key_ids[start:stop] = key_id
+        self._row_faces[start:stop] = np.arange(len(block))
+        self._size = stop
+
+    def remove(self, key:str) -> bool:
+        '''
+        Removes the encodings of an image by marking its rows as removed.
+        Returns False if the key was not indexed
+        :param key: image key
+        '''
+        if key not in self._key_rows:
+            return False
+        start, count = self._key_rows.pop(key)
+        self._row_key_ids[start:start+count] = -1
+        self._removed += count
+        self.keys[self._key_ids.pop(key)] = None
+        return True
+
+    def rows_for(self, key:str) -> slice:
+        '''
+        Returns the rows holding the encodings of an image
+        :param key: image key
+        '''
+        start, count = self._key_rows.get(key, (0, 0))
+        return slice(start, start+count)
+
+    def row_info(self, row:int) -> tuple:
+        '''
+        Returns (image key, face index) of a row, (None, -1) for a removed row
+        :param row: matrix row
+        '''
+        key_id = self._row_key_ids[row]
+        if key_id < 0:
+            return None, -1
+        return self.keys[key_id], int(self._row_faces[row])
+
+    def score(self, query_encoding, rows:np.ndarray=None) -> tuple:
+        '''
+        Returns (euclidean distances, cosine similarities) of the query against every row
+        :param query_encoding: a single face encoding
+        :param rows: optionally only score these rows
+        '''
+        query = np.asarray(query_encoding, dtype=np.float32).reshape(-1)
+        if query.shape[0] != self.dim:
+            print(f'query encoding must have length {self.dim}. Got: {query.shape[0]}')
+            raise ValueError
+        matrix, norms = self.matrix, self.norms
+        if rows is not None:
+            matrix, norms = matrix[rows], norms[rows]
+        dots = matrix @ query
+        query_norm = np.float32(np.sqrt(query @ query))
+        euclid = np.sqrt(np.maximum(query_norm*query_norm + norms*norms - 2*dots, 0))
+        cos = dots / np.maximum(norms*query_norm, np.finfo(np.float32).tiny)
+        return euclid, cos
+
+    def rank_rows(self, rows:np.ndarray, euclid:np.ndarray, cos:np.ndarray, top_k) -> list:
+        '''
+        Ranks candidate rows by sim_score and returns them as matches
+        :param rows: candidate rows
+        :param euclid: euclidean distance per candidate row
+        :param cos: cosine similarity per candidate row
+        :param top_k: keep only the top_k best rows if not None
+        '''
+        scores = euclid + np.abs(cos-1)
+        if top_k is not None and top_k < len(rows):
+            part = np.argpartition(scores, top_k-1)[:top_k] if top_k > 0 else np.empty(0, dtype=np.int64)
+            rows, euclid, cos, scores = rows[part], euclid[part], cos[part], scores[part]
+        order = np.lexsort((rows, scores)) # ties keep insertion (dict) order
+        matches = list()
+        for i in order:
+            key, face_num = self.row_info(rows[i])
+            matches.append(Match(key, face_num, float(euclid[i]), float(cos[i]), float(scores[i])))
+        return matches
+
+    def search(self, query_encoding, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:str=None) -> list:
+        '''
+        Returns the top_k matches ranked by sim_score (lower is more similar).
+        A face matches if it passes either threshold, like Model.render_similar_images
+        :param query_encoding: a single face encoding
+        :param top_k: number of matches to return. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out (usually the query itself)
+        '''
+        if top_k is not None:
+            if not self._type_check('top_k', top_k, int):
+                raise TypeError
+            if top_k < 0:
+                print(f'top_k must be >= 0')
+                raise ValueError
+        if self._size == 0:
+            return list()
+        euclid, cos = self.score(query_encoding)
+        mask = (euclid <= euclidean_thres) | (cos >= cosine_thres)
+        if self._removed > 0:
+            mask &= self.live_mask()
+        if exclude is not None and exclude in self._key_rows:
+            mask[self.rows_for(exclude)] = False
+        rows = np.flatnonzero(mask)
+        return self.rank_rows(rows, euclid[rows], cos[rows], top_k)
+
+    def search_batch(self, query_encodings, top_k:int=None, euclidean_thres:float=0.6,
+        cosine_thres:float=0.92, exclude:list=None, block_size:int=256) -> list:
+        '''
+        Answers many queries with one matrix product per block of queries.
+        Returns a list with the matches of each query, see search
+        :param query_encodings: list of encodings or a (n_queries, dim) array
+        :param top_k: number of matches to return per query. All matches if None
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        :param exclude: optional image key to leave out per query (None entries allowed)
+        :param block_size: queries scored at once. Peak memory is ~block_size*len(self) floats
+        '''
+        if top_k is not None:
+            if not self._type_check('top_k', top_k, int):
+                raise TypeError
+            if top_k < 0:
+                print(f'top_k must be >= 0')
+                raise ValueError
+        queries = np.asarray(query_encodings, dtype=np.float32).reshape(-1, self.dim)
+        if exclude is not None and len(exclude) != len(queries):
+            print(f'exclude must have one entry per query')
+            raise ValueError
+        if self._size == 0:
+            return [list() for _ in range(len(queries))]
+        matrix, norms = self.matrix, self.norms
+        live = self.live_mask() if self._removed > 0 else None
+        results = list()
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start+block_size]
+            dots = block @ matrix.T
+            query_norms = np.sqrt((block*block).sum(axis=1))[:, None]
+            euclid = np.sqrt(np.maximum(query_norms*query_norms + norms*norms - 2*dots, 0))
+            cos = dots / np.maximum(norms*query_norms, np.finfo(np.float32).tiny)
+            mask = (euclid <= euclidean_thres) | (cos >= cosine_thres)
+            if live is not None:
+                mask &= live[None, :]
+            for i in range(len(block)):
+                key = exclude[start+i] if exclude is not None else None
+                if key is not None and key in self._key_rows:
+                    mask[i, self.rows_for(key)] = False
+                rows = np.flatnonzero(mask[i])
+                results.append(self.rank_rows(rows, euclid[i, rows], cos[i, rows], top_k))
+        return results
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
@@ -0,0 +1,412 @@
+'''
+Long-running local query service. Loads the face data, the search index and
+the dlib models once, then answers queries over HTTP on localhost:
+
+    GET  /search?key=<stored image key>&top_k=10&format=json|html
+    POST /search?top_k=10&format=json|html   (body: an image, raw or multipart/form-data)
+    GET  /health
+
+usage (from the root directory of this repo):
+    python src/server.py path/to/faces.fstore --port 8765
+    curl 'http://127.0.0.1:8765/search?key=/photos/a.jpg&top_k=5'
+    curl --data-binary @query.jpg 'http://127.0.0.1:8765/search?format=html' > results.html
+'''
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import mimetypes
+import collections
+import email.parser
+import email.policy
+import urllib.parse
+import concurrent.futures
+import cv2
+import thumbnails
+import video_frames
+from main import Driver
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+UPLOAD_FORM = '''<!DOCTYPE html>
+<html><body style="background-color: black; color: white; font-family: sans-serif">
+<form action="/search?format=html" method="post" enctype="multipart/form-data">
+<input type="file" name="image" accept="image/*"> <input type="number" name="top_k" value="10" min="1">
+<input type="submit" value="Search">
+</form></body></html>'''
+
+class ResultCache:
+    '''
+    Least recently used cache of query results
+    '''
+    def __init__(self, max_size:int=256) -> None:
+        '''
+        :param max_size: max number of cached results. 0 disables caching
+        '''
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key):
+        '''
+        Returns the cached result of key, or None
+        :param key: hashable query description
+        '''
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value) -> None:
+        '''
+        :param key: hashable query description
+        :param value: result
+        '''
+        if self.max_size <= 0:
+            return
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+class QueryServer:
+    '''
+    asyncio HTTP server answering similarity queries against a loaded Driver.
+    Searches run on a thread pool and uploaded images are extracted on a
+    separate one, so slow extractions never hold up queries by stored key
+    '''
+    def __init__(self, driver:Driver, host:str='127.0.0.1', port:int=8765, cache_size:int=256,
+        search_threads:int=4, max_upload_mb:int=32, upload_dir:str='data/uploads', thumbnail_size:int=256) -> None:
+        '''
+        :param driver: Driver holding the face data to search
+        :param host: interface to listen on. Keep the default to only accept local connections
+        :param port: TCP port
+        :param cache_size: number of recent query results kept
+        :param search_threads: number of threads running searches
+        :param max_upload_mb: largest accepted uploaded image
+        :param upload_dir: folder uploaded query images are kept in (named by content hash)
+        :param thumbnail_size: longest side of the thumbnails of html results
+        '''
+        if not self._type_check('driver', driver, Driver) or \
+            not self._type_check('host', host, str) or \
+            not self._type_check('port', port, int) or \
+            not self._type_check('cache_size', cache_size, int):
+            raise TypeError
+        self.driver = driver
+        self.host = host
+        self.port = port
+        self.cache = ResultCache(cache_size)
+        self.max_upload_bytes = max_upload_mb*2**20
+        self.upload_dir = upload_dir
+        self.thumbnail_cache = thumbnails.ThumbnailCache(os.path.join(upload_dir, 'thumbnails'), thumbnail_size)
+        self._search_pool = concurrent.futures.ThreadPoolExecutor(search_threads, thread_name_prefix='search')
+        self._extract_pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='extract')
+        self.queries = 0
+        self.started = time.time()
+        os.makedirs(upload_dir, exist_ok=True)
+
+    async def start(self) -> asyncio.AbstractServer:
+        '''
+        Loads the search index and the dlib models, then starts listening
+        '''
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await asyncio.gather(loop.run_in_executor(self._search_pool, self.driver.search_index),
+            loop.run_in_executor(self._extract_pool, self.driver.model.load_models))
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f'+++ Serving on http://{self.host}:{self.port} (ready in {time.perf_counter()-start:.1f} s)')
+        return server
+
+    def serve_forever(self) -> None:
+        '''
+        Runs the server until interrupted
+        '''
+        async def serve():
+            server = await self.start()
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._search_pool.shutdown(wait=False)
+            self._extract_pool.shutdown(wait=False)
+
+    async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        '''
+        Private method serving the requests of one connection (kept alive between requests)
+        '''
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except ValueError as e:
+                    await self._respond(writer, 413 if 'too large' in str(e) else 400, {'error': str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, path, params, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    status, payload = await self._route(method, path, params, headers, body)
+                except Exception as e:
+                    print(f'!!! {method} {path} failed\n', e)
+                    status, payload = 500, {'error': repr(e)}
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader:asyncio.StreamReader) -> tuple:
+        '''
+        Private method returning (method, path, query params, headers, body), or None once
+        the client closed the connection
+        '''
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError('malformed request line')
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_upload_bytes:
+            raise ValueError(f'request body too large ({length} bytes)')
+        body = await reader.readexactly(length) if length > 0 else b''
+        url = urllib.parse.urlsplit(target)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return method.upper(), url.path, params, headers, body
+
+    async def _respond(self, writer:asyncio.StreamWriter, status:int, payload, keep_alive:bool) -> None:
+        '''
+        Private method writing a response. payload is a dict (sent as json), a str (html)
+        or (content type, bytes)
+        '''
+        if isinstance(payload, dict):
+            content_type, body = 'application/json', json.dumps(payload).encode()
+        elif isinstance(payload, str):
+            content_type, body = 'text/html; charset=utf-8', payload.encode()
+        else:
+            content_type, body = payload
+        head = f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}\r\nContent-Type: {content_type}\r\n' \
+            f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def _route(self, method:str, path:str, params:dict, headers:dict, body:bytes) -> tuple:
+        '''
+        Private method returning (status, payload) of a request
+        '''
+        if path == '/search' and method == 'GET':
+            return await self._search(params, key=params.get('key'))
+        if path == '/search' and method == 'POST':
+            image, fields = self._upload_image(headers, body)
+            return await self._search({**fields, **params}, image=image)
+        if method != 'GET':
+            return 405, {'error': f'{method} is not supported'}
+        if path == '/health':
+            return 200, self.stats()
+        if path == '/':
+            return 200, UPLOAD_FORM
+        if path == '/image':
+            return await self._file(params.get('key'))
+        if path == '/upload':
+            upload_id = params.get('id', '')
+            if re.fullmatch(r'[0-9a-f]{40}', upload_id) is None:
+                return 404, {'error': 'unknown upload'}
+            return await self._file(os.path.join(self.upload_dir, upload_id), stored=False)
+        if path == '/thumb':
+            return await self._thumbnail(params.get('key'), params.get('face'))
+        return 404, {'error': f'{path} not found'}
+
+    def _upload_image(self, headers:dict, body:bytes) -> tuple:
+        '''
+        Private method returning (image bytes, form fields) of an upload
+        '''
+        content_type = headers.get('content-type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return body, dict()
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+        image, fields = b'', dict()
+        for part in message.iter_parts():
+            if part.get_filename() is not None:
+                image = part.get_payload(decode=True) or b''
+            elif part.get_param('name', header='content-disposition') is not None:
+                fields[part.get_param('name', header='content-disposition')] = part.get_content().strip()
+        return image, fields
+
+    async def _search(self, params:dict, key:str=None, image:bytes=None) -> tuple:
+        '''
+        Private method answering a query by stored key or uploaded image, from the cache if possible
+        '''
+        start = time.perf_counter()
+        try:
+            top_k = int(params.get('top_k', 10))
+            euclidean_thres = float(params.get('euclidean_thres', 0.6))
+            cosine_thres = float(params.get('cosine_thres', 0.92))
+        except ValueError as e:
+            return 400, {'error': f'invalid parameter: {e}'}
+        output = params.get('format', 'json')
+        if output not in ('json', 'html'):
+            return 400, {'error': 'format must be either "json" or "html"'}
+        if top_k < 1:
+            return 400, {'error': 'top_k must be >= 1'}
+        face_data_dict = self.driver.file_handler.face_data_dict
+        if image is not None:
+            if len(image) == 0:
+                return 400, {'error': 'no image uploaded'}
+            upload_id = hashlib.sha1(image).hexdigest()
+            query, query_src = f'upload:{upload_id}', f'/upload?id={upload_id}'
+        elif key is None:
+            return 400, {'error': 'pass a stored image key or upload an image'}
+        elif key not in face_data_dict:
+            return 404, {'error': f'{key} is not in the face data'}
+        else:
+            query, query_src = key, f'/image?key={urllib.parse.quote(key)}'
+        cache_key = (query, top_k, euclidean_thres, cosine_thres)
+        faces = self.cache.get(cache_key)
+        cached = faces is not None
+        if not cached:
+            loop = asyncio.get_running_loop()
+            if image is not None:
+                face_data = await loop.run_in_executor(self._extract_pool, self._extract_upload, upload_id, image)
+            else:
+                face_data = face_data_dict[key]
+            if face_data is None or len(face_data.encodings) == 0:
+                return 422, {'error': f'no face found in {query}'}
+            results = await loop.run_in_executor(self._search_pool, self.driver.search_batch,
+                [face_data if image is not None else key], top_k, euclidean_thres, cosine_thres)
+            faces = [{'box': box, 'matches': [m._asdict() for m in matches]}
+                for box, matches in zip(face_data.boxes.tolist(), results[0])]
+            self.cache.put(cache_key, faces)
+        self.queries += 1
+        if output == 'html':
+            return 200, self._render(query_src, faces)
+        return 200, {'query': query, 'faces': faces, 'cached': cached,
+            'elapsed_ms': (time.perf_counter()-start)*1000}
+
+    def _extract_upload(self, upload_id:str, image:bytes):
+        '''
+        Private method saving an uploaded image (once per content hash) and extracting its faces
+        '''
+        path = os.path.join(self.upload_dir, upload_id)
+        if not os.path.isfile(path):
+            with open(f'{path}.tmp', 'wb') as file:
+                file.write(image)
+            os.replace(f'{path}.tmp', path)
+        return self.driver.extract_faces(path)
+
+    def _render(self, query_src:str, faces:list) -> str:
+        '''
+        Private method rendering the matches of every query face as one html page of thumbnails
+        '''
+        matches = sorted((m for face in faces for m in face['matches']), key=lambda m: m['sim_score'])
+        renderer = self.driver.model.renderer
+        tags = [renderer.image_tag(f'/thumb?key={urllib.parse.quote(m["key"])}&face={m["face_num"]}', m['key'],
+            m['sim_score'], href=f'/image?key={urllib.parse.quote(m["key"])}') for m in matches]
+        return renderer.format_page(query_src, tags)
+
+    async def _file(self, path:str, stored:bool=True) -> tuple:
+        '''
+        Private method returning the bytes of a stored image (only keys of the face data
+        are served, video frames as jpeg) or of an uploaded image
+        '''
+        if path is None or (stored and path not in self.driver.file_handler.face_data_dict):
+            return 404, {'error': 'unknown image'}
+        loop = asyncio.get_running_loop()
+        is_frame = video_frames.parse_frame_key(path) is not None
+        try:
+            data = await loop.run_in_executor(self._search_pool, self._read_frame if is_frame else self._read_file, path)
+        except OSError:
+            return 404, {'error': 'image no longer exists'}
+        return 200, ('image/jpeg' if is_frame else mimetypes.guess_type(path)[0] or 'image/jpeg', data)
+
+    async def _thumbnail(self, key:str, face:str) -> tuple:
+        '''
+        Private method returning a cached thumbnail of a stored image with one face boxed in
+        '''
+        face_data = self.driver.file_handler.face_data_dict.get(key) if key is not None else None
+        if face_data is None:
+            return 404, {'error': 'unknown image'}
+        try:
+            box = tuple(face_data.boxes[int(face)].tolist()) if face is not None else None
+        except (ValueError, IndexError):
+            return 400, {'error': f'invalid face: {face}'}
+        loop = asyncio.get_running_loop()
+        thumb = await loop.run_in_executor(self._search_pool, self.thumbnail_cache.get, key, box)
+        if thumb is None:
+            return 404, {'error': 'image no longer exists'}
+        return 200, ('image/jpeg', await loop.run_in_executor(self._search_pool, self._read_file, thumb))
+
+    def _read_file(self, path:str) -> bytes:
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def _read_frame(self, key:str) -> bytes:
+        frame = video_frames.read_key(key)
+        if frame is None:
+            raise FileNotFoundError(key)
+        return cv2.imencode('.jpg', frame)[1].tobytes()
+
+    def stats(self) -> dict:
+        '''
+        Returns the number of indexed images, served queries and cache statistics
+        '''
+        return {'images': len(self.driver.file_handler.face_data_dict), 'queries': self.queries,
+            'uptime_s': time.time()-self.started, 'cache': {'size': len(self.cache),
+            'hits': self.cache.hits, 'misses': self.cache.misses}}
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('face_data', help='path to the face data (.fstore or .pbz2)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--detector-type', default='svm')
+    parser.add_argument('--cache-size', type=int, default=256, help='number of recent query results kept')
+    parser.add_argument('--search-threads', type=int, default=4)
+    parser.add_argument('--use-ann', action='store_true', help='search the saved approximate index')
+    parser.add_argument('--use-quantized', action='store_true', help='search the saved quantized index')
+    args = parser.parse_args()
+    driver = Driver(args.face_data, args.detector_type, use_ann=args.use_ann, use_quantized=args.use_quantized)
+    QueryServer(driver, args.host, args.port, args.cache_size, args.search_threads).serve_forever()
@@ -0,0 +1,417 @@
+'''
+Sharded face data: a collection of face data files (shards), e.g. one per photo
+root or per year, opened through one json manifest. Every shard is built on its
+own with batch_extract_faces, and queries fan out over all shards at once.
+
+usage (from the root directory of this repo):
+    python src/shards.py data/library.shards.json add 2023 2023.fstore --root /photos/2023
+    python src/shards.py data/library.shards.json build 2023
+    python src/shards.py data/library.shards.json search /photos/2023/a.jpg --top-k 10
+    python src/shards.py data/library.shards.json merge 2022 2023 --into 2022-2023
+    python src/shards.py data/library.shards.json split 2022-2023 --into 2022=/photos/2022 2023=/photos/2023
+    python src/shards.py data/library.shards.json list
+'''
+import os
+import json
+import heapq
+import shutil
+import argparse
+import concurrent.futures
+import model
+import face_store
+import video_frames
+from main import Driver
+
+SHARDS_VERSION = 1
+SIDECAR_SUFFIXES = ('ivf.npz', 'clusters.npz', 'quant.npz', 'phash.npz')
+
+class ShardSet:
+    '''
+    Shards listed in a json manifest:
+        {"version": 1, "shards": {"2023": {"path": "2023.fstore", "root": "/photos/2023"}, ...}}
+    Relative shard paths are relative to the manifest. Shards are opened as Drivers on
+    first use and share one model. Searches run on every shard's search index in a
+    thread pool (numpy releases the GIL while scoring) and the per-shard top_k of each
+    query face are merged into a global top_k
+    '''
+    def __init__(self, manifest_path:str, workers:int=None, detector_type:str='svm', **driver_kwargs) -> None:
+        '''
+        :param manifest_path: path to the shard manifest. Created on save if it does not exist
+        :param workers: number of search threads. None uses one per shard (up to the number of cores)
+        :param detector_type: "svm" or "cnn"
+        :param driver_kwargs: passed to the Driver of every shard, e.g. use_ann=True
+        '''
+        if not self._type_check('manifest_path', manifest_path, str) or \
+            not self._type_check('detector_type', detector_type, str):
+            raise TypeError
+        if workers is not None and (not self._type_check('workers', workers, int) or workers < 1):
+            print(f'workers must be >= 1. Got: {workers}')
+            raise ValueError
+        self.manifest_path = manifest_path
+        self.shards = dict()
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') != SHARDS_VERSION:
+                print(f'!!! Unsupported shard manifest version: {manifest.get("version")}')
+                raise ValueError
+            self.shards = manifest['shards']
+        self.workers = workers
+        self.detector_type = detector_type
+        self.driver_kwargs = driver_kwargs
+        self.model = None # model of the first opened shard, shared by all shards
+        self._drivers = dict()
+        self._pool = None
+
+    def __enter__(self) -> 'ShardSet':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def names(self) -> list:
+        return list(self.shards.keys())
+
+    def close(self) -> None:
+        '''
+        Shuts the search threads down
+        '''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def save(self) -> None:
+        '''
+        Writes the manifest, swapped in atomically
+        '''
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': SHARDS_VERSION, 'shards': self.shards}, file, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def shard_path(self, name:str) -> str:
+        '''
+        Returns the face data path of a shard
+        :param name: shard name
+        '''
+        if name not in self.shards:
+            print(f'!!! Unknown shard: {name}')
+            raise KeyError
+        path = self.shards[name]['path']
+        return path if os.path.isabs(path) else os.path.join(os.path.dirname(self.manifest_path), path)
+
+    def add_shard(self, name:str, path:str=None, root:str=None) -> None:
+        '''
+        Registers a shard. Its face data is created on its first build
+        :param name: shard name
+        :param path: face data path (.fstore or .pbz2), relative to the manifest. Defaults to <name>.fstore
+        :param root: optional folder of images the shard is built from
+        '''
+        if not self._type_check('name', name, str):
+            raise TypeError
+        if name in self.shards:
+            print(f'!!! Shard {name} already exists')
+            raise ValueError
+        self.shards[name] = {'path': path if path is not None else f'{name}.{face_store.STORE_SUFFIX}', 'root': root}
+        self.save()
+
+    def remove_shard(self, name:str, delete:bool=False) -> None:
+        '''
+        Unregisters a shard
+        :param name: shard name
+        :param delete: also delete its face data, manifest and indexes
+        '''
+        path = self.shard_path(name)
+        self._drivers.pop(name, None)
+        del self.shards[name]
+        self.save()
+        if delete:
+            _delete_face_data(path)
+
+    def driver(self, name:str) -> Driver:
+        '''
+        Returns the Driver of a shard, opened on first use
+        :param name: shard name
+        '''
+        if name not in self._drivers:
+            driver = Driver(self.shard_path(name), self.detector_type, **self.driver_kwargs)
+            if self.model is None:
+                self.model = driver.model
+            else:
+                driver.model = self.model # dlib models are loaded once for all shards
+            self._drivers[name] = driver
+        return self._drivers[name]
+
+    def build(self, name:str, dir_path:str=None, **kwargs) -> dict:
+        '''
+        Extracts the face data of one shard with batch_extract_faces. Returns its report
+        :param name: shard name
+        :param dir_path: folder of images. Defaults to the shard's root
+        :param kwargs: passed to batch_extract_faces, e.g. incremental=True
+        '''
+        dir_path = dir_path if dir_path is not None else self.shards.get(name, {}).get('root')
+        if dir_path is None:
+            print(f'!!! Shard {name} has no root. Pass dir_path')
+            raise ValueError
+        return self.driver(name).batch_extract_faces(dir_path, **kwargs)
+
+    def shard_of(self, key:str) -> str:
+        '''
+        Returns the name of the shard holding a key, or None
+        :param key: image key
+        '''
+        for name in self.shards.keys():
+            if key in self.driver(name).file_handler.face_data_dict:
+                return name
+        return None
+
+    def search(self, query, top_k:int, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> list:
+        '''
+        Returns the top_k faces of all shards most similar to the query's face, ranked by sim_score
+        :param query: key of a stored image, path of a new image or FaceData. Must hold exactly 1 face
+        :param top_k: max number of matches to return
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        '''
+        results = self.search_batch([query], top_k, euclidean_thres, cosine_thres)[0]
+        if len(results) != 1:
+            print(f'query image {query}: must contain exactly 1 face')
+            raise ValueError
+        return results[0]
+
+    def search_batch(self, queries:list, top_k:int, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> list:
+        '''
+        Searches for every face of many queries on every shard at once.
+        Returns, per query, a list with the global top_k search.Match of each of its faces
+        :param queries: list of stored image keys, paths of new images and/or FaceData
+        :param top_k: max number of matches to return per query face
+        :param euclidean_thres: max euclidean distance of a match
+        :param cosine_thres: min cosine similarity of a match
+        '''
+        if not self._type_check('queries', queries, list) or \
+            not self._type_check('top_k', top_k, int):
+            raise TypeError
+        encodings, exclude, counts = list(), list(), list()
+        for query in queries:
+            face_data, key = self._query_face_data(query)
+            query_encodings = face_data.face_encodings if face_data is not None else list()
+            encodings.extend(query_encodings)
+            exclude.extend([key]*len(query_encodings))
+            counts.append(len(query_encodings))
+        per_shard = list()
+        if len(encodings) > 0 and len(self.shards) > 0:
+            indexes = [self.driver(name).search_index() for name in self.shards.keys()]
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.workers or min(len(self.shards), os.cpu_count() or 1))
+            per_shard = list(self._pool.map(lambda index: index.search_batch(encodings, top_k, euclidean_thres,
+                cosine_thres, exclude), indexes))
+        merged = [self._merge_matches([matches[i] for matches in per_shard], top_k) for i in range(len(encodings))]
+        results, start = list(), 0
+        for count in counts:
+            results.append(merged[start:start+count])
+            start += count
+        return results
+
+    def _merge_matches(self, shard_matches:list, top_k:int) -> list:
+        '''
+        Private method merging the ranked matches of every shard into the global top_k.
+        A face found in more than one shard (overlapping roots, an interrupted merge
+        or split) is only kept once
+        '''
+        merged, seen = list(), set()
+        for match in heapq.merge(*shard_matches, key=lambda match: match.sim_score):
+            if (match.key, match.face_num) in seen:
+                continue
+            seen.add((match.key, match.face_num))
+            merged.append(match)
+            if len(merged) == top_k:
+                break
+        return merged
+
+    def _query_face_data(self, query) -> tuple:
+        '''
+        Private method returning (FaceData, key to exclude from the matches) of a query
+        '''
+        if isinstance(query, model.FaceData):
+            return query, None
+        if not self._type_check('query', query, str):
+            raise TypeError
+        name = self.shard_of(query)
+        if name is not None:
+            return self.driver(name).file_handler.face_data_dict[query], query
+        if not os.path.isfile(video_frames.source_path(query)):
+            print(f'query: {query} is not in any shard and not an image')
+            raise KeyError
+        if self.model is None:
+            self.driver(self.names()[0])
+        return self.model.get_face_data(query), query
+
+    def merge(self, names:list, into:str, path:str=None, delete:bool=True) -> None:
+        '''
+        Moves the face data and file manifests of shards into one shard and unregisters them.
+        The merged shards are only deleted once the shard receiving them is saved
+        :param names: shards to merge
+        :param into: shard receiving the data. Created (see add_shard) if it does not exist
+        :param path: face data path of a new into shard
+        :param delete: delete the face data of the merged shards
+        '''
+        if not self._type_check('names', names, list) or not self._type_check('into', into, str):
+            raise TypeError
+        created = into not in self.shards
+        if created:
+            roots = [self.shards[name].get('root') for name in names]
+            self.add_shard(into, path, os.path.commonpath(roots) if None not in roots else None)
+        target = self.driver(into)
+        sources = [name for name in names if name != into]
+        for name in sources:
+            source = self.driver(name).file_handler
+            target.file_handler.face_data_dict.update(source.face_data_dict)
+            target.file_handler.manifest.update(source.manifest.entries)
+        try:
+            self._save_shard(into)
+        except OSError:
+            if created:
+                self.remove_shard(into)
+            raise
+        for name in sources:
+            self.remove_shard(name, delete)
+        print(f'+++ Merged {", ".join(sources)} into {into}: {len(target.file_handler.face_data_dict)} keys')
+
+    def split(self, name:str, into:dict) -> None:
+        '''
+        Moves the keys of a shard that lie under given folders (video frames follow
+        their video) into other shards, created if they do not exist. Keys are only
+        removed from the shard once every other shard is saved
+        :param name: shard to split
+        :param into: dictionary of shard name -> folder whose images move to that shard
+        '''
+        if not self._type_check('name', name, str) or not self._type_check('into', into, dict):
+            raise TypeError
+        source = self.driver(name).file_handler
+        roots = {target: os.path.abspath(root) for target, root in into.items()}
+        moved = {target: dict() for target in into.keys()}
+        for key in list(source.face_data_dict.keys()):
+            target = self._target_of(video_frames.source_path(key), roots)
+            if target is not None and target != name:
+                moved[target][key] = source.face_data_dict.pop(key)
+        entries = {target: dict() for target in into.keys()}
+        for path, entry in list(source.manifest.entries.items()):
+            target = self._target_of(path, roots)
+            if target is not None and target != name:
+                entries[target][path] = entry
+                source.manifest.remove(path)
+        try:
+            for target in into.keys():
+                if target == name:
+                    continue
+                if target not in self.shards:
+                    self.add_shard(target, root=roots[target])
+                handler = self.driver(target).file_handler
+                handler.face_data_dict.update(moved[target])
+                handler.manifest.update(entries[target])
+                self._save_shard(target)
+                print(f'+++ Moved {len(moved[target])} keys of {name} to {target}')
+        except OSError:
+            self._drivers.pop(name, None) # the source keeps every key; copies already saved are deduplicated by search
+            raise
+        self._save_shard(name)
+
+    def _target_of(self, path:str, roots:dict) -> str:
+        '''
+        Private method returning the shard whose folder (the deepest one) holds path, or None
+        '''
+        path = os.path.abspath(path)
+        targets = [(len(root), target) for target, root in roots.items()
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep)]
+        return max(targets)[1] if len(targets) > 0 else None
+
+    def _save_shard(self, name:str) -> None:
+        '''
+        Private method saving a shard whose keys changed. Its saved indexes no longer
+        match the face data, so they are deleted and the shard is reopened without them.
+        Raises OSError if the face data could not be saved
+        '''
+        driver = self.driver(name)
+        if not driver.file_handler.save_face_data(silent=True):
+            self._drivers.pop(name, None) # drop the unsaved changes
+            print(f'!!! Could not save shard {name}')
+            raise OSError
+        stale = [f'{driver.file_handler.face_data_pkl}.{suffix}' for suffix in SIDECAR_SUFFIXES]
+        stale = [path for path in stale if os.path.isfile(path)]
+        for path in stale:
+            os.remove(path)
+        if len(stale) > 0:
+            print(f'+++ Deleted stale indexes of shard {name}; rebuild them on its Driver')
+        self._drivers.pop(name, None)
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
+
+def _delete_face_data(path:str) -> None:
+    '''
+    Deletes a face data file or store with its manifest, journal and indexes
+    '''
+    for target in [path, f'{path}.manifest.json', f'{path}.journal'] + [f'{path}.{s}' for s in SIDECAR_SUFFIXES]:
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.isfile(target):
+            os.remove(target)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='path to the shard manifest (.shards.json)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list')
+    add = commands.add_parser('add')
+    add.add_argument('name')
+    add.add_argument('path', nargs='?', help='face data path, relative to the manifest')
+    add.add_argument('--root', help='folder of images the shard is built from')
+    build = commands.add_parser('build')
+    build.add_argument('name')
+    build.add_argument('dir_path', nargs='?')
+    build.add_argument('--incremental', action='store_true')
+    build.add_argument('--include-sub-dirs', action='store_true')
+    query = commands.add_parser('search')
+    query.add_argument('query', help='stored image key or path of a new image')
+    query.add_argument('--top-k', type=int, default=10)
+    merge = commands.add_parser('merge')
+    merge.add_argument('names', nargs='+')
+    merge.add_argument('--into', required=True)
+    merge.add_argument('--path', help='face data path of a new shard')
+    merge.add_argument('--keep', action='store_true', help='keep the face data of the merged shards')
+    split = commands.add_parser('split')
+    split.add_argument('name')
+    split.add_argument('--into', nargs='+', required=True, metavar='NAME=FOLDER')
+    args = parser.parse_args()
+    with ShardSet(args.manifest) as shard_set:
+        if args.command == 'list':
+            for name in shard_set.names():
+                print(f'{name}: {shard_set.shard_path(name)} (root: {shard_set.shards[name].get("root")})')
+        elif args.command == 'add':
+            shard_set.add_shard(args.name, args.path, args.root)
+        elif args.command == 'build':
+            shard_set.build(args.name, args.dir_path, incremental=args.incremental,
+                include_sub_dirs=args.include_sub_dirs)
+        elif args.command == 'search':
+            for match in shard_set.search(args.query, args.top_k):
+                print(f'{match.sim_score:.4f} {match.key} (face {match.face_num})')
+        elif args.command == 'merge':
+            shard_set.merge(args.names, args.into, args.path, delete=not args.keep)
+        elif args.command == 'split':
+            shard_set.split(args.name, dict(target.split('=', 1) for target in args.into))
@@ -0,0 +1,91 @@
+import os
+import hashlib
+import threading
+import concurrent.futures
+import cv2
+import video_frames
+
+class ThumbnailCache:
+    '''
+    Small jpeg thumbnails cached on disk, keyed by image path + mtime (and the
+    drawn face box), so rendering the same images again is free. Keys of video
+    frames (video_frames.frame_key) are thumbnailed from the frame at their timestamp
+    '''
+    def __init__(self, cache_dir:str='data/thumbnails', size:int=256, quality:int=85) -> None:
+        '''
+        :param cache_dir: folder the thumbnails are written to. Created if it does not exist
+        :param size: longest side of a thumbnail in pixels
+        :param quality: jpeg quality
+        '''
+        if not self._type_check('cache_dir', cache_dir, str) or \
+            not self._type_check('size', size, int) or \
+            not self._type_check('quality', quality, int):
+            raise TypeError
+        if size < 1:
+            print(f'size must be >= 1. Got: {size}')
+            raise ValueError
+        self.cache_dir = cache_dir
+        self.size = size
+        self.quality = quality
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, path:str, box:tuple=None) -> str:
+        '''
+        Returns the path of the thumbnail of an image, creating it if needed.
+        Returns None if the image does not exist or cannot be read
+        :param path: image path or video frame key
+        :param box: optional (left, top, right, bottom) face box drawn on the thumbnail
+        '''
+        try:
+            mtime = os.stat(video_frames.source_path(path)).st_mtime_ns
+        except OSError:
+            return None
+        key = hashlib.sha1(f'{os.path.abspath(path)}|{mtime}|{self.size}|{box}'.encode()).hexdigest()
+        thumb_path = os.path.join(self.cache_dir, f'{key}.jpg')
+        if os.path.isfile(thumb_path):
+            return thumb_path
+        image = video_frames.read_key(path)
+        if image is None:
+            return None
+        if box is not None:
+            thickness = max(2, max(image.shape[:2])//200)
+            cv2.rectangle(image, (int(box[0]), int(box[1])), (int(box[2]), int(box[3])), (0, 255, 0), thickness)
+        scale = self.size/max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        tmp_path = f'{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp.jpg'
+        try:
+            if not cv2.imwrite(tmp_path, image, [cv2.IMWRITE_JPEG_QUALITY, self.quality]):
+                raise OSError(f'could not write {tmp_path}')
+            os.replace(tmp_path, thumb_path)
+        except (OSError, cv2.error) as e: # e.g. unwritable cache folder or full disk
+            print(f'!!! Could not cache the thumbnail of {path}\n', e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return None
+        return thumb_path
+
+    def get_many(self, items:list, workers:int=8) -> list:
+        '''
+        Returns the thumbnail path of each (path, box) item, created in parallel
+        :param items: list of (image path, face box or None)
+        :param workers: number of threads
+        '''
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(lambda item: self.get(*item), items))
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
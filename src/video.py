@@ -0,0 +1,230 @@
+import heapq
+import numpy as np
+import dlib
+import cv2
+import model
+import video_frames
+
+class Track:
+    '''
+    A face followed across sampled frames. Keeps the best chips_per_track
+    chips seen so far (largest, sharpest face) with enough context to encode them
+    '''
+    def __init__(self, track_id:int, box:tuple, timestamp:float) -> None:
+        self.track_id = track_id
+        self.box = box
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.missed = 0
+        self.chips = list() # min-heap of (quality, timestamp, box, crop, box in crop)
+
+    def offer(self, quality:float, timestamp:float, box:tuple, crop:np.ndarray, crop_box:tuple,
+        chips_per_track:int) -> None:
+        '''
+        Keeps the chip if it is among the best chips_per_track of this track
+        '''
+        chip = (quality, timestamp, box, crop, crop_box)
+        if len(self.chips) < chips_per_track:
+            heapq.heappush(self.chips, chip)
+        elif quality > self.chips[0][0]:
+            heapq.heapreplace(self.chips, chip)
+
+class VideoIngester:
+    '''
+    Extracts face data from videos without encoding every frame. Frames are sampled
+    adaptively: at most one every min_interval seconds, and only when the scene
+    changed noticeably since the last sampled frame (or max_interval passed).
+    Faces detected in sampled frames are tracked by IoU matching, and only the best
+    chips of each track are encoded. Results are keyed by video_frames.frame_key
+    '''
+    def __init__(self, model:model.Model, min_interval:float=0.5, max_interval:float=5.0,
+        scene_change:float=0.04, iou_threshold:float=0.3, max_missed:int=2, chips_per_track:int=1) -> None:
+        '''
+        :param model: model.Model used to detect, align and encode faces
+        :param min_interval: min seconds between sampled frames
+        :param max_interval: sample a frame at least every this many seconds, even if the scene is static
+        :param scene_change: min mean absolute difference (as a fraction of 255) of a downscaled
+            grayscale frame to the last sampled frame for the frame to be sampled
+        :param iou_threshold: min overlap of a detection with a track's last box to continue the track
+        :param max_missed: number of consecutive sampled frames a track may go undetected before it ends
+        :param chips_per_track: number of chips of each track that are encoded
+        '''
+        if not self._type_check('min_interval', min_interval, (int, float)) or \
+            not self._type_check('max_interval', max_interval, (int, float)) or \
+            not self._type_check('scene_change', scene_change, (int, float)) or \
+            not self._type_check('iou_threshold', iou_threshold, (int, float)) or \
+            not self._type_check('max_missed', max_missed, int) or \
+            not self._type_check('chips_per_track', chips_per_track, int):
+            raise TypeError
+        if min_interval <= 0 or max_interval < min_interval:
+            print(f'need 0 < min_interval <= max_interval. Got: {min_interval}, {max_interval}')
+            raise ValueError
+        if iou_threshold < 0 or iou_threshold > 1:
+            print(f'iou_threshold must be in [0, 1]. Got: {iou_threshold}')
+            raise ValueError
+        if max_missed < 0 or chips_per_track < 1:
+            print(f'max_missed must be >= 0 and chips_per_track >= 1. Got: {max_missed}, {chips_per_track}')
+            raise ValueError
+        self.model = model
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.scene_change = scene_change
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.chips_per_track = chips_per_track
+        self.stats = {'frames': 0, 'sampled': 0, 'tracks': 0, 'encoded': 0}
+
+    def frames(self, video_path:str):
+        '''
+        Yields (timestamp, frame) of the sampled frames of a video. Frames between
+        sample points are only grabbed, not decoded
+        :param video_path: video file path
+        '''
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            print(f'!!! Could not open video {video_path}')
+            raise FileNotFoundError
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS)
+            fps = fps if fps > 0 else 25.0
+            step = max(1, int(round(self.min_interval*fps)))
+            index, last_small, last_timestamp = -1, None, None
+            while capture.grab():
+                index += 1
+                self.stats['frames'] += 1
+                if index % step != 0:
+                    continue
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                timestamp = index/fps
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+                small = cv2.resize(gray, (32, 18), interpolation=cv2.INTER_AREA).astype(np.float32)
+                if last_small is not None and timestamp-last_timestamp < self.max_interval and \
+                    np.abs(small-last_small).mean() < self.scene_change*255:
+                    continue
+                last_small, last_timestamp = small, timestamp
+                self.stats['sampled'] += 1
+                yield timestamp, frame
+        finally:
+            capture.release()
+
+    def ingest(self, video_path:str, upsample_times:int=0) -> dict:
+        '''
+        Returns a dictionary of frame key -> FaceData holding the encoded chips of
+        every face track of the video. Faces of different tracks chosen from the same
+        frame share its key. A track is encoded and its chips released as soon as it
+        ends, so memory does not grow with the number of tracks
+        :param video_path: video file path
+        :param upsample_times: optionally upsample frames prior to detection
+        '''
+        if not self._type_check('video_path', video_path, str) or \
+            not self._type_check('upsample_times', upsample_times, int):
+            raise TypeError
+        active, frames, next_id = list(), dict(), 0 # frames: timestamp -> (encodings, boxes)
+        for timestamp, frame in self.frames(video_path):
+            faces = self.model.extract_faces(frame, upsample_times)
+            boxes = [(f.left(), f.top(), f.right(), f.bottom()) for f in faces]
+            matched = self._match(active, boxes)
+            owners = {box_num: active[track_num] for track_num, box_num in matched.items()}
+            for track_num, track in enumerate(active):
+                if track_num not in matched:
+                    track.missed += 1
+            for box_num, box in enumerate(boxes):
+                track = owners.get(box_num)
+                if track is None:
+                    track = Track(next_id, box, timestamp)
+                    next_id += 1
+                    active.append(track)
+                track.box, track.last_seen, track.missed = box, timestamp, 0
+                crop, crop_box = self._crop(frame, box)
+                track.offer(self._quality(crop, crop_box), timestamp, box, crop, crop_box, self.chips_per_track)
+            for track in active:
+                if track.missed > self.max_missed:
+                    self._encode(track, frames)
+            active = [t for t in active if t.missed <= self.max_missed]
+        for track in active:
+            self._encode(track, frames)
+        self.stats['tracks'] += next_id
+        return {video_frames.frame_key(video_path, timestamp): model.FaceData(encodings, np.array(boxes))
+            for timestamp, (encodings, boxes) in sorted(frames.items())}
+
+    def _match(self, tracks:list, boxes:list) -> dict:
+        '''
+        Private method greedily matching detections to tracks by IoU.
+        Returns track index -> box index
+        '''
+        pairs = sorted(((self._iou(track.box, box), t, b) for t, track in enumerate(tracks)
+            for b, box in enumerate(boxes)), reverse=True)
+        matched, used = dict(), set()
+        for iou, t, b in pairs:
+            if iou < self.iou_threshold:
+                break
+            if t not in matched and b not in used:
+                matched[t] = b
+                used.add(b)
+        return matched
+
+    def _iou(self, a:tuple, b:tuple) -> float:
+        '''
+        Private method returning the intersection over union of two (left, top, right, bottom) boxes
+        '''
+        width = min(a[2], b[2])-max(a[0], b[0])
+        height = min(a[3], b[3])-max(a[1], b[1])
+        if width <= 0 or height <= 0:
+            return 0.0
+        intersection = width*height
+        union = (a[2]-a[0])*(a[3]-a[1])+(b[2]-b[0])*(b[3]-b[1])-intersection
+        return intersection/union if union > 0 else 0.0
+
+    def _crop(self, frame:np.ndarray, box:tuple) -> tuple:
+        '''
+        Private method returning a copy of the face with half a face of margin on each
+        side (enough to align it) and the face box relative to the crop
+        '''
+        margin_x, margin_y = (box[2]-box[0])//2, (box[3]-box[1])//2
+        left, top = max(0, box[0]-margin_x), max(0, box[1]-margin_y)
+        right, bottom = min(frame.shape[1], box[2]+margin_x), min(frame.shape[0], box[3]+margin_y)
+        crop = np.ascontiguousarray(frame[top:bottom, left:right])
+        return crop, (box[0]-left, box[1]-top, box[2]-left, box[3]-top)
+
+    def _quality(self, crop:np.ndarray, crop_box:tuple) -> float:
+        '''
+        Private method scoring a chip by face area times sharpness (variance of the Laplacian)
+        '''
+        face = crop[max(0, crop_box[1]):max(0, crop_box[3]), max(0, crop_box[0]):max(0, crop_box[2])]
+        if face.size == 0:
+            return 0.0
+        gray = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY) if face.ndim == 3 else face
+        return float(face.shape[0]*face.shape[1]*cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    def _encode(self, track:Track, frames:dict) -> None:
+        '''
+        Private method encoding the kept chips of an ended track into frames
+        (timestamp -> (encodings, boxes)) and releasing the chips
+        '''
+        for quality, timestamp, box, crop, crop_box in track.chips:
+            rect = dlib.rectangle(*(int(v) for v in crop_box))
+            pose_locations = self.model.extract_landmarks(crop, [rect])
+            encodings = self.model.compute_encodings(crop, pose_locations)
+            faces = frames.setdefault(timestamp, ([], []))
+            faces[0].extend(encodings)
+            faces[1].append(box)
+            self.stats['encoded'] += len(encodings)
+        track.chips = list()
+
+    def _type_check(self, obj_name:str, obj, type)->bool:
+        '''
+        Private method to type check an object
+        :param obj_name: variable name
+        :param obj: actual obj
+        :param type: expected type of obj
+        '''
+        try:
+            if not isinstance(obj, type):
+                print(f'!!! {obj_name} should be of type {type} not {type(obj)}')
+            else:
+                return True
+        except Exception as e:
+            print(f"!!! Error in _type_check: \n {e}")
+        return False
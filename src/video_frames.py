@@ -0,0 +1,66 @@
+import os
+import re
+import numpy as np
+import cv2
+
+VIDEO_SUFFIXES = {s for suffix in ('.mp4', '.mov', '.m4v', '.avi', '.mkv', '.webm') for s in (suffix, suffix.upper())}
+FRAME_KEY_PATTERN = re.compile(r'^(?P<path>.+)#t=(?P<timestamp>\d+(?:\.\d+)?)$')
+
+def frame_key(video_path:str, timestamp:float) -> str:
+    '''
+    Returns the face data key of a video frame, e.g. "clips/party.mp4#t=12.480".
+    Uses the media fragment syntax so browsers open the video at that time
+    :param video_path: video file path
+    :param timestamp: time of the frame in seconds
+    '''
+    return f'{video_path}#t={timestamp:.3f}'
+
+def parse_frame_key(key:str) -> tuple:
+    '''
+    Returns (video path, timestamp in seconds) of a key made by frame_key, or None
+    if the key names an image
+    :param key: face data key
+    '''
+    match = FRAME_KEY_PATTERN.match(key)
+    if match is None or os.path.splitext(match.group('path'))[1] not in VIDEO_SUFFIXES:
+        return None
+    return match.group('path'), float(match.group('timestamp'))
+
+def source_path(key:str) -> str:
+    '''
+    Returns the file a face data key was extracted from: the video of a frame key,
+    else the key itself
+    :param key: face data key
+    '''
+    parsed = parse_frame_key(key)
+    return parsed[0] if parsed is not None else key
+
+def read_frame(video_path:str, timestamp:float) -> np.ndarray:
+    '''
+    Seeks to and decodes the frame shown at timestamp. Returns None if the video
+    cannot be read
+    :param video_path: video file path
+    :param timestamp: time of the frame in seconds
+    '''
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            return None
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        fps = fps if fps > 0 else 25.0 # same fallback as VideoIngester.frames
+        capture.set(cv2.CAP_PROP_POS_FRAMES, round(timestamp*fps)) # keys round index/fps to the ms
+        ok, frame = capture.read()
+        return frame if ok else None
+    finally:
+        capture.release()
+
+def read_key(key:str) -> np.ndarray:
+    '''
+    Reads the image or video frame named by a face data key. Returns None if it
+    cannot be read
+    :param key: face data key
+    '''
+    parsed = parse_frame_key(key)
+    if parsed is not None:
+        return read_frame(*parsed)
+    return cv2.imread(key)
@@ -0,0 +1,28 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import model
+
+def random_face_data(n_images:int, seed:int=0, n_identities:int=20, max_faces:int=3) -> dict:
+    '''
+    Returns image key -> FaceData of synthetic encodings drawn around n_identities
+    centers, so some faces pass the match thresholds and most do not
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_identities, 128))*0.05
+    data = dict()
+    for i in range(n_images):
+        n_faces = int(rng.integers(1, max_faces+1))
+        identities = rng.integers(0, n_identities, n_faces)
+        encodings = centers[identities] + rng.normal(size=(n_faces, 128))*rng.uniform(0.002, 0.05)
+        boxes = rng.integers(0, 500, size=(n_faces, 4)).astype(np.int32)
+        data[f'img_{i:05d}.jpg'] = model.FaceData(encodings, boxes)
+    return data
+
+@pytest.fixture
+def face_data() -> dict:
+    return random_face_data(400)
@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import face_store
+
+def assert_same_face_data(store:face_store.FaceStore, face_data:dict) -> None:
+    assert store.keys == list(face_data.keys())
+    for key, data in face_data.items():
+        stored = store.get(key)
+        if data is None:
+            assert stored is None
+            continue
+        np.testing.assert_array_equal(stored.encodings, data.encodings)
+        np.testing.assert_array_equal(stored.boxes, data.boxes)
+
+def test_write_read_round_trip(tmp_path, face_data):
+    face_data['failed.jpg'] = None
+    path = str(tmp_path/'faces.fstore')
+    face_store.FaceStore.write(path, face_data)
+    store = face_store.FaceStore(path)
+    assert_same_face_data(store, face_data)
+    np.testing.assert_allclose(store.norms, np.linalg.norm(store.encodings, axis=1), rtol=1e-6)
+    assert not os.path.exists(f'{path}.tmp') and not os.path.exists(f'{path}.old')
+
+def test_view_reads_lazily_and_tracks_changes(tmp_path, face_data):
+    path = str(tmp_path/'faces.fstore')
+    face_store.FaceStore.write(path, face_data)
+    view = face_store.FaceDataView(face_store.FaceStore(path))
+    first = next(iter(face_data))
+    del view[first]
+    view['new.jpg'] = None
+    assert view.modified and first not in view and 'new.jpg' in view
+    assert len(view) == len(face_data)
+    assert list(view)[-1] == 'new.jpg'
+
+def test_recover_after_crash_between_renames(tmp_path, face_data):
+    path = str(tmp_path/'faces.fstore')
+    face_store.FaceStore.write(path, face_data)
+    os.rename(path, f'{path}.old') # crashed after moving the old store aside
+    assert_same_face_data(face_store.FaceStore(path), face_data)
+    assert not os.path.exists(f'{path}.old')
+
+def test_recover_replaces_an_incomplete_store(tmp_path, face_data):
+    path = str(tmp_path/'faces.fstore')
+    face_store.FaceStore.write(path, face_data)
+    os.rename(path, f'{path}.old')
+    os.makedirs(path) # the new store was only partially renamed into place
+    assert face_store.recover(path)
+    assert_same_face_data(face_store.FaceStore(path), face_data)
+
+def test_completed_swap_keeps_the_new_store(tmp_path, face_data):
+    path = str(tmp_path/'faces.fstore')
+    old = dict(list(face_data.items())[:10])
+    face_store.FaceStore.write(path, old)
+    os.rename(path, f'{path}.old')
+    face_store.FaceStore.write(f'{path}.new', face_data)
+    os.rename(f'{path}.new', path) # crashed before deleting the old store
+    assert not face_store.recover(path)
+    assert not os.path.exists(f'{path}.old')
+    assert_same_face_data(face_store.FaceStore(path), face_data)
@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+import file_handler
+
+@pytest.fixture(params=['faces.fstore', 'faces.pbz2'])
+def library_path(request, tmp_path) -> str:
+    return str(tmp_path/request.param)
+
+def assert_same_face_data(found:dict, expected:dict) -> None:
+    assert set(found.keys()) == set(expected.keys())
+    for key, data in expected.items():
+        if data is None:
+            assert found[key] is None
+            continue
+        np.testing.assert_array_equal(found[key].encodings, data.encodings)
+        np.testing.assert_array_equal(found[key].boxes, data.boxes)
+
+def test_journal_is_replayed_after_a_crash(library_path, face_data):
+    keys = list(face_data.keys())
+    saved = {key: face_data[key] for key in keys[:100]}
+    handler = file_handler.FileHandler(library_path)
+    handler.face_data_dict.update(saved)
+    assert handler.save_face_data(silent=True)
+
+    # checkpoints of a later run that never reached its final save
+    handler = file_handler.FileHandler(library_path)
+    first = {key: face_data[key] for key in keys[100:150]}
+    first['failed.jpg'] = None
+    assert handler.checkpoint(first, manifest_entries={key: {'size': 1, 'mtime': 2} for key in keys[100:150]})
+    second = {key: face_data[key] for key in keys[150:200]}
+    assert handler.checkpoint(second, removed=keys[:10])
+    with open(os.path.join(handler.journal.journal_dir, 'segment-00000002.npz.tmp'), 'wb') as file:
+        file.write(b'half a segment') # crashed mid-append
+    del handler
+
+    expected = {**saved, **first, **second}
+    for key in keys[:10]:
+        del expected[key]
+    handler = file_handler.FileHandler(library_path)
+    assert_same_face_data(handler.face_data_dict, expected)
+    assert set(handler.manifest.entries.keys()) == set(keys[100:150])
+
+    assert handler.save_face_data(silent=True)
+    assert handler.journal.segments() == list()
+    assert os.listdir(handler.journal.journal_dir) == list()
+    assert_same_face_data(file_handler.FileHandler(library_path).face_data_dict, expected)
+
+def test_failed_manifest_save_keeps_the_journal(library_path, face_data):
+    keys = list(face_data.keys())
+    handler = file_handler.FileHandler(library_path)
+    assert handler.checkpoint({key: face_data[key] for key in keys[:20]})
+    handler.manifest.manifest_path = os.path.join(library_path + '.missing', 'manifest.json')
+    assert not handler.save_face_data(silent=True)
+    assert len(handler.journal.segments()) == 1
@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import pytest
+import cv2
+import manifest
+
+main = pytest.importorskip('main') # needs dlib
+
+def write_images(dir_path, names:list, seed:int=0) -> list:
+    '''
+    Writes distinct random images, which neither match nor near-duplicate each other
+    '''
+    rng = np.random.default_rng(seed)
+    paths = list()
+    for name in names:
+        path = str(dir_path/name)
+        cv2.imwrite(path, rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+def touch(path:str, content_seed:int=None) -> None:
+    '''
+    Rewrites a file with new content (content_seed) or the same content, and bumps its mtime
+    '''
+    if content_seed is not None:
+        rng = np.random.default_rng(content_seed)
+        cv2.imwrite(path, rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+
+def fake_extract(face_data:dict, failing:set=None):
+    '''
+    Returns a Driver._extract_iter replacement yielding face_data (keyed by file name)
+    and None for file names in failing
+    '''
+    calls = list()
+    def extract_iter(files, *args, **kwargs):
+        for file in files:
+            calls.append(file)
+            name = os.path.basename(file)
+            yield file, None if failing is not None and name in failing else face_data[name]
+    extract_iter.calls = calls
+    return extract_iter
+
+def image_face_data(face_data:dict, names:list) -> dict:
+    return dict(zip(names, face_data.values()))
+
+def test_diff_counts(tmp_path):
+    dir_path = tmp_path/'images'
+    dir_path.mkdir()
+    paths = write_images(dir_path, ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg'])
+    m = manifest.Manifest(str(tmp_path/'manifest.json'))
+    changes = m.diff(paths, str(dir_path), hash_files=True)
+    assert {k: len(changes[k]) for k in ('added', 'updated', 'removed', 'skipped')} == \
+        {'added': 4, 'updated': 0, 'removed': 0, 'skipped': 0}
+    m.update(changes['entries'])
+
+    os.remove(paths[0])
+    touch(paths[1], content_seed=1) # modified
+    touch(paths[2]) # only touched, the hash still matches
+    paths += write_images(dir_path, ['e.jpg'], seed=2)
+    changes = m.diff(paths[1:], str(dir_path), hash_files=True)
+    assert changes['added'] == [paths[4]]
+    assert changes['updated'] == [paths[1]]
+    assert changes['removed'] == [paths[0]]
+    assert sorted(changes['skipped']) == sorted(paths[2:4])
+
+def test_diff_adopts_only_encoded_files(tmp_path):
+    dir_path = tmp_path/'images'
+    dir_path.mkdir()
+    paths = write_images(dir_path, ['a.jpg', 'b.jpg'])
+    m = manifest.Manifest(str(tmp_path/'manifest.json'))
+    changes = m.diff(paths, str(dir_path), known={paths[0]: object(), paths[1]: None})
+    assert changes['skipped'] == [paths[0]]
+    assert changes['added'] == [paths[1]]
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_incremental_batch_counts(tmp_path, face_data, dedup):
+    dir_path = tmp_path/'images'
+    dir_path.mkdir()
+    names = ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg']
+    paths = write_images(dir_path, names[:4])
+    data = image_face_data(face_data, names)
+    driver = main.Driver(str(tmp_path/'faces.fstore'))
+    counts = lambda report: {k: report[k] for k in ('added', 'updated', 'removed', 'skipped')}
+
+    driver._extract_iter = fake_extract(data)
+    report = driver.batch_extract_faces(str(dir_path), incremental=True, dedup=dedup)
+    assert counts(report) == {'added': 4, 'updated': 0, 'removed': 0, 'skipped': 0}
+
+    driver._extract_iter = fake_extract(data)
+    report = driver.batch_extract_faces(str(dir_path), incremental=True, dedup=dedup)
+    assert counts(report) == {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 4}
+    assert driver._extract_iter.calls == list()
+
+    os.remove(paths[0])
+    touch(paths[1], content_seed=1)
+    paths += write_images(dir_path, names[4:], seed=2)
+    driver._extract_iter = fake_extract(data)
+    report = driver.batch_extract_faces(str(dir_path), incremental=True, dedup=dedup)
+    assert counts(report) == {'added': 1, 'updated': 1, 'removed': 1, 'skipped': 2}
+    assert sorted(driver._extract_iter.calls) == sorted([paths[1], paths[4]])
+
+    driver = main.Driver(str(tmp_path/'faces.fstore'))
+    assert sorted(driver.file_handler.face_data_dict.keys()) == sorted(paths[1:])
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_full_batch_counts(tmp_path, face_data, dedup):
+    dir_path = tmp_path/'images'
+    dir_path.mkdir()
+    names = ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+    write_images(dir_path, names)
+    driver = main.Driver(str(tmp_path/'faces.fstore'))
+    driver._extract_iter = fake_extract(image_face_data(face_data, names))
+    report = driver.batch_extract_faces(str(dir_path), dedup=dedup)
+    assert report['added'] == 4 and report['updated'] == 0
+    report = driver.batch_extract_faces(str(dir_path), dedup=dedup)
+    assert report['added'] == 0 and report['updated'] == 4
+
+def test_failed_files_are_retried(tmp_path, face_data):
+    dir_path = tmp_path/'images'
+    dir_path.mkdir()
+    names = ['a.jpg', 'b.jpg', 'c.jpg']
+    paths = write_images(dir_path, names)
+    data = image_face_data(face_data, names)
+    driver = main.Driver(str(tmp_path/'faces.fstore'))
+
+    driver._extract_iter = fake_extract(data, failing={'b.jpg'})
+    driver.batch_extract_faces(str(dir_path), incremental=True)
+    assert driver.file_handler.face_data_dict[paths[1]] is None
+
+    driver._extract_iter = fake_extract(data)
+    report = driver.batch_extract_faces(str(dir_path), incremental=True)
+    assert driver._extract_iter.calls == [paths[1]]
+    assert report['added'] == 1 and report['skipped'] == 2
+    assert driver.file_handler.face_data_dict[paths[1]] is not None
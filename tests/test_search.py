@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import model
+import search
+import quantization
+
+def brute_force(face_data:dict, query:str, euclidean_thres:float=0.6, cosine_thres:float=0.92) -> list:
+    '''
+    Ranks every face of every other image like the original find_similarities loop:
+    Metrics per face from Model.compute_similarity, kept if either threshold passes
+    '''
+    m = model.Model()
+    query_encodings = face_data[query].face_encodings
+    matches = list()
+    for key, data in face_data.items():
+        if key == query:
+            continue
+        for face_num, metrics in enumerate(m.compute_similarity(query_encodings, data.face_encodings)):
+            if metrics.euclid_dist <= euclidean_thres or metrics.cos_sim >= cosine_thres:
+                matches.append((metrics.sim_score, key, face_num))
+    return sorted(matches)
+
+def single_face_keys(face_data:dict, n:int) -> list:
+    return [key for key, data in face_data.items() if len(data.face_encodings) == 1][:n]
+
+def test_search_matches_brute_force_ranking(face_data):
+    index = search.EmbeddingIndex.from_face_data(face_data)
+    for query in single_face_keys(face_data, 10):
+        expected = brute_force(face_data, query)
+        matches = index.search(face_data[query].face_encodings[0], exclude=query)
+        assert len(expected) > 0
+        assert [(m.key, m.face_num) for m in matches] == [(key, face_num) for _, key, face_num in expected]
+        np.testing.assert_allclose([m.sim_score for m in matches], [score for score, _, _ in expected], atol=1e-5)
+
+def test_search_top_k_is_a_prefix_of_the_full_ranking(face_data):
+    index = search.EmbeddingIndex.from_face_data(face_data)
+    query = single_face_keys(face_data, 1)[0]
+    encoding = face_data[query].face_encodings[0]
+    full = index.search(encoding, exclude=query)
+    assert index.search(encoding, top_k=5, exclude=query) == full[:5]
+    batched = index.search_batch([encoding], top_k=5, exclude=[query])[0]
+    assert [(m.key, m.face_num) for m in batched] == [(m.key, m.face_num) for m in full[:5]]
+    np.testing.assert_allclose([m.sim_score for m in batched], [m.sim_score for m in full[:5]], atol=1e-5)
+
+def test_find_similarities_matches_compute_similarity(face_data):
+    m = model.Model()
+    query = single_face_keys(face_data, 1)[0]
+    metrics = m.find_similarities(query, face_data)
+    assert len(metrics) == len(face_data)-1
+    for (_, key), found in metrics.items():
+        expected = m.compute_similarity(face_data[query].face_encodings, face_data[key].face_encodings)
+        np.testing.assert_allclose([x.sim_score for x in found], [x.sim_score for x in expected], atol=1e-5)
+
+def test_removed_images_are_not_returned(face_data):
+    index = search.EmbeddingIndex.from_face_data(face_data)
+    query = single_face_keys(face_data, 1)[0]
+    removed = [m.key for m in index.search(face_data[query].face_encodings[0], exclude=query)[:3]]
+    remaining = {key: data for key, data in face_data.items() if key not in removed}
+    for key in removed:
+        assert index.remove(key)
+    expected = [(key, face_num) for _, key, face_num in brute_force(remaining, query)]
+    assert [(m.key, m.face_num) for m in index.search(face_data[query].face_encodings[0], exclude=query)] == expected
+    index.compact()
+    assert index.n_removed == 0
+    assert [(m.key, m.face_num) for m in index.search(face_data[query].face_encodings[0], exclude=query)] == expected
+
+@pytest.mark.parametrize('mode', ['float16', 'int8', 'pq'])
+def test_quantized_threshold_matches_equal_exact(face_data, mode):
+    flat = search.EmbeddingIndex.from_face_data(face_data)
+    index = quantization.QuantizedIndex.build(search.EmbeddingIndex.from_face_data(face_data), mode)
+    for query in single_face_keys(face_data, 10):
+        encoding = face_data[query].face_encodings[0]
+        exact = flat.search(encoding, exclude=query)
+        assert [(m.key, m.face_num) for m in index.search(encoding, exclude=query)] == \
+            [(m.key, m.face_num) for m in exact]